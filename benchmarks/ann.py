@@ -0,0 +1,89 @@
+"""
+Recall and throughput of the IVF index against exact search.
+
+Builds an index over a synthetic clustered corpus (or a wyrm file) and reports
+build time, queries per second and recall@k of indexed search for several
+`nprobe` values, next to exact blocked search. It also builds an index on part
+of the corpus, appends the rest with `Bookwyrm.extend`, and reports the
+append time and recall of the extended index.
+
+    python -m benchmarks.ann --chunks 200000
+    python -m benchmarks.ann --wyrm wyrm.npz
+    python -m benchmarks.ann --append 0.2
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from bookwyrm.models import Bookwyrm
+from bookwyrm.search import top_k
+
+from .quantization import make_corpus, make_queries
+
+
+def timed_search(search, queries: np.ndarray) -> tuple:
+    start = time.perf_counter()
+    indices, _ = search(queries)
+    elapsed = time.perf_counter() - start
+    return indices, round(len(queries) / elapsed, 1)
+
+
+def recall(truth: np.ndarray, found: np.ndarray) -> float:
+    k = truth.shape[1]
+    return round(float(np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)])), 4)
+
+
+def extend_results(wyrm: Bookwyrm, queries: np.ndarray, truth: np.ndarray, k: int, nprobes, append: float) -> dict:
+    """
+    Index the first rows, append the remaining `append` fraction, and measure the extended index.
+    """
+    split = int(len(wyrm.chunks) * (1 - append))
+    base = Bookwyrm.construct(
+        documents=[],
+        chunks=wyrm.chunks[:split],
+        embeddings=wyrm.float_embeddings(slice(0, split)),
+        embedding_dtype="float32",
+        embedding_scales=None,
+        embedding_rows=None,
+    )
+    base.build_index()
+    start = time.perf_counter()
+    base.extend([], wyrm.chunks[split:], wyrm.float_embeddings(slice(split, None)))
+    results = {"appended_rows": len(wyrm.chunks) - split, "extend_s": round(time.perf_counter() - start, 2)}
+    for nprobe in nprobes:
+        found, qps = timed_search(lambda q: base.index.search(base, q, k, nprobe=nprobe), queries)
+        results[f"ivf nprobe={nprobe}"] = {"qps": qps, f"recall@{k}": recall(truth, found)}
+    return results
+
+
+def run(wyrm: Bookwyrm, num_queries: int, k: int, nprobes, append: float = 0.1) -> dict:
+    queries = make_queries(wyrm.float_embeddings(), num_queries)
+    truth, qps = timed_search(lambda q: top_k(wyrm, q, k), queries)
+    results = {"exact": {"qps": qps, f"recall@{k}": 1.0}}
+
+    start = time.perf_counter()
+    index = wyrm.build_index()
+    results["build_s"] = round(time.perf_counter() - start, 2)
+    results["num_lists"] = len(index.centroids)
+    for nprobe in nprobes:
+        found, qps = timed_search(lambda q: index.search(wyrm, q, k, nprobe=nprobe), queries)
+        results[f"ivf nprobe={nprobe}"] = {"qps": qps, f"recall@{k}": recall(truth, found)}
+    if append > 0:
+        results["extended"] = extend_results(wyrm, queries, truth, k, nprobes, append)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--wyrm", default=None, help="Binary wyrm file to use instead of a synthetic corpus.")
+    parser.add_argument("--chunks", type=int, default=100000, help="Chunks in the synthetic corpus.")
+    parser.add_argument("--dim", type=int, default=768, help="Dimension of the synthetic embeddings.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries.")
+    parser.add_argument("-k", type=int, default=10, help="Neighbours per query.")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32], help="nprobe values to try.")
+    parser.add_argument("--append", type=float, default=0.1, help="Fraction of rows appended to a built index with extend (0 to skip).")
+    args = parser.parse_args()
+    wyrm = Bookwyrm.load(args.wyrm, mmap=True) if args.wyrm else make_corpus(args.chunks, args.dim)
+    print(json.dumps(run(wyrm, args.queries, args.k, args.nprobe, args.append), indent=4))
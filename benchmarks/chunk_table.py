@@ -0,0 +1,86 @@
+"""
+Memory and speed of ChunkTable against a list of TextChunk models.
+
+Builds the same synthetic chunks both ways and reports construction time, the
+resident memory they add, and JSON and binary serialization throughput. Each
+representation is measured in a fresh process so their memory doesn't mix.
+
+    python -m benchmarks.chunk_table --chunks 1000000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from bookwyrm.models import Bookwyrm, ChunkTable, NumpyEncoder, TextChunk
+
+
+def make_texts(num_chunks: int, chars: int = 200) -> list:
+    words = "the quick brown fox jumps over the lazy dog while the wyrm reads books".split()
+    line = " ".join(words * (chars // 60 + 1))[:chars]
+    return [f"{i} {line}" for i in range(num_chunks)]
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure(kind: str, num_chunks: int) -> dict:
+    texts = make_texts(num_chunks)
+    indexes = np.arange(num_chunks)
+    before = rss_bytes()
+    start = time.perf_counter()
+    if kind == "models":
+        chunks = [
+            TextChunk(text=text, document_index=i // 100, local_index=i % 100, global_index=i)
+            for i, text in enumerate(texts)
+        ]
+    else:
+        chunks = ChunkTable.from_texts(texts, document_index=indexes // 100, local_index=indexes % 100, global_index=indexes)
+    build_s = time.perf_counter() - start
+    added = rss_bytes() - before
+    del texts
+
+    start = time.perf_counter()
+    encoded = json.dumps(chunks, cls=NumpyEncoder) if kind == "table" else json.dumps([c.dict() for c in chunks])
+    json_s = time.perf_counter() - start
+
+    wyrm = Bookwyrm.construct(documents=[], chunks=chunks, embeddings=np.zeros((num_chunks, 0), dtype=np.float32))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "wyrm.npz")
+        start = time.perf_counter()
+        wyrm.save(path)
+        save_s = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = Bookwyrm.load(path)
+        load_s = time.perf_counter() - start
+        assert len(loaded.chunks) == num_chunks
+
+    return {
+        "build_s": round(build_s, 3),
+        "rss_added_mb": round(added / 2**20, 1),
+        "json_mb_per_s": round(len(encoded) / 2**20 / json_s, 1),
+        "save_s": round(save_s, 3),
+        "load_s": round(load_s, 3),
+    }
+
+
+def run(num_chunks: int) -> dict:
+    results = {}
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for kind in ("models", "table"):
+            results[kind] = pool.apply(measure, (kind, num_chunks))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=1_000_000, help="Number of chunks.")
+    args = parser.parse_args()
+    print(json.dumps(run(args.chunks), indent=4))
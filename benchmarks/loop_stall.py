@@ -0,0 +1,109 @@
+"""
+Event-loop stall benchmark for CPU-bound parsing.
+
+Parses a synthetic multi-page PDF and a batch of HTML pages while a ticker
+coroutine measures how late the event loop wakes it up. Compares running the
+parsers inline on the loop (the old behaviour) with the process and thread pools.
+
+    python -m benchmarks.loop_stall --pages 300
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bookwyrm.scrape import executor
+from bookwyrm.scrape.scrape import parse_html
+
+
+def make_pdf(num_pages: int, lines_per_page: int = 40) -> bytes:
+    """
+    Build a minimal valid PDF with a line of text per row on every page.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for p in range(num_pages):
+        rows = "".join(f"(Page {p} line {i} of the benchmark corpus) Tj T* " for i in range(lines_per_page))
+        stream = f"BT /F1 10 Tf 12 TL 40 760 Td {rows}ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), num_pages)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def make_html(num_links: int = 200) -> str:
+    links = "".join(f'<li><a href="/page/{i}">Page {i}</a> some text about page {i}</li>' for i in range(num_links))
+    return f"<html><body><h1>Index</h1><ul>{links}</ul></body></html>"
+
+
+async def measure(work, interval: float = 0.005) -> dict:
+    """
+    Run `work()` while a ticker records how late each wake-up is.
+    """
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - start - interval)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(interval)
+    start = time.perf_counter()
+    await work()
+    wall = time.perf_counter() - start
+    done.set()
+    await task
+    return {
+        "wall_s": round(wall, 4),
+        "max_lag_ms": round(max(lags, default=0) * 1000, 2),
+        "mean_lag_ms": round(sum(lags) / max(len(lags), 1) * 1000, 2),
+        "ticks": len(lags),
+    }
+
+
+async def run(pages: int, html_pages: int) -> dict:
+    pdf = make_pdf(pages)
+    html = make_html()
+    results = {}
+    for kind in ("inline", "thread", "process"):
+        executor.configure_executor(kind)
+        # Warm the pool so worker start-up isn't counted
+        await executor.run_cpu(len, b"")
+
+        async def pdf_work():
+            await executor.extract_pdf_text(pdf)
+
+        async def html_work():
+            await asyncio.gather(*[executor.run_cpu(parse_html, html) for _ in range(html_pages)])
+
+        results[kind] = {"pdf": await measure(pdf_work), "html": await measure(html_work)}
+    executor.configure_executor("process")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=300, help="Pages in the synthetic PDF.")
+    parser.add_argument("--html-pages", type=int, default=50, help="HTML pages to parse.")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.pages, args.html_pages)), indent=4))
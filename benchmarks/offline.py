@@ -0,0 +1,347 @@
+"""
+Offline end-to-end benchmark of scraping, chunking, encoding and serialization.
+
+Starts a local aiohttp stand-in for GitHub (tarball and contents API), arXiv,
+Semantic Scholar and a small web site, points the scrapers at it, and runs
+`scrape()`, `chunk()`, `encode()` with the hash embedder, `to_json()` and
+`to_ndjson()` on synthetic corpora of increasing size. For each stage it records wall time,
+peak resident memory, requests served by the stand-in and event-loop lag.
+
+Responses are generated at each scale, or replayed from a fixture directory
+written by `save_fixtures` (one `routes.json` plus a body file per route), so
+real recorded responses can be dropped in. The tiktoken encoding must already
+be in the local tiktoken cache.
+
+    python -m benchmarks.offline --sizes 1,4,16 --output offline.json
+    python -m benchmarks.offline --baseline offline.json
+"""
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+import platform
+import resource
+import tarfile
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from benchmarks.loop_stall import make_pdf, measure
+from bookwyrm.metrics import Metrics, collecting
+from bookwyrm.models import Bookwyrm, DocumentRecord
+from bookwyrm.process import chunk, encode
+from bookwyrm.scrape import arxiv, doi, github
+from bookwyrm.scrape.github import git_blob_sha
+from bookwyrm.scrape.main import scrape
+
+# (status, headers, body) by request path, including the query string
+Routes = Dict[str, Tuple[int, Dict[str, str], bytes]]
+
+REPO = "bench/repo"
+# Service each top-level path segment of the stand-in belongs to
+SERVICES = {"repos": "github", "raw": "github", "pdf": "arxiv", "v1": "semantic_scholar", "graph": "semantic_scholar", "site": "web"}
+ARXIV_ID = "2401.00001"
+
+
+def source_file(i: int, lines: int = 120) -> str:
+    body = "\n".join(f"    total += {j} * value  # step {j} of function {i}" for j in range(lines))
+    return f'"""Module {i} of the benchmark repo."""\n\n\ndef function_{i}(value):\n    total = 0\n{body}\n    return total\n'
+
+
+def make_tarball(files: Dict[str, str]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path, text in files.items():
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(f"bench-repo-0000000/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue(), mtime=0)
+
+
+def make_fixtures(base_url: str, scale: int) -> Routes:
+    """
+    Build stand-in responses for a corpus whose size grows linearly with `scale`.
+    """
+    json_headers = {"Content-Type": "application/json"}
+    routes: Routes = {}
+
+    # A repo fetched whole as a tarball, plus a subdirectory walked with the contents API
+    files = {f"pkg/module_{i}.py": source_file(i) for i in range(20 * scale)}
+    files.update({f"docs/page_{i}.md": f"# Page {i}\n\n" + "Some documentation text.\n" * 200 for i in range(5 * scale)})
+    routes[f"/repos/{REPO}/tarball"] = (200, {"Content-Type": "application/x-gzip"}, make_tarball(files))
+    listing = []
+    for path, text in files.items():
+        if path.startswith("docs/"):
+            routes[f"/raw/{REPO}/{path}"] = (200, {"Content-Type": "text/plain"}, text.encode("utf-8"))
+            listing.append({
+                "type": "file", "name": path.rsplit("/", 1)[-1], "path": path,
+                "sha": git_blob_sha(text.encode("utf-8")), "download_url": f"{base_url}/raw/{REPO}/{path}",
+            })
+    routes[f"/repos/{REPO}/contents/docs?ref=main"] = (200, json_headers, json.dumps(listing).encode("utf-8"))
+
+    routes[f"/pdf/{ARXIV_ID}.pdf"] = (200, {"Content-Type": "application/pdf"}, make_pdf(10 * scale))
+
+    for i in range(4 * scale):
+        paper = {
+            "title": f"Benchmark paper {i}",
+            "abstract": "An abstract about wyrms and books. " * 40,
+            "authors": [{"name": f"Author {a}"} for a in range(3)],
+            "year": 2024, "venue": "Bench", "url": f"{base_url}/paper/{i}",
+        }
+        routes[f"/v1/paper/10.1234/bench.{i}"] = (200, json_headers, json.dumps(paper).encode("utf-8"))
+
+    num_pages = 10 * scale
+    html_headers = {"Content-Type": "text/html; charset=utf-8", "ETag": '"bench"'}
+    links = "".join(f'<li><a href="/site/page/{i}">Page {i}</a></li>' for i in range(num_pages))
+    routes["/site"] = (200, html_headers, f"<html><body><h1>Site</h1><ul>{links}</ul></body></html>".encode("utf-8"))
+    for i in range(num_pages):
+        text = "".join(f"<p>Paragraph {p} of page {i} describing the site in some detail.</p>" for p in range(60))
+        routes[f"/site/page/{i}"] = (200, html_headers, f"<html><body><h1>Page {i}</h1>{text}</body></html>".encode("utf-8"))
+    return routes
+
+
+def save_fixtures(routes: Routes, directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    index = {}
+    for i, (path, (status, headers, body)) in enumerate(sorted(routes.items())):
+        name = f"body-{i:05d}"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(body)
+        index[path] = {"status": status, "headers": headers, "body": name}
+    with open(os.path.join(directory, "routes.json"), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def load_fixtures(directory: str, base_url: str) -> Routes:
+    """
+    Read fixtures written by `save_fixtures`. `{base_url}` in a body is replaced with the stand-in's address.
+    """
+    with open(os.path.join(directory, "routes.json")) as f:
+        index = json.load(f)
+    routes: Routes = {}
+    for path, route in index.items():
+        with open(os.path.join(directory, route["body"]), "rb") as f:
+            body = f.read().replace(b"{base_url}", base_url.encode("utf-8"))
+        routes[path] = (route["status"], route["headers"], body)
+    return routes
+
+
+class StandInServer:
+    """
+    Serves fixed responses by path and counts the requests per service.
+    """
+    def __init__(self):
+        self.routes: Routes = {}
+        self.requests: Counter = Counter()
+        self.runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        segment = request.path.strip("/").split("/", 1)[0]
+        self.requests[SERVICES.get(segment, segment)] += 1
+        route = self.routes.get(request.path_qs) or self.routes.get(request.path)
+        if route is None:
+            return web.Response(status=404)
+        status, headers, body = route
+        if request.headers.get("If-None-Match") and request.headers["If-None-Match"] == headers.get("ETag"):
+            return web.Response(status=304, headers=headers)
+        return web.Response(status=status, headers=headers, body=body)
+
+    async def handle_paper_batch(self, request: web.Request) -> web.Response:
+        """
+        Answer the Semantic Scholar batch endpoint from the single-paper fixtures.
+        """
+        self.requests["semantic_scholar"] += 1
+        papers = []
+        for paper_id in (await request.json())["ids"]:
+            route = self.routes.get(f"/v1/paper/{paper_id.removeprefix('DOI:')}")
+            papers.append(json.loads(route[2]) if route else None)
+        return web.json_response(papers)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("POST", "/graph/v1/paper/batch", self.handle_paper_batch)
+        app.router.add_route("GET", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def tasks_for(server: StandInServer, scale: int) -> List[str]:
+    return [
+        f"https://github.com/{REPO}",
+        f"https://github.com/{REPO}/tree/main/docs",
+        f"https://arxiv.org/pdf/{ARXIV_ID}",
+        f"{server.base_url}/site",
+    ] + [f"10.1234/bench.{i}" for i in range(4 * scale)]
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+class PeakMemory:
+    """
+    Samples resident memory on a background thread and keeps the peak above the starting level.
+    """
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.start = self.peak = rss_bytes()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self) -> 'PeakMemory':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+async def measure_stage(server: StandInServer, work) -> Tuple[dict, object]:
+    """
+    Run `work()` and report wall time, peak memory added, stand-in requests and event-loop lag.
+    """
+    result = None
+
+    async def run():
+        nonlocal result
+        result = await work()
+
+    server.requests.clear()
+    metrics = Metrics()
+    with PeakMemory() as memory, collecting(metrics):
+        stats = await measure(run)
+    stats["peak_rss_added_mb"] = round((memory.peak - memory.start) / 2**20, 1)
+    stats["requests"] = dict(server.requests)
+    stats["counters"] = metrics.report().counters
+    return stats, result
+
+
+async def run_size(server: StandInServer, scale: int, fixtures: Optional[str]) -> dict:
+    server.routes = load_fixtures(fixtures, server.base_url) if fixtures else make_fixtures(server.base_url, scale)
+    tasks = tasks_for(server, scale)
+    results = {}
+
+    async def scrape_stage():
+        return await scrape(tasks)
+
+    async def chunk_stage():
+        return chunk(documents)
+
+    async def encode_stage():
+        return await encode(chunks, embedder="hash")
+
+    async def json_stage():
+        return wyrm.to_json()
+
+    async def ndjson_stage():
+        wyrm.to_ndjson(ndjson_path)
+        return os.path.getsize(ndjson_path)
+
+    results["scrape"], documents = await measure_stage(server, scrape_stage)
+    results["chunk"], chunks = await measure_stage(server, chunk_stage)
+    results["encode"], embeddings = await measure_stage(server, encode_stage)
+    wyrm = Bookwyrm(
+        documents=[DocumentRecord(index=i, uri=d.source, metadata=d.metadata) for i, d in enumerate(documents)],
+        chunks=chunks,
+        embeddings=embeddings,
+    )
+    results["to_json"], encoded = await measure_stage(server, json_stage)
+    json_bytes = len(encoded)
+    # Free the JSON string so it doesn't count against the streamed writer
+    del encoded
+    with tempfile.TemporaryDirectory() as tmp:
+        ndjson_path = os.path.join(tmp, "wyrm.ndjson")
+        results["to_ndjson"], ndjson_bytes = await measure_stage(server, ndjson_stage)
+    results["corpus"] = {
+        "documents": len(documents),
+        "chars": sum(d.num_chars for d in documents),
+        "chunks": len(chunks),
+        "json_mb": round(json_bytes / 2**20, 2),
+        "ndjson_mb": round(ndjson_bytes / 2**20, 2),
+    }
+    return results
+
+
+async def run(sizes: List[int], fixtures: Optional[str] = None) -> dict:
+    server = StandInServer()
+    await server.start()
+    overrides = {(github, "API_BASE_URL"): server.base_url, (arxiv, "ARXIV_URL"): server.base_url, (doi, "SEMANTIC_SCHOLAR_API_URL"): server.base_url}
+    saved = {key: getattr(*key) for key in overrides}
+    for (module, name), value in overrides.items():
+        setattr(module, name, value)
+    try:
+        results = {str(scale): await run_size(server, scale, fixtures) for scale in sizes}
+    finally:
+        for (module, name), value in saved.items():
+            setattr(module, name, value)
+        await server.stop()
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "sizes": results,
+    }
+
+
+def compare(current: dict, baseline: dict) -> dict:
+    """
+    Ratio of current to baseline wall time and peak memory, per size and stage.
+    """
+    ratios = {}
+    for size, stages in current["sizes"].items():
+        for stage, stats in stages.items():
+            before = baseline.get("sizes", {}).get(size, {}).get(stage)
+            if stage == "corpus" or not before:
+                continue
+            ratios[f"{size}/{stage}"] = {
+                key: round(stats[key] / before[key], 2) if before[key] else None
+                for key in ("wall_s", "peak_rss_added_mb", "max_lag_ms")
+            }
+    return ratios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1,4,16", help="Comma-separated corpus scale factors.")
+    parser.add_argument("--fixtures", default=None, help="Replay responses from this fixture directory, saved with the same --sizes, instead of generating them.")
+    parser.add_argument("--save-fixtures", default=None, help="Write the generated responses for the first size to this directory and exit.")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="Earlier results file to compare against.")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    if args.save_fixtures:
+        # Bodies keep a placeholder for the stand-in's address, filled in by load_fixtures
+        save_fixtures(make_fixtures("{base_url}", sizes[0]), args.save_fixtures)
+    else:
+        results = asyncio.run(run(sizes, args.fixtures))
+        if args.baseline:
+            with open(args.baseline) as f:
+                results["compared_to_baseline"] = compare(results, json.load(f))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+        print(json.dumps(results, indent=4))
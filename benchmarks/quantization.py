@@ -0,0 +1,83 @@
+"""
+Memory and recall benchmark for embedding storage dtypes.
+
+Converts a corpus of embeddings to float16 and int8 and compares, against
+float32, the bytes in memory and on disk and recall@k of exact cosine search
+for queries near corpus vectors. Uses a synthetic clustered corpus unless a
+wyrm file is given.
+
+    python -m benchmarks.quantization --chunks 20000
+    python -m benchmarks.quantization --wyrm wyrm.npz
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from bookwyrm.models import Bookwyrm, ChunkTable
+from bookwyrm.quantize import EMBEDDING_DTYPES
+
+
+def make_corpus(num_chunks: int, dim: int = 768, clusters: int = 200, seed: int = 0) -> Bookwyrm:
+    """
+    Build a Bookwyrm of unit vectors scattered around random cluster centres.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    embeddings = centres[rng.integers(clusters, size=num_chunks)] + 0.5 * rng.standard_normal((num_chunks, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    chunks = ChunkTable.from_texts([f"chunk {i}" for i in range(num_chunks)], global_index=np.arange(num_chunks))
+    return Bookwyrm.construct(documents=[], chunks=chunks, embeddings=embeddings, embedding_dtype="float32", embedding_scales=None)
+
+
+def make_queries(embeddings: np.ndarray, num_queries: int, noise: float = 0.3, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    queries = embeddings[rng.integers(len(embeddings), size=num_queries)]
+    queries = queries + noise * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def top_k(embeddings: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1)
+    scores = queries @ embeddings.T / np.where(norms > 0, norms, 1)
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def file_size(wyrm: Bookwyrm) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "wyrm.npz")
+        wyrm.save(path)
+        return os.path.getsize(path)
+
+
+def run(wyrm: Bookwyrm, num_queries: int, k: int) -> dict:
+    reference = wyrm.float_embeddings()
+    queries = make_queries(reference, num_queries)
+    truth = top_k(reference, queries, k)
+    results = {}
+    for dtype in EMBEDDING_DTYPES:
+        converted = wyrm.astype(dtype)
+        found = top_k(converted.float_embeddings(), queries, k)
+        recall = np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)])
+        scales = converted.embedding_scales.nbytes if converted.embedding_scales is not None else 0
+        results[dtype] = {
+            "memory_bytes": converted.embeddings.nbytes + scales,
+            "file_bytes": file_size(converted),
+            "max_abs_error": float(np.abs(converted.float_embeddings() - reference).max()),
+            f"recall@{k}": round(float(recall), 4),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--wyrm", default=None, help="Binary wyrm file to use instead of a synthetic corpus.")
+    parser.add_argument("--chunks", type=int, default=20000, help="Chunks in the synthetic corpus.")
+    parser.add_argument("--dim", type=int, default=768, help="Dimension of the synthetic embeddings.")
+    parser.add_argument("--queries", type=int, default=500, help="Number of queries.")
+    parser.add_argument("-k", type=int, default=10, help="Neighbours per query.")
+    args = parser.parse_args()
+    wyrm = Bookwyrm.load(args.wyrm) if args.wyrm else make_corpus(args.chunks, args.dim)
+    print(json.dumps(run(wyrm, args.queries, args.k), indent=4))
@@ -1,2 +1,3 @@
 from .bookwyrm import process_documents
+from .metrics import Metrics
 from .utils import TEST_TASKS
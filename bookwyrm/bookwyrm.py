@@ -1,46 +1,325 @@
+import asyncio
+import contextlib
 import logging
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 
-from .scrape.main import scrape
-from .process import chunk, encode
-from .models import DocumentRecord, Bookwyrm
+from .scrape.main import scrape_iter
+from .scrape.document import count_tokens
+from .process import chunk_sections, encode
+from .models import ChunkTable, Document, DocumentRecord, TextChunk, Bookwyrm
+from .cache import EmbeddingCache
+from .embed import Embedder, EMBEDDERS
+from .dispatch import EmbeddingDispatcher, EmbeddingError
+from .dedup import Deduplicator
+from .metrics import Metrics, collecting, count, span
+from .quantize import EMBEDDING_DTYPES
 from .utils import TEST_TASKS
 
-async def process_documents(urls: list) -> Bookwyrm:
+class WyrmBuilder:
+    """
+    Assembles a Bookwyrm incrementally as documents are chunked and chunk batches are embedded.
+
+    Batches may arrive out of order; chunks are put back in global index order when the Bookwyrm is built.
+    Duplicate chunks are added without embeddings and share their canonical chunk's embedding row.
+    """
+    def __init__(self):
+        self.documents: List[DocumentRecord] = []
+        self.batches: List[Tuple[ChunkTable, np.ndarray]] = []
+        self.duplicates: List[Tuple[ChunkTable, np.ndarray]] = []
+
+    def add_document(self, record: DocumentRecord) -> None:
+        self.documents.append(record)
+
+    def add_batch(self, chunks: Union[ChunkTable, List[TextChunk]], embeddings: np.ndarray) -> None:
+        self.batches.append((ChunkTable.coerce(chunks), embeddings))
+
+    def add_duplicates(self, chunks: Union[ChunkTable, List[TextChunk]], canonical: np.ndarray) -> None:
+        """
+        Add chunks that use the embedding of the chunk with global index `canonical[i]`, added with `add_batch`.
+        """
+        self.duplicates.append((ChunkTable.coerce(chunks), np.asarray(canonical, dtype=np.int64)))
+
+    def build(self, embedding_model: Optional[str] = None) -> Bookwyrm:
+        embedded = ChunkTable.concat([batch_chunks for batch_chunks, _ in self.batches])
+        embedded_order = np.argsort(embedded.columns["global_index"], kind="stable")
+        if self.batches:
+            embeddings = np.concatenate([e for _, e in self.batches])[embedded_order]
+        else:
+            embeddings = np.array([])
+        if not self.duplicates:
+            return Bookwyrm(documents=self.documents, chunks=embedded.take(embedded_order), embeddings=embeddings, embedding_model=embedding_model)
+
+        # Embedding rows follow the embedded chunks' global index order
+        embedded_globals = embedded.columns["global_index"][embedded_order]
+        own_rows = np.empty(len(embedded), dtype=np.int64)
+        own_rows[embedded_order] = np.arange(len(embedded))
+        canonical = np.concatenate([c for _, c in self.duplicates])
+        chunks = ChunkTable.concat([embedded] + [duplicates for duplicates, _ in self.duplicates])
+        rows = np.concatenate([own_rows, np.searchsorted(embedded_globals, canonical)])
+        order = np.argsort(chunks.columns["global_index"], kind="stable")
+        return Bookwyrm(
+            documents=self.documents,
+            chunks=chunks.take(order),
+            embeddings=embeddings,
+            embedding_model=embedding_model,
+            embedding_rows=rows[order],
+        )
+
+# Scraper metadata that only describes the current run and is not stored
+TRANSIENT_METADATA = ("unchanged_files", "not_modified")
+
+def carry_over(record: DocumentRecord, metadata: Dict) -> List[Tuple[str, List[int]]]:
+    """
+    Find the sections of a previously processed document that the scraper reported as unchanged.
+
+    Args:
+        record (DocumentRecord): The document's record in the previous bookwyrm.
+        metadata (Dict): Metadata returned by the scraper for the current run.
+
+    Returns:
+        List[Tuple[str, List[int]]]: (section path, chunk positions in the previous bookwyrm) pairs.
+    """
+    sections = record.metadata.get("sections", [])
+    if not metadata.get("not_modified"):
+        unchanged = set(metadata.get("unchanged_files", []))
+        sections = [section for section in sections if section["path"] in unchanged]
+    return [(section["path"], list(range(section["start"], section["end"]))) for section in sections]
+
+async def process_documents(
+    urls: list,
+    batch_size: int = 200,
+    max_pending_documents: int = 4,
+    max_pending_batches: int = 4,
+    encode_workers: int = 4,
+    builder: Optional[WyrmBuilder] = None,
+    cache: Optional[EmbeddingCache] = None,
+    previous: Optional[Bookwyrm] = None,
+    embedder: Union[str, Embedder, None] = None,
+    max_concurrency: int = 8,
+    checkpoint_dir: Optional[str] = None,
+    embedding_dtype: str = "float32",
+    build_index: bool = False,
+    metrics: Optional[Metrics] = None,
+    dedup: Union[bool, Deduplicator] = False,
+) -> Bookwyrm:
     """
     Process the documents by chunking and encoding them.
 
+    Scraping, chunking and encoding run as concurrent stages connected by bounded
+    queues: each document is chunked as soon as it is scraped and its chunk
+    batches are sent to the embedding API straight away. Documents are indexed
+    in the order they finish scraping.
+
+    When a previous bookwyrm built from the same sources is given, scrapers skip
+    content that has not changed since (by GitHub blob SHA, local mtime and size,
+    or web ETag/Last-Modified). The chunks and embeddings of unchanged files are
+    copied from the previous bookwyrm and only new or changed files are embedded.
+
     Args: 
         urls (list): List of URLs to process.
+        batch_size (int): Number of chunks per embedding request.
+        max_pending_documents (int): Scraped documents that may wait for chunking.
+        max_pending_batches (int): Chunk batches that may wait for encoding.
+        encode_workers (int): Number of batches encoded concurrently.
+        builder (WyrmBuilder): Receives documents and embedded batches as they are ready. Defaults to an in-memory WyrmBuilder.
+            Pass a `shards.ShardWriter` to write a sharded wyrm to disk as the run goes; it applies its own dtype and index settings.
+        cache (EmbeddingCache): Optional cache; only chunks missing from it are sent to the embedding API.
+        previous (Bookwyrm): Optional result of an earlier run to update incrementally.
+        embedder (Embedder | str): Embedding backend, or "replicate", "local" or "hash". Defaults to Replicate.
+        max_concurrency (int): Embedding requests in flight at once, across all encode workers.
+        checkpoint_dir (str): Optional directory where embeddings are saved as batches finish, so a failed run can be resumed.
+        embedding_dtype (str): Storage dtype of the result's embeddings: "float32", "float16" or "int8".
+        build_index (bool): Build an approximate nearest-neighbour index for `Bookwyrm.search`, saved with the wyrm.
+        metrics (Metrics): Optional collector for per-stage timings and counters; read them with `metrics.report()` afterwards.
+        dedup (bool | Deduplicator): Skip embedding chunks that exactly or nearly repeat an earlier chunk; they
+            share its embedding row instead. Pass a Deduplicator to tune it or read its stats afterwards.
 
     Returns:
-        dict: Dictionary with keys 'documents', 'chunks', and 'embeddings'.
+        Bookwyrm: The bookwyrm built by the builder, or a `shards.ShardedWyrm` for a ShardWriter.
+
+    Raises:
+        EmbeddingError: If some chunks could not be embedded after retries.
     """
-    documents = await scrape(urls)
-    chunks = chunk(documents)
-    data = await encode(chunks) 
-    logging.info("Finished processing documents")
-    logging.info(f"Embeddings shape: {data.shape}")
-    logging.info(f"Documents: {len(documents)}")
-    logging.info(f"Chunks: {len(chunks)}")
-    
-    bookwyrm = Bookwyrm(
-        documents=[DocumentRecord(index=i, uri=document.source, metadata=document.metadata) for i, document in enumerate(documents)],
-        chunks=chunks,
-        embeddings=data
-    )
+    if builder is None:
+        builder = WyrmBuilder()
+    deduplicator = dedup if isinstance(dedup, Deduplicator) else None
+    if dedup is True:
+        # Shards can't share embedding rows, so a ShardWriter only deduplicates within each shard
+        deduplicator = Deduplicator(scope=getattr(builder, "shard_size", None))
+    dispatcher = EmbeddingDispatcher(embedder, batch_size=batch_size, max_concurrency=max_concurrency, checkpoint_dir=checkpoint_dir)
+    documents: asyncio.Queue[Optional[Document]] = asyncio.Queue(max_pending_documents)
+    batches: asyncio.Queue[Optional[ChunkTable]] = asyncio.Queue(max_pending_batches)
+
+    # Only documents with recorded sections can have their chunks carried over
+    previous_records = {}
+    if previous is not None:
+        if previous.embedding_model not in (None, dispatcher.embedder.model_id):
+            logging.warning(f"Previous bookwyrm was embedded with {previous.embedding_model}; re-embedding everything")
+        else:
+            previous_records = {record.uri: record for record in previous.documents if "sections" in record.metadata}
+
+    async def scrape_stage():
+        # Closed here if another stage fails, so the scrapers' HTTP client is shut down in this task
+        async with contextlib.aclosing(scrape_iter(urls, {uri: record.metadata for uri, record in previous_records.items()})) as scraped:
+            async for document in scraped:
+                await documents.put(document)
+        await documents.put(None)
+
+    async def chunk_stage():
+        pending: List[ChunkTable] = []
+        num_chunks = 0
+        index = 0
+        finished = False
+        while not finished:
+            # Tokenize every document that is ready in one batch, off the event loop
+            group = [await documents.get()]
+            while not documents.empty():
+                group.append(documents.get_nowait())
+            if None in group:
+                finished = True
+                group = group[:group.index(None)]
+            tokens = await count_tokens(group) if group else []
+            for document, document_tokens in zip(group, tokens):
+                index, num_chunks = chunk_one(document, document_tokens, index, num_chunks, pending)
+                if sum(len(table) for table in pending) >= batch_size:
+                    ready = ChunkTable.concat(pending)
+                    full = len(ready) - len(ready) % batch_size
+                    for start in range(0, full, batch_size):
+                        await batches.put(ready[start:start + batch_size])
+                    pending = [ready[full:]]
+        if sum(len(table) for table in pending):
+            await batches.put(ChunkTable.concat(pending))
+        for _ in range(encode_workers):
+            await batches.put(None)
+        logging.info(f"Documents: {index}")
+
+    def chunk_one(document, tokens, index, num_chunks, pending):
+        """
+        Record one document, carry over its unchanged chunks and append its new chunks to `pending`.
+        Returns the next document index and chunk count.
+        """
+        sections = []
+        carried_rows: List[int] = []
+        if previous is not None and document.source in previous_records:
+            for path, rows in carry_over(previous_records[document.source], document.metadata):
+                start = num_chunks + len(carried_rows)
+                carried_rows.extend(rows)
+                sections.append({"path": path, "start": start, "end": num_chunks + len(carried_rows)})
+        num_carried = len(carried_rows)
+        if carried_rows:
+            logging.info(f"Carried over {num_carried} unchanged chunks of {document.source}")
+            count("carried_chunks", num_carried)
+            # Positions in the document changed, so only the text is kept
+            ordinals = np.arange(num_carried, dtype=np.int64)
+            carried = previous.chunks.take(carried_rows).replace(
+                document_index=index,
+                local_index=ordinals,
+                global_index=num_chunks + ordinals,
+                char_start=0, char_end=0, token_start=0, token_end=0,
+            )
+            builder.add_batch(carried, previous.float_embeddings(carried_rows))
+        num_chunks += num_carried
+
+        for path, chunks in chunk_sections(document, index, num_chunks, num_carried, tokens=tokens):
+            if len(chunks):
+                global_index = chunks.columns["global_index"]
+                sections.append({"path": path, "start": int(global_index[0]), "end": int(global_index[-1]) + 1})
+            num_chunks += len(chunks)
+            if deduplicator is not None:
+                canonical = deduplicator.find(chunks)
+                duplicate = canonical != chunks.columns["global_index"]
+                if duplicate.any():
+                    builder.add_duplicates(chunks.take(np.flatnonzero(duplicate)), canonical[duplicate])
+                    chunks = chunks.take(np.flatnonzero(~duplicate))
+            pending.append(chunks)
+
+        metadata = {k: v for k, v in document.metadata.items() if k not in TRANSIENT_METADATA}
+        metadata["sections"] = sections
+        builder.add_document(DocumentRecord(index=index, uri=document.source, metadata=metadata))
+        count("documents")
+        return index + 1, num_chunks
 
+    async def encode_stage():
+        while (batch := await batches.get()) is not None:
+            builder.add_batch(batch, await encode(batch, cache, dispatcher=dispatcher))
+
+    # Stage tasks inherit the active collector when they are created
+    with collecting(metrics):
+        try:
+            async with asyncio.TaskGroup() as group:
+                group.create_task(scrape_stage())
+                group.create_task(chunk_stage())
+                for _ in range(encode_workers):
+                    group.create_task(encode_stage())
+        except BaseExceptionGroup as errors:
+            # Raise a stage's own error, rather than the TaskGroup's group, so callers can catch EmbeddingError
+            raise (errors.subgroup(EmbeddingError) or errors).exceptions[0] from None
+
+        with span("build"):
+            bookwyrm = builder.build(dispatcher.embedder.model_id)
+            # Sharded builders convert and index each shard as they write it
+            if isinstance(bookwyrm, Bookwyrm):
+                if embedding_dtype != bookwyrm.embedding_dtype:
+                    bookwyrm = bookwyrm.astype(embedding_dtype)
+                if build_index and len(bookwyrm.chunks):
+                    bookwyrm.build_index()
+    if isinstance(bookwyrm, Bookwyrm):
+        logging.info(f"Embeddings shape: {bookwyrm.embeddings.shape}")
+        logging.info(f"Chunks: {len(bookwyrm.chunks)}")
     logging.info("Finished processing documents")
+    if cache is not None:
+        logging.info(f"Embedding cache: {cache.stats()}")
+    if deduplicator is not None:
+        logging.info(f"Duplicate chunks: {deduplicator.stats(batch_size)}")
 
     return bookwyrm
 
-async def main():
+async def main(embedder=None, checkpoint_dir=None, embedding_dtype="float32", build_index=False, metrics=None, dedup=False):
     urls = TEST_TASKS
-    output = await process_documents(urls)
+    output = await process_documents(urls, embedder=embedder, checkpoint_dir=checkpoint_dir, embedding_dtype=embedding_dtype, build_index=build_index, metrics=metrics, dedup=dedup)
     return output
 
+def write_output(bookwyrm: Bookwyrm, path: str, output_format: str = "json") -> None:
+    """
+    Write a Bookwyrm to disk in the requested format.
+
+    Args:
+        bookwyrm (Bookwyrm): The Bookwyrm to write.
+        path (str): Destination file path.
+        output_format (str): "json" for the JSON interchange format, "ndjson" for streamed newline-delimited
+            JSON, or "binary" for the compact wyrm file.
+    """
+    if output_format == "binary":
+        bookwyrm.save(path)
+    elif output_format == "ndjson":
+        bookwyrm.to_ndjson(path)
+    elif output_format == "json":
+        with open(path, "w") as f:
+            f.write(bookwyrm.to_json())
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
 if __name__ == "__main__":
-    import asyncio
-    out = asyncio.run(main())
-    with open("wyrm.json", "w") as f:      
-        f.write(out.to_json())
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process the test URLs into a bookwyrm.")
+    parser.add_argument("--format", choices=["json", "ndjson", "binary"], default="json", help="Output format.")
+    parser.add_argument("--output", default=None, help="Output path. Defaults to wyrm.json, wyrm.ndjson or wyrm.npz.")
+    parser.add_argument("--embedder", choices=list(EMBEDDERS), default="replicate", help="Embedding backend.")
+    parser.add_argument("--checkpoint-dir", default=None, help="Save embedded batches here so an interrupted run can resume.")
+    parser.add_argument("--dtype", choices=list(EMBEDDING_DTYPES), default="float32", help="Embedding storage dtype.")
+    parser.add_argument("--index", action="store_true", help="Build a search index, saved next to a binary wyrm.")
+    parser.add_argument("--dedup", action="store_true", help="Don't embed exact or near-duplicate chunks; they share the embedding of the first copy.")
+    parser.add_argument("--metrics", default=None, help="Write per-stage timings and counters here: Prometheus text for a .prom path, else JSON.")
+    args = parser.parse_args()
+
+    run_metrics = Metrics() if args.metrics else None
+    out = asyncio.run(main(args.embedder, args.checkpoint_dir, args.dtype, args.index, run_metrics, args.dedup))
+    with collecting(run_metrics):
+        write_output(out, args.output or {"binary": "wyrm.npz", "ndjson": "wyrm.ndjson"}.get(args.format, "wyrm.json"), args.format)
+    if run_metrics is not None:
+        report = run_metrics.report()
+        with open(args.metrics, "w") as f:
+            f.write(report.to_prometheus() if args.metrics.endswith(".prom") else report.to_json())
@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+from .models import Bookwyrm
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bookwyrm")
+DEFAULT_MAX_BYTES = 1 << 30
+
+# SQLite limits the number of bound parameters per statement
+_QUERY_BATCH = 500
+
+
+def cache_key(model: str, text: str) -> str:
+    """
+    Content-addressed cache key for a text embedded with a given model.
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by model id and a hash of the chunk text.
+
+    Vectors are stored as float32 blobs in an SQLite database. When the stored
+    vectors exceed `max_bytes`, the least recently used entries are evicted.
+
+    Attributes:
+        path (str): Path to the SQLite database.
+        max_bytes (int): Size bound for stored vectors.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups not found in the cache.
+    """
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        directory = directory or os.getenv("BOOKWYRM_CACHE_DIR", DEFAULT_CACHE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "embeddings.sqlite3")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up the embeddings of several texts.
+
+        Args:
+            model (str): Id of the embedding model.
+            texts (Sequence[str]): Texts to look up.
+
+        Returns:
+            List[Optional[np.ndarray]]: One float32 vector per text, or None for a miss.
+        """
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        for i in range(0, len(keys), _QUERY_BATCH):
+            batch = keys[i:i + _QUERY_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+
+        results = [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+        hits = sum(r is not None for r in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model: str, texts: Sequence[str], vectors) -> None:
+        """
+        Store the embeddings of several texts and evict old entries if the cache is over its size bound.
+
+        Args:
+            model (str): Id of the embedding model.
+            texts (Sequence[str]): Texts that were embedded.
+            vectors: Array-like of shape (len(texts), dim).
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        now = time.time()
+        # A text repeated in one call is stored once, so it must only be counted once
+        unique = {cache_key(model, text): vector for text, vector in zip(texts, vectors)}
+        rows = [(key, vector.tobytes(), vector.nbytes, now) for key, vector in unique.items()]
+        keys = list(unique)
+        # Entries being replaced no longer count towards the total
+        for i in range(0, len(keys), _QUERY_BATCH):
+            batch = keys[i:i + _QUERY_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            replaced = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})", batch)
+            self.total_bytes -= replaced.fetchone()[0]
+        self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+        self.total_bytes += sum(row[2] for row in rows)
+        self.evict()
+        self.conn.commit()
+
+    def evict(self) -> None:
+        """
+        Delete least recently used entries until the cache is within `max_bytes`.
+        """
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM embeddings ORDER BY last_used LIMIT ?", (_QUERY_BATCH,)).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            freed = []
+            for key, size in rows:
+                freed.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.conn.executemany("DELETE FROM embeddings WHERE key = ?", freed)
+            logging.info(f"Evicted {len(freed)} cached embeddings")
+
+    def warm(self, wyrm: Union[Bookwyrm, str], model: Optional[str] = None) -> None:
+        """
+        Fill the cache from an existing bookwyrm.
+
+        Args:
+            wyrm (Bookwyrm | str): A Bookwyrm, or the path to a binary or JSON wyrm file.
+            model (str): Id of the model the wyrm was embedded with. Defaults to its `embedding_model`.
+        """
+        if isinstance(wyrm, str):
+            if wyrm.endswith(".json"):
+                with open(wyrm) as f:
+                    wyrm = Bookwyrm.from_json(f.read())
+            else:
+                wyrm = Bookwyrm.load(wyrm, mmap=True)
+        model = model or wyrm.embedding_model
+        if model is None:
+            raise ValueError("The bookwyrm doesn't record its embedding model; pass model=")
+        for i in range(0, len(wyrm.chunks), _QUERY_BATCH):
+            texts = wyrm.chunks[i:i + _QUERY_BATCH].texts()
+            self.put_many(model, texts, wyrm.float_embeddings(slice(i, i + _QUERY_BATCH)))
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters and size of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+    def close(self) -> None:
+        self.conn.close()
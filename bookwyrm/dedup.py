@@ -0,0 +1,243 @@
+import hashlib
+import math
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import metrics
+from .models import ChunkTable, TextChunk
+
+# Shingles are overlapping 8-byte windows, which pack exactly into a uint64
+SHINGLE_BYTES = 8
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 8
+# Fraction of equal MinHash values (estimated Jaccard similarity) that makes two chunks near-duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.85
+# Shorter chunks are only matched exactly, as they share many shingles by chance
+MIN_NEAR_DUPLICATE_BYTES = 128
+# Shingles hashed at once, bounding the (shingles, NUM_PERMUTATIONS) temporary matrix
+SHINGLE_BLOCK = 1 << 15
+MINHASH_SEED = 0x5EED
+
+
+def exact_digests(chunks: ChunkTable) -> List[bytes]:
+    """
+    A 16-byte BLAKE2 digest of every chunk's UTF-8 text.
+    """
+    text, offsets = chunks.text, chunks.offsets
+    return [hashlib.blake2b(text[offsets[i]:offsets[i + 1]], digest_size=16).digest() for i in range(len(chunks))]
+
+
+def shingle_hashes(chunks: ChunkTable) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The byte shingles of every chunk, each packed into a uint64.
+
+    Returns:
+        tuple: (shingles of all chunks concatenated, int64 number of shingles per chunk).
+    """
+    text = np.asarray(chunks.text)
+    starts, ends = chunks.offsets[:-1], chunks.offsets[1:]
+    counts = np.maximum(ends - starts - SHINGLE_BYTES + 1, 0)
+    if len(text) < SHINGLE_BYTES or not counts.any():
+        return np.empty(0, dtype=np.uint64), counts
+    # Window starting at every byte of the buffer, then keep those inside a single chunk
+    windows = np.zeros(len(text) - SHINGLE_BYTES + 1, dtype=np.uint64)
+    for j in range(SHINGLE_BYTES):
+        windows |= text[j:len(windows) + j].astype(np.uint64) << np.uint64(8 * j)
+    bounds = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    positions = np.repeat(starts - bounds[:-1], counts) + np.arange(bounds[-1])
+    return windows[positions], counts
+
+
+def minhash_signatures(chunks: ChunkTable, num_permutations: int = NUM_PERMUTATIONS) -> np.ndarray:
+    """
+    MinHash signature of every chunk's set of byte shingles.
+
+    Each permutation is a multiply-shift hash (a * x + b mod 2**64, top 32 bits).
+    Shingles are hashed a block at a time and reduced to per-chunk minimums with
+    `np.minimum.reduceat`.
+
+    Returns:
+        np.ndarray: uint32 array of shape (len(chunks), num_permutations). Chunks
+            without shingles get all-ones signatures.
+    """
+    rng = np.random.default_rng(MINHASH_SEED)
+    a = rng.integers(1, 2**63, size=num_permutations, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_permutations, dtype=np.uint64)
+    shingles, counts = shingle_hashes(chunks)
+    bounds = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    signatures = np.full((len(counts), num_permutations), np.iinfo(np.uint32).max, dtype=np.uint32)
+    i = 0
+    while i < len(counts):
+        # Whole chunks per block, and at least one
+        j = max(i + 1, int(np.searchsorted(bounds, bounds[i] + SHINGLE_BLOCK, side="right")) - 1)
+        rows = np.flatnonzero(counts[i:j])
+        if len(rows):
+            block = shingles[bounds[i]:bounds[j]]
+            hashed = ((block[:, None] * a + b) >> np.uint64(32)).astype(np.uint32)
+            signatures[i + rows] = np.minimum.reduceat(hashed, bounds[i:j][rows] - bounds[i], axis=0)
+        i = j
+    return signatures
+
+
+class Deduplicator:
+    """
+    Finds chunks that repeat, exactly or nearly, a chunk seen earlier in the run.
+
+    Exact duplicates are found by a digest of the text. Near-duplicates are found
+    by MinHash over byte shingles with locality-sensitive hashing: signatures are
+    split into `num_bands` bands, chunks sharing a band are candidates, and a
+    candidate matches if the estimated Jaccard similarity is at least `threshold`.
+    The first chunk seen with some text is the canonical chunk of its duplicates,
+    which are not embedded and share its embedding row instead.
+
+    Signatures of canonical chunks are kept (256 bytes each by default) so later
+    chunks can be compared with them.
+
+    Attributes:
+        scope (int): If set, duplicates only match canonical chunks in the same block
+            of `scope` global indexes, for example the same shard.
+        chunks (int): Chunks checked.
+        exact_duplicates (int): Chunks whose text was seen before.
+        near_duplicates (int): Chunks close to a canonical chunk's text.
+        bytes_skipped (int): Text bytes of duplicates, which are not sent to the embedding model.
+    """
+    def __init__(
+        self,
+        threshold: float = NEAR_DUPLICATE_THRESHOLD,
+        num_permutations: int = NUM_PERMUTATIONS,
+        num_bands: int = NUM_BANDS,
+        near: bool = True,
+        scope: Optional[int] = None,
+    ):
+        if num_permutations % num_bands:
+            raise ValueError("num_permutations must be a multiple of num_bands")
+        self.threshold = threshold
+        self.num_permutations = num_permutations
+        self.num_bands = num_bands
+        self.near = near
+        self.scope = scope
+        # Canonical global index by (scope block, digest)
+        self.digests: Dict[Tuple[int, bytes], int] = {}
+        # Canonical signature id by (scope block, band, band values)
+        self.bands: Dict[Tuple[int, int, bytes], int] = {}
+        self.signatures = np.empty((1024, num_permutations), dtype=np.uint32)
+        self.signature_globals = np.empty(1024, dtype=np.int64)
+        self.num_signatures = 0
+        self.chunks = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.bytes_skipped = 0
+
+    def store_signature(self, signature: np.ndarray, global_index: int) -> int:
+        if self.num_signatures == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+            self.signature_globals = np.concatenate([self.signature_globals, np.empty_like(self.signature_globals)])
+        self.signatures[self.num_signatures] = signature
+        self.signature_globals[self.num_signatures] = global_index
+        self.num_signatures += 1
+        return self.num_signatures - 1
+
+    def find(self, chunks: Union[ChunkTable, List[TextChunk]]) -> np.ndarray:
+        """
+        Find the canonical chunk of every chunk, remembering new canonical chunks for later calls.
+
+        Args:
+            chunks (ChunkTable | List[TextChunk]): Chunks in global index order.
+
+        Returns:
+            np.ndarray: The global index of each chunk's canonical chunk, which
+                is its own global index if it is not a duplicate.
+        """
+        chunks = ChunkTable.coerce(chunks).compact()
+        global_index = np.asarray(chunks.columns["global_index"])
+        canonical = global_index.copy()
+        if not len(chunks):
+            return canonical
+        blocks = global_index // self.scope if self.scope else np.zeros(len(chunks), dtype=np.int64)
+        lengths = np.diff(chunks.offsets)
+        digests = exact_digests(chunks)
+        near = self.near & (lengths >= MIN_NEAR_DUPLICATE_BYTES)
+        signatures = minhash_signatures(chunks, self.num_permutations) if near.any() else None
+        rows_per_band = self.num_permutations // self.num_bands
+
+        for i in range(len(chunks)):
+            block = int(blocks[i])
+            key = (block, digests[i])
+            if key in self.digests:
+                canonical[i] = self.digests[key]
+                self.exact_duplicates += 1
+            elif near[i]:
+                signature = signatures[i]
+                band_keys = [(block, band, signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes()) for band in range(self.num_bands)]
+                match = None
+                for band_key in band_keys:
+                    candidate = self.bands.get(band_key)
+                    if candidate is not None and np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                        match = candidate
+                        break
+                if match is None:
+                    signature_id = self.store_signature(signature, global_index[i])
+                    for band_key in band_keys:
+                        self.bands.setdefault(band_key, signature_id)
+                else:
+                    canonical[i] = self.signature_globals[match]
+                    self.near_duplicates += 1
+                # Later exact copies point straight at the same canonical chunk
+                self.digests[key] = int(canonical[i])
+            else:
+                self.digests[key] = int(global_index[i])
+
+        duplicates = canonical != global_index
+        self.chunks += len(chunks)
+        self.bytes_skipped += int(lengths[duplicates].sum())
+        metrics.count("duplicate_chunks", int(duplicates.sum()))
+        metrics.count("duplicate_bytes_skipped", int(lengths[duplicates].sum()))
+        return canonical
+
+    def stats(self, batch_size: int = 200) -> dict:
+        """
+        Duplicate counts and the embedding work they saved.
+
+        Args:
+            batch_size (int): Texts per embedding request, used to estimate requests saved.
+        """
+        duplicates = self.exact_duplicates + self.near_duplicates
+        return {
+            "chunks": self.chunks,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+            "bytes_skipped": self.bytes_skipped,
+            "requests_saved": math.ceil(self.chunks / batch_size) - math.ceil((self.chunks - duplicates) / batch_size),
+        }
+
+
+def deduplicate(chunks: Union[ChunkTable, List[TextChunk]], deduplicator: Optional[Deduplicator] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the duplicate chunks within one table.
+
+    Embed `chunks.take(unique_rows)` and pass `embedding_rows` to the Bookwyrm to
+    share the canonical embeddings with the duplicates.
+
+    Args:
+        chunks (ChunkTable | List[TextChunk]): Chunks with distinct global indexes.
+        deduplicator (Deduplicator): Deduplicator that has not seen other chunks. Defaults to a new one.
+
+    Returns:
+        tuple: (rows to embed, embedding row of every chunk among those rows).
+    """
+    chunks = ChunkTable.coerce(chunks)
+    if deduplicator is None:
+        deduplicator = Deduplicator()
+    canonical = deduplicator.find(chunks)
+    global_index = np.asarray(chunks.columns["global_index"])
+    unique_rows = np.flatnonzero(canonical == global_index)
+    if len(chunks) and not len(unique_rows):
+        raise ValueError("Some canonical chunks are not in this table; use a new Deduplicator")
+    order = np.argsort(global_index[unique_rows])
+    embedding_rows = order[np.minimum(np.searchsorted(global_index[unique_rows], canonical, sorter=order), len(order) - 1)]
+    if len(chunks) and not np.array_equal(global_index[unique_rows][embedding_rows], canonical):
+        raise ValueError("Some canonical chunks are not in this table; use a new Deduplicator")
+    return unique_rows, embedding_rows
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import random
+import sys
+import time
+from typing import List, Optional, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from . import metrics
+from .cache import EmbeddingCache
+from .embed import Embedder, get_embedder
+from .utils import estimate_token_count
+
+
+class EmbeddingError(Exception):
+    """
+    Raised when embedding batches still fail after all retries.
+    Embeddings of batches that succeeded are kept in the checkpoint directory, if one is set.
+    """
+
+
+class EmbeddingDispatcher:
+    """
+    Sends texts to an Embedder in batches with bounded concurrency and retries.
+
+    Batches hold at most `batch_size` texts and about `max_batch_tokens` tokens,
+    so batches of long chunks are smaller. At most `max_concurrency` batches are
+    in flight at once, across every call sharing the dispatcher. A failed batch is
+    retried with exponential backoff and jitter. If `checkpoint_dir` is set, the
+    embeddings of each finished batch are saved there, keyed by model id and chunk
+    text like the embedding cache, so a rerun after a failure only embeds the texts
+    that are missing however they are batched.
+
+    Attributes:
+        embedder (Embedder): The backend batches are sent to.
+    """
+    def __init__(
+        self,
+        embedder: Union[str, Embedder, None] = None,
+        batch_size: int = 200,
+        max_batch_tokens: int = 32768,
+        max_concurrency: int = 8,
+        retries: int = 4,
+        backoff: float = 1.0,
+        checkpoint_dir: Optional[str] = None,
+    ):
+        self.embedder = get_embedder(embedder)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint_dir = checkpoint_dir
+        # Never evicted, so a rerun finds everything a failed run embedded
+        self.checkpoint = EmbeddingCache(checkpoint_dir, max_bytes=sys.maxsize) if checkpoint_dir else None
+
+    def batches(self, texts: List[str]) -> List[slice]:
+        """
+        Split texts into consecutive batches bounded by count and estimated tokens.
+        """
+        batches = []
+        start = 0
+        tokens = 0
+        for i, text in enumerate(texts):
+            n = estimate_token_count(text)
+            if i > start and (i - start >= self.batch_size or tokens + n > self.max_batch_tokens):
+                batches.append(slice(start, i))
+                start, tokens = i, 0
+            tokens += n
+        if start < len(texts):
+            batches.append(slice(start, len(texts)))
+        return batches
+
+    async def embed_batch(self, texts: List[str]) -> np.ndarray:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()
+                    embeddings = await self.embedder.embed(texts)
+                metrics.observe("embedding.batch", time.perf_counter() - start)
+                metrics.count("embedding_batches")
+                metrics.count("embedded_texts", len(texts))
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    metrics.count("embedding_batch_failures")
+                    raise
+                metrics.count("embedding_retries")
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                logging.warning(f"Embedding batch of {len(texts)} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        if self.checkpoint is not None:
+            self.checkpoint.put_many(self.embedder.model_id, texts, embeddings)
+        return embeddings
+
+    async def run(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed all texts and return their embeddings in order.
+        Texts already in the checkpoint directory are not sent again.
+
+        Raises:
+            EmbeddingError: If any batch fails after retries. The other batches are still completed first.
+        """
+        if self.checkpoint is None:
+            return await self.embed_texts(texts)
+        stored = self.checkpoint.get_many(self.embedder.model_id, texts)
+        missing = [i for i, vector in enumerate(stored) if vector is None]
+        metrics.count("embedding_checkpoint_hits", len(texts) - len(missing))
+        if missing:
+            embedded = await self.embed_texts([texts[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                stored[i] = vector
+        return np.stack(stored) if stored else np.array([])
+
+    async def embed_texts(self, texts: List[str]) -> np.ndarray:
+        batches = self.batches(texts)
+        if not batches:
+            return np.array([])
+        progress = tqdm(total=len(batches), desc="Embedding batches", disable=len(batches) < 2)
+
+        async def tracked(batch):
+            try:
+                return await self.embed_batch(texts[batch])
+            finally:
+                progress.update()
+
+        results = await asyncio.gather(*[tracked(batch) for batch in batches], return_exceptions=True)
+        progress.close()
+        failures = [r for r in results if isinstance(r, BaseException)]
+        if failures:
+            hint = f"; finished batches are checkpointed in {self.checkpoint_dir}" if self.checkpoint_dir else ""
+            raise EmbeddingError(f"{len(failures)} of {len(batches)} embedding batches failed: {failures[0]!r}{hint}") from failures[0]
+        return np.concatenate(results)
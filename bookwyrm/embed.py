@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from typing import List, Union
+
+import numpy as np
+import replicate # type: ignore
+
+EMBEDDING_MODEL = "replicate/all-mpnet-base-v2:b6b7585c9640cd7a9572c6e129c9549d79c9c31f0d3fdce7baac7c67ca38f305"
+LOCAL_MODEL = "sentence-transformers/all-mpnet-base-v2"
+
+
+class Embedder(ABC):
+    """
+    Turns a batch of texts into embedding vectors.
+
+    Attributes:
+        model_id (str): Identifies the model, and keys the embedding cache.
+    """
+    model_id: str
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed one batch of texts.
+
+        Args:
+            texts (List[str]): Texts to embed.
+
+        Returns:
+            np.ndarray: Array of shape (len(texts), dim).
+        """
+
+
+class ReplicateEmbedder(Embedder):
+    """
+    Embeds texts with all-mpnet-base-v2 hosted on Replicate. Needs REPLICATE_API_TOKEN.
+    """
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model_id = model
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        resp = await replicate.async_run(
+            self.model_id,
+            input={"text_batch": json.dumps(texts)},
+        )
+        return np.array([o['embedding'] for o in resp], dtype=np.float32)
+
+
+class LocalEmbedder(Embedder):
+    """
+    Embeds texts in-process on CPU with sentence-transformers.
+
+    Texts are sorted by token length and grouped into batches of at most
+    `max_batch_tokens` padded tokens, so short texts aren't padded to the length
+    of long ones. Batches run on a worker thread to keep the event loop free.
+    Requires the optional `sentence-transformers` package.
+    """
+    def __init__(self, model: str = LOCAL_MODEL, device: str = "cpu", max_batch_tokens: int = 8192):
+        try:
+            from sentence_transformers import SentenceTransformer # type: ignore
+        except ImportError as e:
+            raise ImportError("LocalEmbedder requires sentence-transformers: pip install sentence-transformers") from e
+        self.model_id = model
+        self.model = SentenceTransformer(model, device=device)
+        self.max_batch_tokens = max_batch_tokens
+
+    def length_batches(self, texts: List[str]) -> List[List[int]]:
+        max_length = self.model.max_seq_length
+        lengths = [min(len(ids), max_length) for ids in self.model.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        for i in np.argsort(lengths, kind="stable"):
+            # Sorted ascending, so the current text is the longest in its batch
+            if batch and (len(batch) + 1) * lengths[i] > self.max_batch_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(int(i))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        for batch in self.length_batches(texts):
+            vectors = await asyncio.to_thread(self.model.encode, [texts[i] for i in batch], batch_size=len(batch))
+            embeddings[batch] = vectors
+        return embeddings
+
+
+class HashEmbedder(Embedder):
+    """
+    Deterministic fake embedder for tests and benchmarks.
+
+    Each text maps to a unit vector drawn from a random generator seeded with a
+    hash of the text, so identical texts get identical vectors without any
+    network access or model weights.
+    """
+    def __init__(self, dim: int = 768):
+        self.dim = dim
+        self.model_id = f"hash-{dim}"
+
+    def vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return np.array([self.vector(text) for text in texts], dtype=np.float32).reshape(len(texts), self.dim)
+
+
+EMBEDDERS = {
+    "replicate": ReplicateEmbedder,
+    "local": LocalEmbedder,
+    "hash": HashEmbedder,
+}
+
+
+def get_embedder(embedder: Union[str, Embedder, None] = None) -> Embedder:
+    """
+    Resolve an embedder by name ("replicate", "local" or "hash"), passing instances through.
+    Defaults to the Replicate embedder.
+    """
+    if embedder is None:
+        embedder = "replicate"
+    if isinstance(embedder, Embedder):
+        return embedder
+    if embedder not in EMBEDDERS:
+        raise ValueError(f"Unsupported embedder: {embedder}")
+    return EMBEDDERS[embedder]()
+
+
+def embedder_for_model(model_id: str) -> Embedder:
+    """
+    Create an embedder for the model id recorded on a Bookwyrm.
+    """
+    if model_id == EMBEDDING_MODEL:
+        return ReplicateEmbedder()
+    if model_id.startswith("hash-"):
+        return HashEmbedder(int(model_id[len("hash-"):]))
+    return LocalEmbedder(model_id)
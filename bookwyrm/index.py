@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import os
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from .search import normalize
+
+PathLike = Union[str, os.PathLike]
+
+INDEX_SUFFIX = ".ivf.npz"
+DEFAULT_NPROBE = 8
+# Vectors assigned to centroids per matrix product
+ASSIGN_BLOCK_SIZE = 16384
+# k-means trains on at most this many vectors per list
+TRAINING_POINTS_PER_LIST = 256
+
+
+def index_path(wyrm_path: PathLike) -> str:
+    """
+    Path of the index saved next to a wyrm file: "wyrm.npz" -> "wyrm.ivf.npz".
+    """
+    root, _ = os.path.splitext(os.fspath(wyrm_path))
+    return root + INDEX_SUFFIX
+
+
+def wyrm_fingerprint(wyrm) -> str:
+    """
+    Identify the rows of a Bookwyrm by their chunk text, document indexes and embeddings.
+
+    Chunk order changes between runs (documents are numbered as they finish
+    scraping) and a refresh can change a chunk without changing its length, so
+    an index is only valid for the exact rows and vectors it was built from.
+    """
+    chunks = wyrm.chunks
+    offsets = np.asarray(chunks.offsets, dtype=np.int64)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.int64(len(chunks)).tobytes())
+    digest.update((offsets - offsets[0]).tobytes())
+    digest.update(np.ascontiguousarray(chunks.text[offsets[0]:offsets[-1]]).data)
+    digest.update(np.ascontiguousarray(chunks.columns["document_index"], dtype=np.int64).tobytes())
+    digest.update(str(wyrm.embedding_dtype).encode("utf-8"))
+    digest.update(np.ascontiguousarray(wyrm.embeddings).data)
+    if wyrm.embedding_scales is not None:
+        digest.update(np.ascontiguousarray(wyrm.embedding_scales, dtype=np.float32).tobytes())
+    if wyrm.embedding_rows is not None:
+        digest.update(np.ascontiguousarray(wyrm.embedding_rows, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Index of the most similar centroid for each normalized vector.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        block = vectors[start:start + ASSIGN_BLOCK_SIZE]
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def kmeans(vectors: np.ndarray, num_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on normalized vectors.
+
+    Returns:
+        np.ndarray: Unit-norm float32 centroids of shape (num_lists, dim).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=num_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids[filled] = normalize(sums)
+        # Restart empty lists from random vectors
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index for approximate cosine search over a Bookwyrm's embeddings.
+
+    Embeddings are clustered with spherical k-means and each row is filed under
+    its nearest centroid. A query only scores the rows in its `nprobe` closest
+    lists, which are read from the Bookwyrm itself, so the index stores only the
+    centroids and one list id per row.
+
+    Attributes:
+        centroids (np.ndarray): Unit-norm float32 centroids of shape (num_lists, dim).
+        assignments (np.ndarray): List id of every indexed row.
+        fingerprint (str): `wyrm_fingerprint` of the Bookwyrm a saved index belongs to, if known.
+    """
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, fingerprint: Optional[str] = None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.fingerprint = fingerprint
+        self._lists: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.assignments)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, num_lists: Optional[int] = None, iterations: int = 10, seed: int = 0) -> 'IVFIndex':
+        """
+        Train an index on float embeddings and assign every row to a list.
+
+        Args:
+            embeddings (np.ndarray): Float matrix of shape (n, dim).
+            num_lists (int): Number of lists. Defaults to about 4 * sqrt(n).
+            iterations (int): k-means iterations.
+            seed (int): Seed for sampling and initialization.
+
+        Returns:
+            IVFIndex: The trained index.
+        """
+        vectors = normalize(embeddings)
+        if num_lists is None:
+            num_lists = int(4 * np.sqrt(len(vectors)))
+        num_lists = max(1, min(num_lists, len(vectors)))
+        sample = vectors
+        max_sample = num_lists * TRAINING_POINTS_PER_LIST
+        if len(vectors) > max_sample:
+            sample = vectors[np.sort(np.random.default_rng(seed).choice(len(vectors), max_sample, replace=False))]
+        centroids = kmeans(sample, num_lists, iterations, seed)
+        return cls(centroids, nearest_centroids(vectors, centroids))
+
+    def add(self, embeddings: np.ndarray, start_row: int) -> None:
+        """
+        Index rows appended to the Bookwyrm after the index was built.
+
+        New rows are filed under their nearest existing centroid; the centroids
+        are not retrained, so call `Bookwyrm.build_index` again once many rows
+        have been added or the data has drifted.
+
+        Args:
+            embeddings (np.ndarray): Float embeddings of the new rows, in row order.
+            start_row (int): Row of the first new embedding, which must be `num_rows`.
+        """
+        if start_row != self.num_rows:
+            raise ValueError(f"Rows must be appended in order: the index covers {self.num_rows} rows, not {start_row}")
+        if len(embeddings) == 0:
+            return
+        self.assignments = np.concatenate([self.assignments, nearest_centroids(normalize(embeddings), self.centroids)])
+        self.fingerprint = None
+        self._lists = None
+
+    def lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows grouped by list: (row ids sorted by list, offsets of each list).
+        """
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            offsets = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, offsets)
+        return self._lists
+
+    def search(
+        self,
+        wyrm,
+        queries: np.ndarray,
+        k: int,
+        nprobe: int = DEFAULT_NPROBE,
+        rows: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate cosine top-k.
+
+        Args:
+            wyrm (Bookwyrm): The Bookwyrm the index was built from.
+            queries (np.ndarray): Query vectors of shape (num_queries, dim).
+            k (int): Number of results per query.
+            nprobe (int): Number of lists scored per query.
+            rows (np.ndarray): Optional embedding rows to restrict the search to.
+
+        Returns:
+            tuple: (row indices, cosine scores) of shape (num_queries, k), best
+                first. Missing results have index -1.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        order, offsets = self.lists()
+        allowed = None
+        if rows is not None:
+            allowed = np.zeros(self.num_rows, dtype=bool)
+            allowed[rows] = True
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, lists in enumerate(probes):
+            candidates = np.concatenate([order[offsets[l]:offsets[l + 1]] for l in lists])
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            if len(candidates) == 0:
+                continue
+            # Read rows in file order, which is faster for memory-mapped wyrms
+            candidates = np.sort(candidates)
+            candidate_scores = normalize(wyrm.float_embeddings(candidates)) @ queries[q]
+            n = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, n - 1)[:n]
+            best = best[np.argsort(-candidate_scores[best], kind="stable")]
+            indices[q, :n] = candidates[best]
+            scores[q, :n] = candidate_scores[best]
+        return indices, scores
+
+    def save(self, path: PathLike, fingerprint: str) -> None:
+        """
+        Write the index, recording the `wyrm_fingerprint` of the Bookwyrm it indexes.
+        """
+        self.fingerprint = fingerprint
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments, fingerprint=np.array(fingerprint))
+
+    @classmethod
+    def load(cls, path: PathLike) -> 'IVFIndex':
+        with np.load(path) as archive:
+            fingerprint = str(archive["fingerprint"]) if "fingerprint" in archive else None
+            return cls(archive["centroids"], archive["assignments"], fingerprint)
+
+
+def load_index(path: PathLike, fingerprint: str) -> Optional[IVFIndex]:
+    """
+    Load the index saved for the Bookwyrm with `fingerprint`, or None if it was built for other rows.
+
+    A mismatched index is ignored rather than extended, since its rows may have
+    been reordered as well as added.
+    """
+    index = IVFIndex.load(path)
+    if index.fingerprint != fingerprint:
+        logging.warning(f"Ignoring index {path}: it was built for different rows; call build_index() to rebuild it")
+        return None
+    return index
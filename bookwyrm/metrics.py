@@ -0,0 +1,169 @@
+import functools
+import inspect
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+
+class SpanStats(BaseModel):
+    """
+    Aggregated timings of one kind of span.
+
+    Attributes:
+        count (int): Number of times the span was entered.
+        total_seconds (float): Summed duration. Concurrent spans overlap, so this can exceed the wall time.
+        max_seconds (float): Longest single duration.
+    """
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+class MetricsReport(BaseModel):
+    """
+    Timings and counters collected over one pipeline run.
+
+    Attributes:
+        wall_seconds (float): Time from the start of collection to the report.
+        spans (Dict[str, SpanStats]): Timings by span name, such as "scrape.github_repo", "chunk" or "encode".
+        counters (Dict[str, float]): Totals by counter name, such as "http_requests" or "chunks".
+    """
+    wall_seconds: float
+    spans: Dict[str, SpanStats]
+    counters: Dict[str, float]
+
+    def to_json(self) -> str:
+        return json.dumps(self.dict(), indent=4)
+
+    def to_prometheus(self, prefix: str = "bookwyrm") -> str:
+        """
+        Render the report in the Prometheus text exposition format.
+
+        Spans become a `<prefix>_span_seconds` summary (sum and count) plus a
+        `<prefix>_span_max_seconds` gauge, labelled by span name. Each counter
+        becomes a `<prefix>_<name>_total` counter.
+        """
+        lines = [
+            f"# TYPE {prefix}_wall_seconds gauge",
+            f"{prefix}_wall_seconds {self.wall_seconds}",
+        ]
+        if self.spans:
+            lines.append(f"# TYPE {prefix}_span_seconds summary")
+            for name, stats in sorted(self.spans.items()):
+                lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {stats.total_seconds}')
+                lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {stats.count}')
+            lines.append(f"# TYPE {prefix}_span_max_seconds gauge")
+            for name, stats in sorted(self.spans.items()):
+                lines.append(f'{prefix}_span_max_seconds{{span="{name}"}} {stats.max_seconds}')
+        for name, value in sorted(self.counters.items()):
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Collects timing spans and counters from every stage of a run.
+
+    Activate it with `collecting`; the module-level `span`, `timed`, `observe`
+    and `count` helpers then record into it from any task or worker thread
+    started inside the block, and do nothing when no collector is active.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, SpanStats] = {}
+        self.counters: Dict[str, float] = {}
+        # Counters are also updated from worker threads
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            stats = self.spans.setdefault(name, SpanStats())
+            stats.count += 1
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self) -> MetricsReport:
+        with self.lock:
+            return MetricsReport(
+                wall_seconds=time.perf_counter() - self.started,
+                spans={name: stats.copy() for name, stats in self.spans.items()},
+                counters=dict(self.counters),
+            )
+
+
+_current_metrics: ContextVar[Optional[Metrics]] = ContextVar("bookwyrm_metrics", default=None)
+
+
+@contextmanager
+def collecting(metrics: Optional[Metrics]):
+    """
+    Record spans and counters into `metrics` inside the block. With None, keep the current collector, if any.
+    """
+    if metrics is None:
+        yield _current_metrics.get()
+        return
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+def observe(name: str, seconds: float) -> None:
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.observe(name, seconds)
+
+
+def count(name: str, value: float = 1) -> None:
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time the block as one `name` span. Works around awaits too, measuring wall time including waits.
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """
+    Decorator recording every call of a function or coroutine function as a `name` span.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,8 +1,13 @@
 import json
-from pydantic import BaseModel
-from typing import List, Dict
+import os
+from collections.abc import Sequence
+from pydantic import BaseModel, PrivateAttr, root_validator, validator
+from typing import List, Dict, Optional, Union
 import numpy as np
 
+from . import metrics
+from .quantize import EMBEDDING_DTYPES, convert_embeddings, quantize_int8, restore_embeddings
+
 class Document(BaseModel):
     """
     Represents a document with its text, source, and metadata.
@@ -31,11 +36,208 @@ class TextChunk(BaseModel):
         document_index (int): Index of the document this chunk belongs to. Default is 0.
         local_index (int): Local index of the chunk within the document. Default is 0.
         global_index (int): Global index of the chunk across all documents. Default is 0.
+        char_start (int): Start of the chunk as a character offset in the document. Default is 0.
+        char_end (int): End of the chunk as a character offset in the document. Default is 0.
+        token_start (int): Start of the chunk as a token offset in the document. Default is 0.
+        token_end (int): End of the chunk as a token offset in the document. Default is 0.
     """
     text: str
     document_index: int = 0
     local_index: int = 0
     global_index: int = 0
+    char_start: int = 0
+    char_end: int = 0
+    token_start: int = 0
+    token_end: int = 0
+
+# Integer TextChunk fields, stored as one int64 column each
+CHUNK_COLUMNS = ("document_index", "local_index", "global_index", "char_start", "char_end", "token_start", "token_end")
+
+
+def encode_texts(texts: List[str]):
+    """
+    Pack a list of strings into one UTF-8 byte column and an offsets array.
+
+    Args:
+        texts (List[str]): Strings to pack.
+
+    Returns:
+        tuple: (uint8 byte buffer, int64 offsets of length len(texts) + 1).
+    """
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return buffer, offsets
+
+
+def decode_text(buffer: np.ndarray, offsets: np.ndarray, i: int) -> str:
+    """
+    Decode the i-th string from a byte column packed with `encode_texts`.
+    """
+    return bytes(buffer[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+
+def gather_bytes(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    """
+    Concatenate the byte ranges [starts[i], ends[i]) of a buffer.
+
+    Returns:
+        tuple: (uint8 byte buffer, int64 offsets of length len(starts) + 1).
+    """
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # Position in the source buffer of every output byte
+    positions = np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return np.asarray(buffer)[positions], offsets
+
+
+class ChunkTable(Sequence):
+    """
+    Columnar store of text chunks.
+
+    Chunk text is one UTF-8 byte buffer with an offsets array, and each integer
+    TextChunk field is an int64 NumPy column, so a table of a million chunks is a
+    handful of arrays instead of a million pydantic objects. The columns may be
+    memory-mapped. Indexing returns TextChunk objects built on demand; slicing
+    and `take` return tables.
+
+    Attributes:
+        text (np.ndarray): UTF-8 bytes of all chunk texts.
+        offsets (np.ndarray): Start of every chunk's text in `text`, plus the end of the last one.
+        columns (Dict[str, np.ndarray]): One int64 array per name in CHUNK_COLUMNS.
+    """
+    def __init__(self, text: np.ndarray, offsets: np.ndarray, columns: Optional[Dict[str, np.ndarray]] = None):
+        self.text = text
+        self.offsets = offsets
+        columns = dict(columns or {})
+        for name in CHUNK_COLUMNS:
+            if name not in columns:
+                # Columns missing from older files read as zeros
+                columns[name] = np.zeros(len(offsets) - 1, dtype=np.int64)
+        self.columns = columns
+
+    @classmethod
+    def from_texts(cls, texts: List[str], **columns) -> 'ChunkTable':
+        """
+        Build a table from chunk texts and integer columns given as arrays or scalars.
+        """
+        buffer, offsets = encode_texts(texts)
+        n = len(texts)
+        return cls(buffer, offsets, {name: np.broadcast_to(np.asarray(value, dtype=np.int64), (n,)).copy() for name, value in columns.items()})
+
+    @classmethod
+    def from_chunks(cls, chunks) -> 'ChunkTable':
+        """
+        Build a table from TextChunks or dicts with TextChunk fields.
+        """
+        rows = [c.dict() if isinstance(c, BaseModel) else c for c in chunks]
+        return cls.from_texts(
+            [row["text"] for row in rows],
+            **{name: np.array([row.get(name, 0) for row in rows], dtype=np.int64) for name in CHUNK_COLUMNS},
+        )
+
+    @classmethod
+    def coerce(cls, chunks) -> 'ChunkTable':
+        """
+        Return `chunks` if it is a table, otherwise build one from it.
+        """
+        return chunks if isinstance(chunks, ChunkTable) else cls.from_chunks(chunks)
+
+    @classmethod
+    def concat(cls, tables: List['ChunkTable']) -> 'ChunkTable':
+        """
+        Concatenate tables into one compact table.
+        """
+        tables = [table.compact() for table in tables]
+        if not tables:
+            return cls.from_texts([])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for table in tables:
+            offsets.append(table.offsets[1:] + total)
+            total += len(table.text)
+        return cls(
+            np.concatenate([table.text for table in tables]),
+            np.concatenate(offsets),
+            {name: np.concatenate([table.columns[name] for table in tables]) for name in CHUNK_COLUMNS},
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            # A contiguous slice is a view on the same buffers
+            return ChunkTable(self.text, self.offsets[start:stop + 1], {name: column[start:stop] for name, column in self.columns.items()})
+        if isinstance(i, (list, np.ndarray)):
+            return self.take(i)
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        return TextChunk(text=self.text_at(i), **{name: int(column[i]) for name, column in self.columns.items()})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text_at(self, i: int) -> str:
+        return decode_text(self.text, self.offsets, i)
+
+    def texts(self) -> List[str]:
+        """
+        Decode the text of every chunk.
+        """
+        data = bytes(self.text[self.offsets[0]:self.offsets[-1]]) if len(self) else b""
+        bounds = (self.offsets - self.offsets[0]).tolist()
+        return [data[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(len(self))]
+
+    def take(self, rows) -> 'ChunkTable':
+        """
+        Copy the given rows into a new compact table.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        text, offsets = gather_bytes(self.text, self.offsets[rows], self.offsets[rows + 1])
+        return ChunkTable(text, offsets, {name: np.asarray(column)[rows] for name, column in self.columns.items()})
+
+    def compact(self) -> 'ChunkTable':
+        """
+        Return a table whose text buffer holds exactly its own chunks, copying if needed.
+        """
+        if len(self) and (self.offsets[0] != 0 or self.offsets[-1] != len(self.text)):
+            return self.take(np.arange(len(self)))
+        return self
+
+    def replace(self, **columns) -> 'ChunkTable':
+        """
+        Return a table sharing this one's text with some integer columns replaced.
+        """
+        updated = dict(self.columns)
+        for name, value in columns.items():
+            updated[name] = np.broadcast_to(np.asarray(value, dtype=np.int64), (len(self),)).copy()
+        return ChunkTable(self.text, self.offsets, updated)
+
+    def to_dicts(self) -> List[Dict]:
+        """
+        Every chunk as a dict of TextChunk fields, without building TextChunk objects.
+        """
+        columns = {name: np.asarray(column).tolist() for name, column in self.columns.items()}
+        return [
+            {"text": text, **{name: values[i] for name, values in columns.items()}}
+            for i, text in enumerate(self.texts())
+        ]
+
+    @property
+    def nbytes(self) -> int:
+        return self.text.nbytes + self.offsets.nbytes + sum(column.nbytes for column in self.columns.values())
 
 class DocumentRecord(BaseModel):
     """
@@ -50,22 +252,76 @@ class DocumentRecord(BaseModel):
     uri: str
     metadata: Dict
     
+class SearchResult(BaseModel):
+    """
+    Represents one chunk found by `Bookwyrm.search`.
+
+    Attributes:
+        chunk (TextChunk): The matching chunk.
+        document (DocumentRecord): Record of the document the chunk belongs to.
+        score (float): Cosine similarity between the query and the chunk.
+    """
+    chunk: TextChunk
+    document: Optional[DocumentRecord]
+    score: float
+
 class Bookwyrm(BaseModel):
     """
     Represents the Bookwyrm model containing documents, chunks, and embeddings.
 
     Attributes:
         documents (List[DocumentRecord]): List of document records.
-        chunks (List[TextChunk]): List of text chunks.
-        embeddings (np.ndarray): Array of embeddings.
+        chunks (ChunkTable): The text chunks. Lists of TextChunks or dicts are converted.
+        embeddings (np.ndarray): Array of embeddings, stored as `embedding_dtype`.
+        embedding_dtype (str): "float32" (default), "float16" or "int8".
+        embedding_scales (np.ndarray): Per-dimension scales of int8 embeddings, None otherwise.
+            Float embeddings given with `embedding_dtype="int8"` are quantized, with these
+            scales if set and with new ones otherwise.
+        embedding_model (str): Id of the model that produced the embeddings, if known.
+        embedding_rows (np.ndarray): Embedding row of every chunk when duplicate chunks share
+            rows (see `dedup`), None when row i belongs to chunk i.
     """
     documents: List[DocumentRecord]
-    chunks: List[TextChunk]
+    chunks: ChunkTable
     embeddings: np.ndarray
+    embedding_dtype: str = "float32"
+    embedding_scales: Optional[np.ndarray] = None
+    embedding_model: Optional[str] = None
+    embedding_rows: Optional[np.ndarray] = None
+    # Approximate nearest-neighbour index, built or loaded on first use
+    _index = PrivateAttr(default=None)
+    _index_path = PrivateAttr(default=None)
 
     class Config:
         arbitrary_types_allowed = True
 
+    @validator("chunks", pre=True)
+    def to_chunk_table(cls, chunks):
+        return ChunkTable.coerce(chunks)
+
+    @root_validator(skip_on_failure=True)
+    def check_embedding_dtype(cls, values):
+        dtype = values["embedding_dtype"]
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+        embeddings = np.asarray(values["embeddings"])
+        if dtype == "int8":
+            if np.issubdtype(embeddings.dtype, np.floating) and embeddings.size:
+                # Casting float vectors to int8 would truncate them to zero, so quantize them instead
+                embeddings, values["embedding_scales"] = quantize_int8(embeddings, values["embedding_scales"])
+            elif values["embedding_scales"] is None:
+                raise ValueError("int8 embeddings need embedding_scales")
+            values["embedding_scales"] = np.asarray(values["embedding_scales"], dtype=np.float32)
+        # Embeddings parsed from JSON or returned by an API are float64
+        values["embeddings"] = np.asarray(embeddings, dtype=dtype)
+        if values["embedding_rows"] is not None:
+            rows = np.asarray(values["embedding_rows"], dtype=np.int64)
+            if len(rows) != len(values["chunks"]) or (len(rows) and rows.max() >= len(values["embeddings"])):
+                raise ValueError("embedding_rows must give an embedding row for every chunk")
+            values["embedding_rows"] = rows
+        return values
+
+    @metrics.timed("serialize.json")
     def to_json(self) -> str:
         """
         Convert the Bookwyrm instance to a JSON string.
@@ -88,9 +344,280 @@ class Bookwyrm(BaseModel):
         """
         data = json.loads(json_str)
         documents = [DocumentRecord(**doc) for doc in data['documents']]
-        chunks = [TextChunk(**chunk) for chunk in data['chunks']]
+        chunks = ChunkTable.from_chunks(data['chunks'])
         embeddings = np.array(data['embeddings'])
-        return cls(documents=documents, chunks=chunks, embeddings=embeddings)
+        scales = data.get('embedding_scales')
+        rows = data.get('embedding_rows')
+        return cls(
+            documents=documents,
+            chunks=chunks,
+            embeddings=embeddings,
+            embedding_dtype=data.get('embedding_dtype', 'float32'),
+            embedding_scales=None if scales is None else np.array(scales),
+            embedding_model=data.get('embedding_model'),
+            embedding_rows=None if rows is None else np.array(rows),
+        )
+
+    def astype(self, dtype: str) -> 'Bookwyrm':
+        """
+        Return a copy of the Bookwyrm with its embeddings converted to another dtype.
+
+        Converting to int8 quantizes each dimension with its own scale; converting
+        back restores approximate float values.
+
+        Args:
+            dtype (str): "float32", "float16" or "int8".
+
+        Returns:
+            Bookwyrm: A Bookwyrm sharing documents and chunks with this one.
+        """
+        # Convert the stored rows, so rows shared by duplicate chunks stay shared
+        stored = restore_embeddings(self.embeddings, self.embedding_dtype, self.embedding_scales)
+        embeddings, scales = convert_embeddings(stored, dtype)
+        converted = Bookwyrm.construct(
+            documents=self.documents,
+            chunks=self.chunks,
+            embeddings=embeddings,
+            embedding_dtype=dtype,
+            embedding_scales=scales,
+            embedding_model=self.embedding_model,
+            embedding_rows=self.embedding_rows,
+        )
+        converted._index = self._index
+        converted._index_path = self._index_path
+        return converted
+
+    def float_embeddings(self, rows=None) -> np.ndarray:
+        """
+        Get the embeddings of chunks as float32, dequantizing int8 ones.
+
+        Args:
+            rows: Optional index, slice or array of chunk positions. Defaults to all chunks.
+
+        Returns:
+            np.ndarray: Float32 embeddings of the selected chunks, one row per chunk
+                even where duplicate chunks share a stored row.
+        """
+        if self.embedding_rows is not None:
+            rows = self.embedding_rows if rows is None else self.embedding_rows[rows]
+        embeddings = self.embeddings if rows is None else self.embeddings[rows]
+        return restore_embeddings(embeddings, self.embedding_dtype, self.embedding_scales)
+
+    def document_indices(self) -> np.ndarray:
+        """
+        Get the document index of every chunk as an int64 array.
+        """
+        return np.asarray(self.chunks.columns["document_index"])
+
+    @property
+    def index(self):
+        """
+        The approximate nearest-neighbour index, or None if there isn't one.
+
+        An index saved next to a loaded wyrm file is read on first access, unless
+        it was built for different rows.
+        """
+        from .index import load_index, wyrm_fingerprint
+        if self._index is None and self._index_path is not None:
+            self._index = load_index(self._index_path, wyrm_fingerprint(self))
+            self._index_path = None
+        return self._index
+
+    def build_index(self, num_lists: Optional[int] = None, **kwargs):
+        """
+        Build an IVF index over the embeddings, used by `search` from then on.
+
+        Args:
+            num_lists (int): Number of inverted lists. Defaults to about 4 * sqrt(number of chunks).
+            **kwargs: Passed to `IVFIndex.build`.
+
+        Returns:
+            IVFIndex: The new index.
+        """
+        from .index import IVFIndex
+        self._index = IVFIndex.build(self.float_embeddings(), num_lists, **kwargs)
+        self._index_path = None
+        return self._index
+
+    def extend(self, documents: List[DocumentRecord], chunks, embeddings: np.ndarray) -> None:
+        """
+        Append documents and embedded chunks in place.
+
+        Embeddings are converted to the Bookwyrm's `embedding_dtype`, reusing its
+        int8 scales. If the Bookwyrm has an index, the new chunks are filed under
+        its existing centroids (see `IVFIndex.add`) instead of retraining it, and
+        its fingerprint is updated so `save` and `load` keep it.
+
+        Args:
+            documents (List[DocumentRecord]): Records of documents the new chunks belong to.
+            chunks (ChunkTable | List[TextChunk]): The new chunks, with their document and global indexes set.
+            embeddings (np.ndarray): Float embeddings of the new chunks, one row per chunk.
+        """
+        from .index import wyrm_fingerprint
+        chunks = ChunkTable.coerce(chunks)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(chunks) != len(embeddings):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(chunks)} chunks")
+        # Read a saved index while it still matches the rows
+        index = self.index
+        if self.embedding_dtype == "int8":
+            stored, _ = quantize_int8(embeddings, self.embedding_scales)
+        else:
+            stored, _ = convert_embeddings(embeddings, self.embedding_dtype)
+        start_row = len(self.chunks)
+        if self.embedding_rows is not None:
+            self.embedding_rows = np.concatenate([self.embedding_rows, len(self.embeddings) + np.arange(len(chunks))])
+        self.embeddings = np.concatenate([self.embeddings, stored]) if len(self.embeddings) else stored
+        self.chunks = ChunkTable.concat([self.chunks, chunks])
+        self.documents = self.documents + list(documents)
+        if index is not None:
+            index.add(self.float_embeddings(slice(start_row, None)), start_row)
+            index.fingerprint = wyrm_fingerprint(self)
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        k: int = 10,
+        document_index: Union[int, List[int], None] = None,
+        block_size: Optional[int] = None,
+        exact: bool = False,
+        nprobe: Optional[int] = None,
+    ) -> Union[List[SearchResult], List[List[SearchResult]]]:
+        """
+        Find the chunks most similar to query vectors by cosine similarity.
+
+        Queries and embeddings are L2-normalized and scored with blocked matrix
+        products, so memory stays bounded for large wyrms and query batches.
+        If the Bookwyrm has an index (see `build_index`), only the rows in the
+        queries' nearest lists are scored unless `exact` is set.
+
+        Args:
+            query_vectors (np.ndarray): One query vector of shape (dim,) or a batch of shape (num_queries, dim).
+            k (int): Number of results per query. Default is 10.
+            document_index (int | List[int]): Only search chunks of these documents.
+            block_size (int): Embedding rows scored at once. Defaults to `search.DEFAULT_BLOCK_SIZE`.
+            exact (bool): Score every row even if an index is available. Default is False.
+            nprobe (int): Index lists scored per query. Defaults to `index.DEFAULT_NPROBE`.
+
+        Returns:
+            List[SearchResult]: Results for a single query, best first, or one such list per query for a batch.
+        """
+        from .search import DEFAULT_BLOCK_SIZE, top_k
+        from .index import DEFAULT_NPROBE
+
+        rows = None
+        if document_index is not None:
+            rows = np.flatnonzero(np.isin(self.document_indices(), np.atleast_1d(document_index)))
+        query_vectors = np.asarray(query_vectors)
+        index = None if exact else self.index
+        if index is not None:
+            indices, scores = index.search(self, query_vectors, k, nprobe=nprobe or DEFAULT_NPROBE, rows=rows)
+        else:
+            indices, scores = top_k(self, query_vectors, k, rows=rows, block_size=block_size or DEFAULT_BLOCK_SIZE)
+        records = {record.index: record for record in self.documents}
+        results = []
+        for row_indices, row_scores in zip(indices, scores):
+            hits = []
+            for i, score in zip(row_indices, row_scores):
+                if i < 0:
+                    break
+                chunk = self.chunks[int(i)]
+                hits.append(SearchResult(chunk=chunk, document=records.get(chunk.document_index), score=float(score)))
+            results.append(hits)
+        return results[0] if query_vectors.ndim == 1 else results
+
+    async def search_text(
+        self,
+        query: Union[str, List[str]],
+        k: int = 10,
+        embedder=None,
+        document_index: Union[int, List[int], None] = None,
+        **kwargs,
+    ) -> Union[List[SearchResult], List[List[SearchResult]]]:
+        """
+        Embed query text with the Bookwyrm's embedding model and search for it.
+
+        Args:
+            query (str | List[str]): One query or a list of queries.
+            k (int): Number of results per query. Default is 10.
+            embedder (Embedder | str): Embedder to use. Defaults to one for `embedding_model`.
+            document_index (int | List[int]): Only search chunks of these documents.
+            **kwargs: Passed to `search`, for example `exact` or `nprobe`.
+
+        Returns:
+            List[SearchResult]: Results for a single query, or one list per query.
+        """
+        from .search import embed_queries
+        vectors = await embed_queries(query, self.embedding_model, embedder)
+        return self.search(vectors, k, document_index=document_index, **kwargs)
+
+    def save(self, path) -> None:
+        """
+        Save the Bookwyrm instance to a binary wyrm file.
+
+        The binary format stores embeddings as a raw array in their `embedding_dtype`
+        (with per-dimension scales for int8) and chunk text as a packed byte column,
+        so it is much smaller and faster than `to_json`.
+        If an index has been built, it is saved next to the file (see `index.index_path`);
+        otherwise an index left there by an earlier save is removed.
+
+        Args:
+            path (str | os.PathLike): Destination file path.
+        """
+        from .storage import save_wyrm
+        from .index import index_path, wyrm_fingerprint
+        save_wyrm(self, path)
+        if self.index is not None:
+            self.index.save(index_path(path), wyrm_fingerprint(self))
+        elif os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+
+    def to_ndjson(self, file) -> None:
+        """
+        Stream the Bookwyrm to newline-delimited JSON without building the whole string in memory.
+
+        Documents come first, then chunks, then base64 float32 embedding rows (see `storage.write_ndjson`).
+
+        Args:
+            file (str | os.PathLike | IO[str]): Destination path or text file handle.
+        """
+        from .storage import write_ndjson
+        write_ndjson(self, file)
+
+    @classmethod
+    def from_ndjson(cls, file) -> 'Bookwyrm':
+        """
+        Read a Bookwyrm written by `to_ndjson`, one line at a time.
+
+        Args:
+            file (str | os.PathLike | IO[str]): Source path or text file handle.
+
+        Returns:
+            Bookwyrm: An instance of the Bookwyrm class, with float32 embeddings.
+        """
+        from .storage import read_ndjson
+        return read_ndjson(file)
+
+    @classmethod
+    def load(cls, path, mmap: bool = False) -> 'Bookwyrm':
+        """
+        Load a Bookwyrm instance from a binary wyrm file written by `save`.
+        An index saved next to the file is loaded when first needed.
+
+        Args:
+            path (str | os.PathLike): Path to the wyrm file.
+            mmap (bool): Memory-map the file read-only and build chunks lazily
+                instead of reading everything into memory. Default is False.
+
+        Returns:
+            Bookwyrm: An instance of the Bookwyrm class.
+        """
+        from .storage import load_wyrm, open_wyrm
+        from .index import index_path
+        wyrm = open_wyrm(path) if mmap else load_wyrm(path)
+        if os.path.exists(index_path(path)):
+            wyrm._index_path = index_path(path)
+        return wyrm
     
     
 
@@ -110,4 +637,8 @@ class NumpyEncoder(json.JSONEncoder):
         """
         if isinstance(obj, np.ndarray):
             return obj.tolist()
+        if isinstance(obj, BaseModel):
+            return obj.dict()
+        if isinstance(obj, ChunkTable):
+            return obj.to_dicts()
         return super(NumpyEncoder, self).default(obj)
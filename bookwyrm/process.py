@@ -1,12 +1,187 @@
-from typing import List
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
 import asyncio
+import re
 import numpy as np
 from tqdm import tqdm
 import logging
-from .utils import embedding_api
-from .models import Document, TextChunk
+from .utils import embedding_api, encode_batch, get_encoding
+from .models import ChunkTable, Document, TextChunk, gather_bytes
+from .cache import EmbeddingCache
+from .embed import Embedder
+from .dispatch import EmbeddingDispatcher, EmbeddingError
+from . import metrics
 
-def chunk(documents: List[Document], window_size: int = 800, overlap: int = 0) -> List[TextChunk]:
+# Scrapers join header lines with "\n", so blank lines may separate them.
+# Files are headed by "Filename", crawled pages by "URL" or "PDF URL".
+SECTION_HEADER = re.compile(r"^# -{3}\n+# (?:Filename|URL|PDF URL): (.*)\n+# -{3}\n", re.MULTILINE)
+
+def split_sections(text: str) -> List[Tuple[str, int, int]]:
+    """
+    Split a document into the file sections written by the scrapers.
+
+    Each section starts at a `# Filename:` (or `# URL:`) header. Text before the first header
+    (for example a pull request description) is returned as a section with an
+    empty path.
+
+    Args:
+        text (str): The document text.
+
+    Returns:
+        List[Tuple[str, int, int]]: (path, start, end) character spans.
+    """
+    sections = []
+    starts = [(m.group(1), m.start()) for m in SECTION_HEADER.finditer(text)]
+    if not starts or starts[0][1] > 0:
+        starts.insert(0, ("", 0))
+    for k, (path, start) in enumerate(starts):
+        end = starts[k + 1][1] if k + 1 < len(starts) else len(text)
+        if end > start:
+            sections.append((path, start, end))
+    return sections
+
+@lru_cache(maxsize=None)
+def token_byte_lengths() -> np.ndarray:
+    """
+    Length in bytes of every token of the encoding, indexed by token id.
+    """
+    encoding = get_encoding()
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            # Unused ids between the regular and special tokens
+            pass
+    return lengths
+
+def snap_to_breaks(ideal: np.ndarray, breaks: np.ndarray, slack: int, fallback: np.ndarray) -> np.ndarray:
+    """
+    Move each ideal end back to the last break in (ideal - slack, ideal], or use the fallback if there is none.
+    """
+    if not len(breaks):
+        return fallback
+    j = np.searchsorted(breaks, ideal, side="right") - 1
+    candidate = breaks[np.maximum(j, 0)]
+    return np.where((j >= 0) & (candidate > ideal - slack), candidate, fallback)
+
+def window_spans(start: int, end: int, max_tokens: int, overlap: int, paragraph_breaks: np.ndarray, line_breaks: np.ndarray) -> np.ndarray:
+    """
+    Token spans covering [start, end) in windows of at most `max_tokens`.
+
+    Window ends are laid out at a fixed stride and then snapped back to the
+    nearest paragraph break, else line break, within the last quarter of the
+    window, all at once with `np.searchsorted`. Each window starts `overlap`
+    tokens before the previous one ends. The stride leaves room for both, so no
+    window exceeds `max_tokens`.
+
+    Returns:
+        np.ndarray: (n, 2) array of [start, end) token offsets.
+    """
+    if end - start <= max_tokens:
+        return np.array([[start, end]], dtype=np.int64)
+    slack = max_tokens // 4
+    step = max_tokens - overlap - slack
+    ideal = np.arange(start + max_tokens, end, step, dtype=np.int64)
+    ends = snap_to_breaks(ideal, line_breaks, slack, ideal)
+    ends = snap_to_breaks(ideal, paragraph_breaks, slack, ends)
+    ends = np.append(ends, end)
+    starts = np.concatenate([[start], ends[:-1] - overlap])
+    return np.stack([starts, ends], axis=1)
+
+@metrics.timed("chunk")
+def chunk_sections(document: Document, document_index: int, global_offset: int = 0, local_offset: int = 0, max_tokens: int = 256, overlap: int = 0, tokens: Optional[np.ndarray] = None) -> List[Tuple[str, ChunkTable]]:
+    """
+    Chunk a single document section by section into windows of at most `max_tokens` tokens.
+
+    The document is tokenized once with the encoding used by `get_token_count`,
+    unless its tokens are passed in (for example from `count_tokens`).
+    Token, byte and character offsets and the candidate break points are computed
+    for the whole document with NumPy. Chunks never span two sections, and
+    inside a section they end at paragraph or line breaks where possible.
+
+    Args:
+        document (Document): The document to chunk.
+        document_index (int): Index of the document within the bookwyrm.
+        global_offset (int): Global index of the first chunk.
+        local_offset (int): Local index of the first chunk.
+        max_tokens (int): Maximum number of tokens per chunk.
+        overlap (int): Number of tokens shared by consecutive chunks of a section.
+        tokens (np.ndarray): Token ids of the document, if already computed.
+
+    Returns:
+        List[Tuple[str, ChunkTable]]: The chunks of each section, keyed by section path.
+    """
+    if not 0 <= overlap <= max_tokens // 2:
+        raise ValueError("overlap must be between 0 and half of max_tokens")
+    text = document.text
+    logging.info(f"Chunking document {document_index} with {len(text)} characters")
+    if tokens is None:
+        tokens = get_encoding().encode_ordinary(text)
+    tokens = np.asarray(tokens, dtype=np.int64)
+    if not len(tokens):
+        return []
+
+    data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    is_char_start = (data & 0xC0) != 0x80
+    # Byte offset of every token boundary, and character offset of every byte offset
+    bounds = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(token_byte_lengths()[tokens], out=bounds[1:])
+    char_at = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(is_char_start, out=char_at[1:])
+    byte_of_char = np.append(np.flatnonzero(is_char_start), len(data))
+
+    # Token boundaries right after a newline, and right after a blank line
+    after_newline = (bounds >= 1) & (data[np.maximum(bounds - 1, 0)] == 10)
+    after_blank_line = after_newline & (bounds >= 2) & (data[np.maximum(bounds - 2, 0)] == 10)
+    line_breaks = np.flatnonzero(after_newline)
+    paragraph_breaks = np.flatnonzero(after_blank_line)
+
+    sections = []
+    n = 0
+    for path, start, end in split_sections(text):
+        t0, t1 = np.searchsorted(bounds, byte_of_char[[start, end]])
+        if t1 <= t0:
+            continue
+        spans = window_spans(int(t0), int(t1), max_tokens, overlap, paragraph_breaks, line_breaks)
+        token_start, token_end = spans[:, 0], spans[:, 1]
+        char_start, char_end = char_at[bounds[token_start]], char_at[bounds[token_end]]
+        # Slice the UTF-8 bytes at character boundaries instead of building Python strings
+        chunk_text, chunk_offsets = gather_bytes(data, byte_of_char[char_start], byte_of_char[char_end])
+        ordinals = np.arange(n, n + len(spans), dtype=np.int64)
+        sections.append((path, ChunkTable(chunk_text, chunk_offsets, {
+            "document_index": np.full(len(spans), document_index, dtype=np.int64),
+            "local_index": local_offset + ordinals,
+            "global_index": global_offset + ordinals,
+            "char_start": char_start,
+            "char_end": char_end,
+            "token_start": token_start.astype(np.int64),
+            "token_end": token_end.astype(np.int64),
+        })))
+        n += len(spans)
+    metrics.count("chunks", n)
+    metrics.count("tokens", len(tokens))
+    return sections
+
+def chunk_document(document: Document, document_index: int, global_offset: int = 0, max_tokens: int = 256, overlap: int = 0, tokens: Optional[np.ndarray] = None) -> ChunkTable:
+    """
+    Chunk a single document into smaller pieces.
+
+    Args:
+        document (Document): The document to chunk.
+        document_index (int): Index of the document within the bookwyrm.
+        global_offset (int): Global index of the first chunk.
+        max_tokens (int): Maximum number of tokens per chunk.
+        overlap (int): Number of tokens shared by consecutive chunks.
+        tokens (np.ndarray): Token ids of the document, if already computed.
+
+    Returns:
+        ChunkTable: The text chunks.
+    """
+    sections = chunk_sections(document, document_index, global_offset, 0, max_tokens, overlap, tokens)
+    return ChunkTable.concat([chunks for _, chunks in sections])
+
+def chunk(documents: List[Document], max_tokens: int = 256, overlap: int = 0, tokens: Optional[List[np.ndarray]] = None) -> ChunkTable:
     """
     Chunk the documents into smaller pieces.
     Keeping the order and tagging the chunks with the document index, local index, and global index.
@@ -14,54 +189,61 @@ def chunk(documents: List[Document], window_size: int = 800, overlap: int = 0) -
 
     Args:
         documents (List[Document]): List of documents to chunk.
-        window_size (int): Size of each chunk window.
-        overlap (int): Overlap between chunks.
+        max_tokens (int): Maximum number of tokens per chunk.
+        overlap (int): Number of tokens shared by consecutive chunks.
+        tokens (List[np.ndarray]): Token ids of each document, if already computed. Otherwise all documents are tokenized in one batch.
 
     Returns:
-        List[TextChunk]: List of text chunks.
+        ChunkTable: The text chunks of all documents.
     """
-    chunks = []
-    g = 0
+    if tokens is None:
+        with metrics.span("tokenize"):
+            tokens = encode_batch([document.text for document in documents])
+    tables: List[ChunkTable] = []
+    num_chunks = 0
     for i, document in enumerate(tqdm(documents, desc="Chunking documents")):
-        text = document.text
-        logging.info(f"Chunking document {i} with {len(text)} characters")
-        for j in range(0, len(text), window_size):
-            chunk = TextChunk(
-                text=text[j:j+window_size],
-                document_index=i,
-                local_index=j,
-                global_index=g
-            )
-            chunks.append(chunk)
-            g += 1
+        tables.append(chunk_document(document, i, num_chunks, max_tokens, overlap, tokens[i]))
+        num_chunks += len(tables[-1])
+    chunks = ChunkTable.concat(tables)
     logging.info(f"Chunked {len(chunks)} chunks")
     return chunks
 
-async def encode(chunks: List[TextChunk]) -> np.ndarray:
+@metrics.timed("encode")
+async def encode(
+    chunks: Union[ChunkTable, List[TextChunk]],
+    cache: Optional[EmbeddingCache] = None,
+    embedder: Union[str, Embedder, None] = None,
+    dispatcher: Optional[EmbeddingDispatcher] = None,
+) -> np.ndarray:
     """
     Encode the chunks using the embedding API.
     The embedding API takes a list of texts and returns a list of embeddings.
     It does batching for us.
 
     Args:
-        chunks (List[TextChunk]): List of text chunks to encode.
+        chunks (ChunkTable | List[TextChunk]): Text chunks to encode.
+        cache (EmbeddingCache): Optional cache of previously computed embeddings.
+        embedder (Embedder | str): Embedding backend or its name. Defaults to Replicate.
+        dispatcher (EmbeddingDispatcher): Optional dispatcher shared across calls, overriding `embedder`.
 
     Returns:
         np.ndarray: Array of embeddings.
+
+    Raises:
+        EmbeddingError: If some batches could not be embedded after retries.
     """
-    texts = [chunk.text for chunk in chunks]
+    texts = chunks.texts() if isinstance(chunks, ChunkTable) else [chunk.text for chunk in chunks]
     logging.info(f"Encoding {len(chunks)} chunks")
     try:
-        embeddings = await embedding_api(texts)
-        logging.info(embeddings)
-        logging.info(f"Received {len(embeddings)} embeddings")
+        embeddings = await embedding_api(texts, cache=cache, embedder=embedder, dispatcher=dispatcher)
+    except EmbeddingError as e:
+        logging.error(f"Error encoding chunks: {e}")
+        raise
+    logging.info(f"Received {len(embeddings)} embeddings")
+    if len(embeddings):
         logging.info(f"Embedding shape: {embeddings[0].shape}")
         logging.info(f"Embedding type: {type(embeddings[0])}")
-        return embeddings
-    except Exception as e:
-        # Handle potential errors from the embedding API
-        logging.error(f"Error encoding chunks: {e}")
-        return np.array([])
+    return embeddings
 
 async def process_chunks(documents: List[Document]) -> np.ndarray:
     """
@@ -0,0 +1,65 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Storage dtypes a Bookwyrm's embeddings can have
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+
+def quantize_int8(embeddings: np.ndarray, scales: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric int8 scalar quantization with one scale per dimension.
+
+    Each dimension is scaled so its largest absolute value maps to 127, unless
+    existing `scales` are given, in which case values outside their range are clipped.
+
+    Args:
+        embeddings (np.ndarray): Float matrix of shape (n, dim).
+        scales (np.ndarray): Per-dimension scales to reuse, for example those of the rows being extended.
+
+    Returns:
+        tuple: (int8 matrix of shape (n, dim), float32 scales of shape (dim,)).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if scales is None:
+        scales = np.abs(embeddings).max(axis=0) / 127 if len(embeddings) else np.ones(embeddings.shape[1:], dtype=np.float32)
+    # Constant-zero dimensions would divide by zero
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    quantized = np.clip(np.rint(embeddings / scales), -127, 127).astype(np.int8)
+    return quantized, scales
+
+
+def dequantize_int8(quantized: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """
+    Approximate float32 embeddings from int8 values and their per-dimension scales.
+    """
+    return quantized.astype(np.float32) * scales
+
+
+def convert_embeddings(embeddings: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Convert float embeddings to a storage dtype.
+
+    Args:
+        embeddings (np.ndarray): Float matrix of shape (n, dim).
+        dtype (str): "float32", "float16" or "int8".
+
+    Returns:
+        tuple: (converted matrix, per-dimension scales for int8 or None).
+    """
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    if dtype == "int8":
+        return quantize_int8(embeddings)
+    return np.asarray(embeddings, dtype=dtype), None
+
+
+def restore_embeddings(embeddings: np.ndarray, dtype: str, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Convert embeddings stored as `dtype` back to float32.
+    """
+    if dtype == "int8":
+        if scales is None:
+            raise ValueError("int8 embeddings need per-dimension scales")
+        return dequantize_int8(np.asarray(embeddings), scales)
+    return np.asarray(embeddings, dtype=np.float32)
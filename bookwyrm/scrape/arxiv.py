@@ -1,21 +1,17 @@
-import aiohttp
-from io import BytesIO
-from PyPDF2 import PdfReader
+import os
 
 from bookwyrm.models import Document
+from .client import http_client
 from .document import create_document
+from .executor import extract_pdf_text
+
+# Overridable so the scraper can be pointed at a local stand-in server
+ARXIV_URL = os.getenv("ARXIV_URL", "https://arxiv.org")
 
 async def process_arxiv_pdf(arxiv_abs_url) -> Document:
-    pdf_url = arxiv_abs_url.replace("/abs/", "/pdf/") + ".pdf"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(pdf_url) as response:
-            response.raise_for_status()
-            pdf_content = await response.read()
+    pdf_url = arxiv_abs_url.replace("/abs/", "/pdf/").replace("https://arxiv.org", ARXIV_URL, 1) + ".pdf"
+    async with http_client() as client:
+        pdf_content = await client.fetch(pdf_url)
 
-    text = []
-    with BytesIO(pdf_content) as pdf_file:
-        pdf_reader = PdfReader(pdf_file)
-        for _, page in enumerate(pdf_reader.pages):
-            text.append(page.extract_text())
-    
-    return create_document(' '.join(text), arxiv_abs_url)
+    text = await extract_pdf_text(pdf_content)
+    return create_document(text, arxiv_abs_url)
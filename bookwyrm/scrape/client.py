@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set
+
+import aiohttp
+
+from bookwyrm import metrics
+
+DEFAULT_LIMIT = 100
+DEFAULT_LIMIT_PER_HOST = 10
+# Per connection attempt and per socket read rather than per request, so large downloads can take as long as they need
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_RETRY_AFTER = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """
+    HTTP client shared by every scraper in one scrape run.
+
+    Holds a single aiohttp session whose connection pool is bounded globally and
+    per host, plus a table of in-flight fetches so identical work requested by
+    several tasks (for example one repo crawl needed by several PR URLs) is
+    only done once.
+
+    Connecting and each socket read time out, and `fetch` retries failed requests.
+    """
+    def __init__(self, limit: int = DEFAULT_LIMIT, limit_per_host: int = DEFAULT_LIMIT_PER_HOST):
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[request_metrics()])
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.background: Set[asyncio.Future] = set()
+
+    def spawn(self, coroutine: Awaitable[Any]) -> asyncio.Future:
+        """
+        Run work in the background until it finishes or the client is closed.
+        """
+        future = asyncio.ensure_future(coroutine)
+        self.background.add(future)
+        future.add_done_callback(self.background.discard)
+        return future
+
+    async def fetch(
+        self,
+        url: str,
+        method: str = "GET",
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        **kwargs,
+    ) -> bytes:
+        """
+        Request a URL and read the response body.
+
+        Connection errors, timeouts and 429/5xx responses are retried with
+        exponential backoff and jitter, or after the server's Retry-After delay.
+
+        Args:
+            url (str): The URL.
+            method (str): The HTTP method.
+            retries (int): Attempts after the first one.
+            backoff (float): Delay in seconds before the first retry, doubled for each one after.
+            **kwargs: Passed to `aiohttp.ClientSession.request`, e.g. `params`, `json` or `headers`.
+
+        Returns:
+            bytes: The response body.
+
+        Raises:
+            aiohttp.ClientResponseError: If the last response has an error status.
+        """
+        for attempt in range(retries + 1):
+            delay = backoff * 2 ** attempt * (0.5 + random.random())
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        response.raise_for_status()
+                        body = await response.read()
+                        break
+                    reason = f"status {response.status}"
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = min(float(retry_after), MAX_RETRY_AFTER)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                reason = repr(e)
+            metrics.count("http_retries")
+            logging.warning(f"{method} {url} failed ({reason}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        return body
+
+    async def fetch_json(self, url: str, method: str = "GET", **kwargs) -> Any:
+        """
+        Like `fetch`, but decode the body as JSON.
+        """
+        return json.loads(await self.fetch(url, method, **kwargs))
+
+    async def once(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `factory()` once per key and share its result with every caller.
+
+        Args:
+            key (Hashable): Identifies the work.
+            factory (Callable): Creates the coroutine doing the work.
+
+        Returns:
+            The result of the shared coroutine.
+        """
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(factory())
+        # Shield so one cancelled caller doesn't cancel the work for the others
+        return await asyncio.shield(self.inflight[key])
+
+    async def close(self) -> None:
+        for future in list(self.inflight.values()) + list(self.background):
+            future.cancel()
+        await self.session.close()
+
+
+def request_metrics() -> aiohttp.TraceConfig:
+    """
+    Trace hooks counting requests, errors and bytes received, and timing each request, into the active Metrics.
+    """
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+        metrics.count("http_requests")
+
+    async def on_request_end(session, context, params):
+        metrics.observe("http.request", time.perf_counter() - context.start)
+
+    async def on_request_exception(session, context, params):
+        metrics.count("http_errors")
+
+    async def on_response_chunk_received(session, context, params):
+        metrics.count("bytes_fetched", len(params.chunk))
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+_current_client: ContextVar[Optional[HttpClient]] = ContextVar("bookwyrm_http_client", default=None)
+
+
+@asynccontextmanager
+async def http_client(**kwargs):
+    """
+    Use the HTTP client of the current scrape run, or open one for the duration of the block.
+
+    Tasks started inside the block see the same client, so nesting this in
+    `scrape_async` makes every scraper share one connection pool.
+    """
+    client = _current_client.get()
+    if client is not None:
+        yield client
+        return
+    client = HttpClient(**kwargs)
+    token = _current_client.set(client)
+    try:
+        yield client
+    finally:
+        _current_client.reset(token)
+        await client.close()
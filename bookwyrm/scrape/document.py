@@ -1,14 +1,39 @@
+import asyncio
+import os
+from typing import List
+
+from bookwyrm import metrics
 from bookwyrm.models import Document
-from bookwyrm.utils import get_token_count
+from bookwyrm.utils import encode_batch, estimate_token_count
+
+# "exact" counts tokens off the event loop once scraping is done, "estimate"
+# uses a cheap character-based guess, and "lazy" leaves num_tokens at 0.
+TOKEN_COUNT_MODE = os.getenv("BOOKWYRM_TOKEN_COUNT", "exact")
 
-def create_document(text, source, metadata=None):
+def create_document(text, source, metadata=None, num_files=None):
     if metadata is None:
         metadata = {}
+    if num_files is None:
+        # Scrapers that don't know their file count head each file with a "# ---" block
+        num_files = len(text.split("# ---"))
     return Document(
         text=text,
         source=source,
         metadata=metadata,
-        num_files=len(text.split("# ---")),
+        num_files=num_files,
         num_chars=len(text),
-        num_tokens=get_token_count(text)
+        num_tokens=estimate_token_count(text) if TOKEN_COUNT_MODE == "estimate" else 0
     )
+
+async def count_tokens(documents: List[Document]):
+    """
+    Tokenize documents in one batch on a worker thread and fill in their exact `num_tokens`.
+
+    Returns:
+        list: The token arrays, so the chunker can reuse them instead of tokenizing again.
+    """
+    with metrics.span("tokenize"):
+        tokens = await asyncio.to_thread(encode_batch, [document.text for document in documents])
+    for document, document_tokens in zip(documents, tokens):
+        document.num_tokens = len(document_tokens)
+    return tokens
@@ -1,33 +1,134 @@
-
+import asyncio
+import os
+import re
+import weakref
+from typing import Dict, List, Optional
 
 import aiohttp
 from bookwyrm.models import Document
+from .client import HttpClient, http_client
 from .document import create_document
 
+# Overridable so the scraper can be pointed at a local stand-in server
+SEMANTIC_SCHOLAR_API_URL = os.getenv("SEMANTIC_SCHOLAR_API_URL", "https://api.semanticscholar.org")
+PAPER_FIELDS = "title,abstract,authors,year,venue,url"
+# The batch endpoint accepts up to 500 ids per request
+MAX_BATCH_SIZE = 500
+# How long a lookup waits for others to join its batch
+BATCH_WINDOW = 0.05
+
+
+def format_paper(data: Optional[Dict], identifier) -> Document:
+    # if there is no data, we need to return an empty document
+    if not data:
+        return create_document("", identifier)
+
+    title = data.get("title", "")
+    abstract = data.get("abstract", "")
+    authors = ", ".join([author["name"] for author in data.get("authors", [])])
+    year = data.get("year", "")
+    venue = data.get("venue", "")
+    url = data.get("url", "")
+
+    text = f"# Title: {title}\n\n"
+    text += f"## Authors: {authors}\n\n"
+    text += f"## Year: {year}\n\n"
+    text += f"## Venue: {venue}\n\n"
+    text += f"## URL: {url}\n\n"
+    text += f"## Abstract:\n{abstract}\n"
+
+    return create_document(text, identifier)
+
+
+def paper_id(identifier: str) -> str:
+    """
+    The batch endpoint needs DOIs prefixed with "DOI:".
+    """
+    return f"DOI:{identifier}" if re.match(r"10\.\d{4,9}/", identifier) else identifier
+
+
+async def fetch_paper(client: HttpClient, identifier: str) -> Optional[Dict]:
+    try:
+        return await client.fetch_json(f"{SEMANTIC_SCHOLAR_API_URL}/v1/paper/{identifier}")
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+async def fetch_papers(client: HttpClient, identifiers: List[str]) -> List[Optional[Dict]]:
+    """
+    Look up several papers with one request to the batch endpoint. Unknown papers are None.
+    """
+    return await client.fetch_json(
+        f"{SEMANTIC_SCHOLAR_API_URL}/graph/v1/paper/batch",
+        method="POST",
+        params={"fields": PAPER_FIELDS},
+        json={"ids": [paper_id(identifier) for identifier in identifiers]},
+    )
+
+
+class PaperBatcher:
+    """
+    Coalesces paper lookups made around the same time into batch requests.
+
+    A lookup waits up to `window` seconds for others to join it, then up to
+    `max_batch_size` papers are fetched with one request. A lookup that nobody
+    joins uses the single-paper endpoint.
+    """
+    def __init__(self, client: HttpClient, window: float = BATCH_WINDOW, max_batch_size: int = MAX_BATCH_SIZE):
+        self.client = client
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    async def get(self, identifier: str) -> Optional[Dict]:
+        future = self.pending.get(identifier)
+        if future is None:
+            future = self.pending[identifier] = asyncio.get_running_loop().create_future()
+            if len(self.pending) >= self.max_batch_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        # Shield so one cancelled caller doesn't cancel the lookup for the others
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            # Cancelled with the client, so lookups that every caller gave up on don't outlive the run
+            self.client.spawn(self.request(batch))
+
+    async def request(self, batch: Dict[str, asyncio.Future]) -> None:
+        identifiers = list(batch)
+        try:
+            if len(identifiers) == 1:
+                papers = [await fetch_paper(self.client, identifiers[0])]
+            else:
+                papers = await fetch_papers(self.client, identifiers)
+            if len(papers) != len(identifiers):
+                raise ValueError(f"Semantic Scholar returned {len(papers)} papers for {len(identifiers)} ids")
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, paper in zip(batch.values(), papers):
+            if not future.done():
+                future.set_result(paper)
+
+
+# One batcher per scrape run's client
+_batchers: "weakref.WeakKeyDictionary[HttpClient, PaperBatcher]" = weakref.WeakKeyDictionary()
+
 
 async def process_doi_or_pmid(identifier) -> Document:
-    url = f"https://api.semanticscholar.org/v1/paper/{identifier}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            data = await response.json()
-
-            # if there is no data, we need to return an empty document
-            if not data:
-                return create_document("", identifier)
-            
-            title = data.get("title", "")
-            abstract = data.get("abstract", "")
-            authors = ", ".join([author["name"] for author in data.get("authors", [])])
-            year = data.get("year", "")
-            venue = data.get("venue", "")
-            url = data.get("url", "")
-
-            text = f"# Title: {title}\n\n"
-            text += f"## Authors: {authors}\n\n"
-            text += f"## Year: {year}\n\n"
-            text += f"## Venue: {venue}\n\n"
-            text += f"## URL: {url}\n\n"
-            text += f"## Abstract:\n{abstract}\n"
-
-            return create_document(text, identifier)
-       
\ No newline at end of file
+    async with http_client() as client:
+        if client not in _batchers:
+            _batchers[client] = PaperBatcher(client)
+        data = await _batchers[client].get(identifier)
+    return format_paper(data, identifier)
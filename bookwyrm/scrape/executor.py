@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from .scrape import count_pdf_pages, extract_pdf_pages, split_pdf
+
+# "process" keeps parsing off the event loop and the GIL; "thread" avoids
+# pickling large payloads; "inline" runs on the loop (useful for comparison).
+EXECUTOR_KIND = os.getenv("BOOKWYRM_CPU_EXECUTOR", "process")
+MAX_WORKERS = int(os.getenv("BOOKWYRM_CPU_WORKERS", "0")) or None
+PDF_PAGES_PER_TASK = 16
+
+_executor: Optional[Executor] = None
+
+
+def configure_executor(kind: str = "process", max_workers: Optional[int] = None) -> None:
+    """
+    Choose the pool that CPU-bound parsing is submitted to.
+
+    Args:
+        kind (str): "process", "thread", or "inline" to run on the event loop.
+        max_workers (int): Pool size. Defaults to the executor's own default.
+    """
+    global EXECUTOR_KIND, MAX_WORKERS, _executor
+    if kind not in ("process", "thread", "inline"):
+        raise ValueError(f"Unsupported executor kind: {kind}")
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    EXECUTOR_KIND = kind
+    MAX_WORKERS = max_workers
+
+
+def get_executor() -> Optional[Executor]:
+    global _executor
+    if EXECUTOR_KIND == "inline":
+        return None
+    if _executor is None:
+        if EXECUTOR_KIND == "process":
+            _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="bookwyrm-cpu")
+        logging.info(f"Started {EXECUTOR_KIND} pool for CPU-bound parsing")
+    return _executor
+
+
+async def run_cpu(func, *args):
+    """
+    Run a CPU-bound function in the configured pool without blocking the event loop.
+    `func` and its arguments must be picklable when a process pool is used.
+    """
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def extract_pdf_text(content: bytes, pages_per_task: int = PDF_PAGES_PER_TASK) -> str:
+    """
+    Extract the text of a PDF, splitting large documents into page ranges that are parsed in parallel.
+
+    Pool threads share the file, so each task reads its own range of it. Process
+    pool tasks would each need a pickled copy of the whole file, so it is split
+    once into smaller PDFs and each task is sent only its own pages.
+
+    Args:
+        content (bytes): The PDF file.
+        pages_per_task (int): Pages extracted by each pool task.
+
+    Returns:
+        str: The text of all pages, separated by spaces.
+    """
+    if EXECUTOR_KIND == "process":
+        pdfs = await run_cpu(split_pdf, content, pages_per_task)
+        parts = await asyncio.gather(*[run_cpu(extract_pdf_pages, pdf) for pdf in pdfs])
+    else:
+        num_pages = await run_cpu(count_pdf_pages, content)
+        ranges = [(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+        parts = await asyncio.gather(*[run_cpu(extract_pdf_pages, content, start, stop) for start, stop in ranges])
+    return ' '.join(text for part in parts for text in part)
@@ -1,14 +1,21 @@
 import time
 import os
+import hashlib
+import tarfile
 import aiohttp
 import asyncio
 import logging
-from typing import List
+from io import BytesIO
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
+from bookwyrm import metrics
 from bookwyrm.models import Document
+from .client import http_client
 from .document import create_document
-from .scrape import is_allowed_filetype, process_ipynb_file
+from .executor import run_cpu
+from .scrape import is_allowed_filetype, convert_ipynb
 
 
 load_dotenv()
@@ -19,99 +26,225 @@ if TOKEN == 'default_token_here':
 else:
     logging.info("GITHUB_TOKEN environment variable set.")
 
+# Overridable so the scraper can be pointed at a local stand-in server
+API_BASE_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
 headers = {
     "Accept": "application/vnd.github.v3+json",
     "Authorization": f"token {TOKEN}"
 }
 
-RATE_LIMIT_REMAINING = 5000
-RATE_LIMIT_RESET = 0
+class RateLimiter:
+    """
+    Token bucket that paces GitHub API requests to the budget reported in the `X-RateLimit-*` headers.
+
+    The bucket refills at the rate that spends the remaining budget evenly until the
+    reset time and allows bursts of up to `burst` requests. Waits are reserved
+    synchronously, so concurrent callers don't need a lock and queue up in order.
+    """
+    def __init__(self, burst: int = 20):
+        self.burst = burst
+        self.tokens = float(burst)
+        self.remaining: Optional[int] = None
+        self.reset = 0.0
+        self.updated = time.monotonic()
+
+    def rate(self) -> float:
+        if self.remaining is None:
+            return float(self.burst)
+        return self.remaining / max(self.reset - time.time(), 1.0)
+
+    def reserve(self) -> float:
+        """
+        Take one token and return how many seconds to wait before using it.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate())
+        self.updated = now
+        self.tokens -= 1
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining < 0:
+                return max(self.reset - time.time(), 0.0) + 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / max(self.rate(), 1e-3)
+
+    async def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            logging.info(f"GitHub rate limit: waiting {wait:.1f} seconds")
+            metrics.count("rate_limit_waits")
+            metrics.count("rate_limit_wait_seconds", wait)
+            await asyncio.sleep(wait)
+
+    def update(self, response_headers) -> None:
+        if "X-RateLimit-Remaining" not in response_headers:
+            return
+        self.remaining = int(response_headers["X-RateLimit-Remaining"])
+        self.reset = float(response_headers.get("X-RateLimit-Reset", 0))
+        if self.remaining <= 0:
+            logging.warning(f"Rate limit exceeded. Waiting until {time.ctime(self.reset)}.")
+
+# The budget belongs to the token, so it is shared by every request in the process
+rate_limiter = RateLimiter()
+
+@asynccontextmanager
+async def github_request(session, url):
+    await rate_limiter.acquire()
+    async with session.get(url, headers=headers) as response:
+        rate_limiter.update(response.headers)
+        yield response
 
-async def process_file_in_repo(file, repo_content, session, semaphore):
+async def process_file_in_repo(file, repo_files, session, semaphore):
     async with semaphore:
         logging.info(f"Processing {file['path']}...")
 
-        temp_file = f"temp_{file['name']}"
-        await download_file(file["download_url"], temp_file, session)
-
-        repo_content.append(f"# {'-' * 3}\n")
-        repo_content.append(f"# Filename: {file['path']}\n")
-        repo_content.append(f"# {'-' * 3}\n\n")
-
+        # Read in memory like the tarball path, so concurrent downloads of same-named files can't collide on disk
+        text = (await download_file(file["download_url"], session)).decode("utf-8", errors="ignore")
         if file["name"].endswith(".ipynb"):
-            repo_content.append(process_ipynb_file(temp_file))
-        else:
-            with open(temp_file, "r", encoding='utf-8', errors='ignore') as f:
-                repo_content.append(f.read())
+            text = await run_cpu(convert_ipynb, text)
 
-        repo_content.append("\n\n")
-        os.remove(temp_file)
-
-        # Add a delay between file processing
-        await asyncio.sleep(1)  # Adjust the delay as needed
+        repo_files.append((file["path"], file["sha"], text))
 
-async def process_directory(url, repo_content, session, semaphore):
-    async with session.get(url, headers=headers) as response:
-        print(headers)
-        await handle_rate_limit(response)
+async def process_directory(url, repo_files, session, semaphore):
+    async with github_request(session, url) as response:
         response.raise_for_status()
         files = await response.json()
 
         tasks = []
         for file in files:
             if file["type"] == "file" and is_allowed_filetype(file["name"]):
-                tasks.append(process_file_in_repo(file, repo_content, session, semaphore))
+                tasks.append(process_file_in_repo(file, repo_files, session, semaphore))
             elif file["type"] == "dir":
-                tasks.append(process_directory(file["url"], repo_content, session, semaphore))
+                tasks.append(process_directory(file["url"], repo_files, session, semaphore))
 
         await asyncio.gather(*tasks)
 
-        # Add a delay between directory processing
-        await asyncio.sleep(1)  # Adjust the delay as needed
-
-async def download_file(url, dest, session):
+async def download_file(url, session) -> bytes:
     async with session.get(url) as response:
-        await handle_rate_limit(response)
         response.raise_for_status()
-        with open(dest, 'wb') as f:
-            f.write(await response.read())
+        return await response.read()
+
+def git_blob_sha(data: bytes) -> str:
+    """
+    The SHA git (and the contents API) reports for a blob with this content.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def read_repo_archive(archive: bytes) -> List[Tuple[str, str, str]]:
+    """
+    Read the allowed files of a repo tarball.
+
+    Runs in the CPU pool, so decompression and notebook conversion stay off the event loop.
+
+    Returns:
+        List[Tuple[str, str, str]]: (path, blob SHA, text) per file.
+    """
+    files = []
+    # Stream mode reads members in order and never extracts to disk
+    with tarfile.open(fileobj=BytesIO(archive), mode="r|gz") as tar:
+        for member in tar:
+            # Members are prefixed with "{owner}-{repo}-{sha}/"
+            path = member.name.split("/", 1)[-1]
+            if not member.isfile() or not is_allowed_filetype(path):
+                continue
+            extracted = tar.extractfile(member)
+            if extracted is None:
+                continue
+            data = extracted.read()
+            sha = git_blob_sha(data)
+            text = data.decode("utf-8", errors="ignore")
+            files.append((path, sha, convert_ipynb(text) if path.endswith(".ipynb") else text))
+    return files
+
+async def process_repo_archive(archive_url, session) -> List[Tuple[str, str, str]]:
+    async with github_request(session, archive_url) as response:
+        response.raise_for_status()
+        archive = await response.read()
+    return await run_cpu(read_repo_archive, archive)
 
-async def process_github_repo(repo_url) -> Document:
-    api_base_url = "https://api.github.com/repos/"
+def parse_repo_url(repo_url) -> Tuple[str, str, str]:
+    """
+    Split a repo URL into ("owner/repo", ref, subdirectory); ref and subdirectory may be empty.
+    """
     repo_url_parts = repo_url.split("https://github.com/")[-1].split("/")
     repo_name = "/".join(repo_url_parts[:2])
 
+    ref = ""
     subdirectory = ""
-    if len(repo_url_parts) > 4 and repo_url_parts[2] == "tree":
-        subdirectory = "/".join(repo_url_parts[4:])
+    if len(repo_url_parts) > 3 and repo_url_parts[2] == "tree":
+        ref = repo_url_parts[3]
+        subdirectory = "/".join(part for part in repo_url_parts[4:] if part)
+    return repo_name, ref, subdirectory
+
+async def process_github_repo(repo_url, previous_files: Optional[Dict[str, str]] = None) -> Document:
+    """
+    Fetch every allowed file of a GitHub repository into one document.
+
+    Runs on the shared HTTP client of the current scrape run. Every request for
+    the same repo, ref and path in a run (for example several PR and issue URLs
+    on it, and the repo URL itself) shares one crawl; see `fetch_repo_files`.
+
+    Files are fingerprinted by their blob SHA in `metadata["files"]`. Files whose
+    SHA matches `previous_files` are left out of the text and listed in
+    `metadata["unchanged_files"]` so their chunks can be carried over.
+    """
+    repo_name, ref, subdirectory = parse_repo_url(repo_url)
+    async with http_client() as client:
+        key = ("github_repo", repo_name, ref, subdirectory)
+        files = await client.once(key, lambda: fetch_repo_files(repo_name, ref, subdirectory, client.session))
+
+    previous_files = previous_files or {}
+    repo_content: List[str] = []
+    for path, sha, text in files:
+        if previous_files.get(path) == sha:
+            logging.info(f"Skipping unchanged {path}")
+            continue
+        repo_content.append(f"# {'-' * 3}\n")
+        repo_content.append(f"# Filename: {path}\n")
+        repo_content.append(f"# {'-' * 3}\n\n")
+        repo_content.append(text)
+        repo_content.append("\n\n")
+
+    fingerprints = {path: sha for path, sha, _ in files}
+    unchanged = [path for path, sha in fingerprints.items() if previous_files.get(path) == sha]
+    metadata = {"files": fingerprints, "unchanged_files": unchanged}
+    return create_document("\n".join(repo_content), repo_url, metadata)
+
+async def fetch_repo_files(repo_name: str, ref: str, subdirectory: str, session) -> List[Tuple[str, str, str]]:
+    """
+    Fetch every allowed file of a GitHub repository, or of one of its directories.
+
+    Whole repositories are fetched as a single tarball at the requested ref and
+    read in memory. Subdirectories, or a failed archive download, fall back to
+    walking the contents API.
 
-    contents_url = f"{api_base_url}{repo_name}/contents"
+    Returns:
+        List[Tuple[str, str, str]]: (path, blob SHA, text) per file.
+    """
+    contents_url = f"{API_BASE_URL}/repos/{repo_name}/contents"
     if subdirectory:
         contents_url = f"{contents_url}/{subdirectory}"
+    if ref:
+        contents_url = f"{contents_url}?ref={ref}"
 
-    repo_content: List[str] = []
+    if not subdirectory:
+        archive_url = f"{API_BASE_URL}/repos/{repo_name}/tarball" + (f"/{ref}" if ref else "")
+        try:
+            return await process_repo_archive(archive_url, session)
+        except (aiohttp.ClientResponseError, tarfile.TarError) as e:
+            logging.warning(f"Archive download failed for {repo_name}, falling back to contents API: {e}")
 
+    repo_files: List[Tuple[str, str, str]] = []
     semaphore = asyncio.Semaphore(10)  # Limit the number of concurrent requests
-    async with aiohttp.ClientSession() as session:
-        await process_directory(contents_url, repo_content, session, semaphore)
-
+    await process_directory(contents_url, repo_files, session, semaphore)
     logging.info("All files processed.")
-    return create_document("\n".join(repo_content), repo_url)
-
-async def handle_rate_limit(response):
-    global RATE_LIMIT_REMAINING, RATE_LIMIT_RESET
-
-    RATE_LIMIT_REMAINING = int(response.headers.get("X-RateLimit-Remaining", 0))
-    RATE_LIMIT_RESET = int(response.headers.get("X-RateLimit-Reset", 0))
-
-    if RATE_LIMIT_REMAINING <= 0:
-        current_time = int(time.time())
-        wait_time = RATE_LIMIT_RESET - current_time + 1
-        logging.warning(f"Rate limit exceeded. Waiting for {wait_time} seconds.")
-        await asyncio.sleep(wait_time)
+    return repo_files
 
 async def process_github_pull_request(pull_request_url) -> Document:
-    async with aiohttp.ClientSession() as session:
+    async with http_client() as client:
+        session = client.session
         # Extract repository owner, repository name, and pull request number from the URL
         url_parts = pull_request_url.split("/")
         repo_owner = url_parts[3]
@@ -119,10 +252,10 @@ async def process_github_pull_request(pull_request_url) -> Document:
         pull_request_number = url_parts[-1]
 
         # Make API requests to retrieve pull request information
-        api_base_url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pull_request_number}"
+        api_base_url = f"{API_BASE_URL}/repos/{repo_owner}/{repo_name}/pulls/{pull_request_number}"
 
         # Retrieve pull request details
-        async with session.get(api_base_url, headers=headers) as response:
+        async with github_request(session, api_base_url) as response:
             pull_request_data = await response.json()
 
         # Retrieve pull request diff
@@ -133,9 +266,9 @@ async def process_github_pull_request(pull_request_url) -> Document:
         # Retrieve pull request comments and review comments
         comments_url = pull_request_data["comments_url"]
         review_comments_url = pull_request_data["review_comments_url"]
-        async with session.get(comments_url, headers=headers) as response:
+        async with github_request(session, comments_url) as response:
             comments_data = await response.json()
-        async with session.get(review_comments_url, headers=headers) as response:
+        async with github_request(session, review_comments_url) as response:
             review_comments_data = await response.json()
 
         # Combine comments and review comments into a single list
@@ -176,7 +309,8 @@ async def process_github_pull_request(pull_request_url) -> Document:
 
 
 async def process_github_issue(issue_url) -> Document:
-    async with aiohttp.ClientSession() as session:
+    async with http_client() as client:
+        session = client.session
         # Extract repository owner, repository name, and issue number from the URL
         url_parts = issue_url.split("/")
         repo_owner = url_parts[3]
@@ -184,15 +318,15 @@ async def process_github_issue(issue_url) -> Document:
         issue_number = url_parts[-1]
 
         # Make API requests to retrieve issue information
-        api_base_url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/issues/{issue_number}"
+        api_base_url = f"{API_BASE_URL}/repos/{repo_owner}/{repo_name}/issues/{issue_number}"
 
         # Retrieve issue details
-        async with session.get(api_base_url, headers=headers) as response:
+        async with github_request(session, api_base_url) as response:
             issue_data = await response.json()
 
         # Retrieve issue comments
         comments_url = issue_data["comments_url"]
-        async with session.get(comments_url, headers=headers) as response:
+        async with github_request(session, comments_url) as response:
             comments_data = await response.json()
 
         # Format the retrieved issue information
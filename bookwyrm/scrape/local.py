@@ -1,38 +1,242 @@
+import asyncio
+import fnmatch
 import logging
 import os
-import asyncio
-from typing import List
+import re
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+from bookwyrm import metrics
 from bookwyrm.models import Document
 from .document import create_document
-from .scrape import is_allowed_filetype, process_ipynb_file
+from .executor import run_cpu
+from .scrape import convert_ipynb, is_allowed_filetype
+
+# Files larger than this are skipped, as they are usually data or generated code
+MAX_FILE_BYTES = int(os.getenv("BOOKWYRM_MAX_FILE_BYTES", 1 << 20))
+READ_WORKERS = 16
+# A NUL byte in the first block marks a file as binary
+BINARY_SNIFF_BYTES = 8192
+
+
+def file_header(file_path: str) -> str:
+    return f"# {'-' * 3}\n# Filename: {file_path}\n# {'-' * 3}\n\n"
+
+
+def fingerprint(stat: os.stat_result) -> str:
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate a gitignore glob to a regex where `*` stays within a path segment and `**` spans segments.
+    """
+    parts = re.split(r"(\*\*/|/\*\*$|\*\*|\*|\?|\[[^\]]*\])", pattern)
+    out = []
+    for part in parts:
+        if part == "**/":
+            out.append("(?:.*/)?")
+        elif part in ("/**", "**"):
+            out.append("(?:/.*)?" if part == "/**" else ".*")
+        elif part == "*":
+            out.append("[^/]*")
+        elif part == "?":
+            out.append("[^/]")
+        elif part.startswith("[") and part.endswith("]") and len(part) > 2:
+            out.append(fnmatch.translate(part)[4:-3])
+        else:
+            out.append(re.escape(part))
+    return "".join(out)
+
+
+class GitIgnore:
+    """
+    Patterns of one .gitignore file, matched against paths relative to its directory.
+
+    Supports comments, `!` negation, trailing `/` for directories only, leading
+    or inner `/` to anchor a pattern, and `*`, `?`, `[...]` and `**` globs.
+    """
+    def __init__(self, lines: List[str]):
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            directory_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                regex = glob_to_regex(line.lstrip("/"))
+            else:
+                # Unanchored patterns match a name at any depth
+                regex = "(?:.*/)?" + glob_to_regex(line)
+            self.rules.append((re.compile(regex + r"\Z"), negate, directory_only))
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['GitIgnore']:
+        path = os.path.join(directory, ".gitignore")
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            return cls(f.readlines())
+
+    def match(self, relative_path: str, is_dir: bool) -> Optional[bool]:
+        """
+        True if ignored, False if re-included by a negated pattern, None if no pattern matches.
+        """
+        result = None
+        for regex, negate, directory_only in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                result = not negate
+        return result
+
+
+def list_files(local_path: str) -> List[str]:
+    """
+    Walk a folder and list the allowed files that no .gitignore excludes.
+
+    Ignored directories are not descended into, and `.git` is always skipped.
+    """
+    files = []
+    # (directory, patterns) of every .gitignore above the current directory
+    ignores: List[Tuple[str, GitIgnore]] = []
+
+    def ignored(path: str, is_dir: bool) -> bool:
+        result = False
+        for directory, gitignore in ignores:
+            if os.path.commonpath([directory, path]) != directory:
+                continue
+            match = gitignore.match(os.path.relpath(path, directory).replace(os.sep, "/"), is_dir)
+            if match is not None:
+                result = match
+        return result
+
+    for root, dirs, names in os.walk(local_path):
+        ignores = [(directory, gitignore) for directory, gitignore in ignores if os.path.commonpath([directory, root]) == directory]
+        gitignore = GitIgnore.load(root)
+        if gitignore is not None:
+            ignores.append((root, gitignore))
+        dirs[:] = sorted(d for d in dirs if d != ".git" and not ignored(os.path.join(root, d), True))
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if is_allowed_filetype(name) and not ignored(path, False):
+                files.append(path)
+    return files
+
+
+def read_text_file(file_path: str, max_bytes: int) -> Optional[str]:
+    """
+    Read a text file, or return None if it is binary or larger than `max_bytes`.
+    """
+    with open(file_path, "rb") as f:
+        data = f.read(max_bytes + 1)
+    metrics.count("local_bytes_read", len(data))
+    if len(data) > max_bytes:
+        logging.info(f"Skipping {file_path}: larger than {max_bytes} bytes")
+        return None
+    if b"\0" in data[:BINARY_SNIFF_BYTES]:
+        logging.info(f"Skipping binary file {file_path}")
+        return None
+    return data.decode("utf-8", errors="ignore")
+
+
+async def scan_local_folder(
+    local_path: str,
+    previous_files: Optional[Dict[str, str]] = None,
+    max_file_bytes: int = MAX_FILE_BYTES,
+    workers: int = READ_WORKERS,
+) -> AsyncIterator[Document]:
+    """
+    Stream one document per file under a local folder as files are read.
+
+    Files are listed off the event loop, honoring .gitignore files, and read by
+    `workers` concurrent tasks on worker threads. Binary files and files over
+    `max_file_bytes`, notebooks included, are skipped. Each document's source is the file path and its
+    text is the file under a `# Filename:` header, so it forms one section.
+
+    Files are fingerprinted by modification time and size in `metadata["fingerprint"]`.
+    A file whose fingerprint matches `previous_files` is not read; it is yielded
+    as an empty document with `metadata["not_modified"]` so its chunks can be carried over.
 
-async def process_file(file_path, output):
-    logging.info(f"Processing {file_path}...")
+    Args:
+        local_path (str): Folder to scan.
+        previous_files (Dict[str, str]): Fingerprints by file path from an earlier run.
+        max_file_bytes (int): Size above which files are skipped.
+        workers (int): Number of files read concurrently.
+    """
+    previous_files = previous_files or {}
+    paths = await asyncio.to_thread(list_files, local_path)
+    files: asyncio.Queue = asyncio.Queue()
+    for path in paths:
+        files.put_nowait(path)
+    # Bounded, so reading pauses while the consumer is busy
+    documents: asyncio.Queue = asyncio.Queue(workers * 2)
 
-    output.append(f"# {'-' * 3}\n")
-    output.append(f"# Filename: {file_path}\n")
-    output.append(f"# {'-' * 3}\n\n")
+    async def read_worker():
+        while not files.empty():
+            file_path = files.get_nowait()
+            try:
+                with metrics.span("scrape.local_file"):
+                    document = await read_document(file_path)
+                if document is not None:
+                    await documents.put(document)
+            except Exception as e:
+                # One unreadable or malformed file shouldn't lose the rest of the folder
+                logging.warning(f"Could not read {file_path}: {e}")
 
-    if file_path.endswith(".ipynb"):
-        output.append(process_ipynb_file(file_path))
-    else:
-        with open(file_path, "r", encoding='utf-8', errors='ignore') as f:
-            output.append(f.read())
+    async def read_document(file_path: str) -> Optional[Document]:
+        stat = await asyncio.to_thread(os.stat, file_path)
+        metadata = {"folder": local_path, "fingerprint": fingerprint(stat)}
+        if previous_files.get(file_path) == metadata["fingerprint"]:
+            return create_document("", file_path, {**metadata, "not_modified": True}, num_files=1)
+        # Notebooks are bounded by their raw size too, before they are parsed
+        text = await asyncio.to_thread(read_text_file, file_path, max_file_bytes)
+        if text is None:
+            return None
+        if file_path.endswith(".ipynb"):
+            text = await run_cpu(convert_ipynb, text)
+        return create_document(file_header(file_path) + text, file_path, metadata, num_files=1)
 
-    output.append("\n\n")
+    async def read_all():
+        try:
+            await asyncio.gather(*[read_worker() for _ in range(min(workers, len(paths)))])
+        finally:
+            # When cancelled the consumer has stopped, so nothing would make room for the end marker
+            if not asyncio.current_task().cancelling():
+                await documents.put(None)
 
-async def process_local_folder(local_path) -> Document:
-    output: List[str] = []
-    tasks = []
+    reader = asyncio.create_task(read_all())
+    try:
+        while (document := await documents.get()) is not None:
+            yield document
+        await reader
+    finally:
+        reader.cancel()
 
-    for root, dirs, files in os.walk(local_path):
-        for file in files:
-            if is_allowed_filetype(file):
-                file_path = os.path.join(root, file)
-                tasks.append(process_file(file_path, output))
 
-    await asyncio.gather(*tasks)
+async def process_local_folder(local_path, previous_files: Optional[Dict[str, str]] = None) -> Document:
+    """
+    Read every allowed file under a local folder into one document.
 
-    final_text = "\n".join(output)
-    return create_document(final_text, local_path)
+    Uses `scan_local_folder`. Unchanged files (by `previous_files` fingerprint)
+    are not read and are listed in `metadata["unchanged_files"]`.
+    """
+    parts: List[Tuple[str, str]] = []
+    fingerprints: Dict[str, str] = {}
+    unchanged: List[str] = []
+    async for document in scan_local_folder(local_path, previous_files):
+        fingerprints[document.source] = document.metadata["fingerprint"]
+        if document.metadata.get("not_modified"):
+            unchanged.append(document.source)
+        else:
+            parts.append((document.source, document.text))
+    # Keep a stable file order regardless of read completion order
+    parts.sort()
+    final_text = "\n\n".join(text for _, text in parts)
+    metadata = {"files": fingerprints, "unchanged_files": unchanged}
+    return create_document(final_text, local_path, metadata, num_files=len(fingerprints))
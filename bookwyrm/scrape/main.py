@@ -1,21 +1,42 @@
 import asyncio
+import contextlib
 import logging
 import os
 import re
-from typing import List
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
+from bookwyrm import metrics
 from bookwyrm.models import Document
 from bookwyrm.utils import TEST_TASKS
+from .client import http_client
+from .document import TOKEN_COUNT_MODE, count_tokens, create_document
 from .doi import process_doi_or_pmid
 from .github import process_github_repo, process_github_pull_request, process_github_issue
 from .arxiv import process_arxiv_pdf
 from .youtube import fetch_youtube_transcript
 from .web import crawl_and_extract_text
-from .local import process_local_folder
+from .local import process_local_folder, scan_local_folder
 # Configure logging
 # logging.basicConfig(level=logging.INFO)
 
+MAX_CONCURRENT_TASKS = int(os.getenv("BOOKWYRM_SCRAPE_CONCURRENCY", "32"))
+# Long crawls start first so they don't hold up the end of the run
+TASK_PRIORITY = [
+    "github_repo", "web_content", "local_folder", "arxiv",
+    "youtube_transcript", "github_pull_request", "github_issue", "doi_or_pmid",
+]
+TASK_SOURCES = {
+    "github_repo": "github", "github_pull_request": "github", "github_issue": "github",
+    "web_content": "web", "arxiv": "arxiv", "youtube_transcript": "youtube",
+    "local_folder": "local", "doi_or_pmid": "semantic_scholar",
+}
+# Tasks of each source running at once. DOI lookups are cheap and batched, so they are only bounded globally.
+SOURCE_LIMITS = {"github": 8, "web": 4, "arxiv": 4, "youtube": 4, "local": 2}
+# Seconds a task may spend scraping. Local folders are read from disk and aren't limited.
+DEFAULT_TASK_TIMEOUT = float(os.getenv("BOOKWYRM_TASK_TIMEOUT", "300"))
+TASK_TIMEOUTS: Dict[str, Optional[float]] = {"github_repo": 3 * DEFAULT_TASK_TIMEOUT, "web_content": 3 * DEFAULT_TASK_TIMEOUT, "local_folder": None}
+
 def get_task_type(task) -> str:
     parsed_url = urlparse(task)
     if parsed_url.netloc == "github.com":
@@ -39,11 +60,20 @@ def get_task_type(task) -> str:
         raise ValueError(f"Unsupported task: {task}")
 
 
-async def process_task(task) -> Document:
+async def process_task(task, previous: Optional[Dict] = None) -> Document:
+    """
+    Scrape a single task. `previous` is the metadata recorded for the same source
+    by an earlier run; sources that support it use it to skip unchanged content.
+    """
+    previous = previous or {}
     task_type = get_task_type(task)
+    with metrics.span(f"scrape.{task_type}"):
+        return await scrape_task(task, task_type, previous)
+
+async def scrape_task(task, task_type: str, previous: Dict) -> Document:
     match task_type:
         case "github_repo":
-            return await process_github_repo(task)
+            return await process_github_repo(task, previous.get("files"))
         case "github_pull_request":
             return await process_github_pull_request(task)
         case "github_issue":
@@ -51,18 +81,196 @@ async def process_task(task) -> Document:
         case "arxiv":
             return await process_arxiv_pdf(task)
         case "local_folder":
-            return await process_local_folder(task)
+            return await process_local_folder(task, previous.get("files"))
         case "youtube_transcript":
             return await fetch_youtube_transcript(task)
         case "web_content":
-            return await crawl_and_extract_text(task, max_depth=2, include_pdfs=True, ignore_epubs=True)
+            return await crawl_and_extract_text(task, max_depth=2, include_pdfs=True, ignore_epubs=True, previous_metadata=previous)
         case "doi_or_pmid":
             return await process_doi_or_pmid(task)
         case _:
             raise ValueError(f"Unsupported task: {task}")
 
-async def scrape_async(tasks) -> List[Document]:
-    processed_data_list = await asyncio.gather(*[process_task(task) for task in tasks])
+async def iter_task(task, previous: Dict[str, Dict]) -> AsyncIterator[Document]:
+    """
+    Scrape a single task, yielding its documents as they are ready.
+
+    Local folders stream one document per file; other tasks yield one document.
+    `previous` maps document sources to the metadata recorded by an earlier run.
+    """
+    if get_task_type(task) == "local_folder":
+        previous_files = {uri: metadata["fingerprint"] for uri, metadata in previous.items() if "fingerprint" in metadata}
+        async with contextlib.aclosing(scan_local_folder(task, previous_files)) as documents:
+            async for document in documents:
+                yield document
+    else:
+        yield await process_task(task, previous.get(task))
+
+def failed_document(task, task_type: str, error: str, previous: Optional[Dict] = None) -> Document:
+    """
+    An empty document recording why a task failed in its metadata.
+    If an earlier run scraped the same source, its content is kept by marking it not modified.
+    """
+    metadata = {"error": error, "task_type": task_type}
+    if previous:
+        metadata = {**previous, **metadata, "not_modified": True}
+    return create_document("", task, metadata, num_files=0)
+
+def failed_documents(task, task_type: str, error: str, previous: Dict[str, Dict], scraped: Set[str]) -> List[Document]:
+    """
+    Documents for a task that failed after yielding the documents in `scraped`.
+
+    Besides the `failed_document`, a local folder yields each file an earlier run
+    read from it that wasn't scraped before the failure, marked not modified so
+    its chunks are kept.
+    """
+    documents = [failed_document(task, task_type, error, previous.get(task))]
+    if task_type == "local_folder":
+        for uri, metadata in previous.items():
+            if metadata.get("folder") == task and uri not in scraped:
+                documents.append(create_document("", uri, {**metadata, "not_modified": True}, num_files=1))
+    return documents
+
+async def with_timeout(documents: AsyncIterator[Document], timeout: Optional[float]) -> AsyncIterator[Document]:
+    """
+    Pass on documents until `timeout` seconds have been spent producing them.
+    Time the consumer spends between documents is not counted.
+    """
+    loop = asyncio.get_running_loop()
+    remaining = timeout
+    try:
+        while True:
+            start = loop.time()
+            deadline = asyncio.timeout(remaining)
+            try:
+                async with deadline:
+                    document = await anext(documents)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                if deadline.expired():
+                    raise TimeoutError(f"Timed out after {timeout:g}s") from None
+                raise
+            if remaining is not None:
+                remaining -= loop.time() - start
+            yield document
+    finally:
+        await documents.aclose()
+
+class ScrapeScheduler:
+    """
+    Runs scrape tasks with a global concurrency cap and a cap per source.
+
+    Tasks start in TASK_PRIORITY order. Each task has its own timeout, and a task
+    that fails or times out yields its `failed_documents` instead of aborting the others.
+
+    Args:
+        max_concurrency (int): Tasks running at once.
+        source_limits (Dict[str, int]): Tasks running at once per source (see TASK_SOURCES), overriding SOURCE_LIMITS.
+        timeouts (Dict[str, float]): Seconds allowed per task type, overriding TASK_TIMEOUTS. None means no limit.
+    """
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENT_TASKS,
+        source_limits: Optional[Dict[str, int]] = None,
+        timeouts: Optional[Dict[str, Optional[float]]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.source_limits = {**SOURCE_LIMITS, **(source_limits or {})}
+        self.timeouts = {**TASK_TIMEOUTS, **(timeouts or {})}
+
+    def priority(self, task) -> int:
+        try:
+            return TASK_PRIORITY.index(get_task_type(task))
+        except ValueError:
+            # Unsupported tasks fail straight away
+            return -1
+
+    async def run(
+        self,
+        tasks,
+        previous: Optional[Dict[str, Dict]] = None,
+        iterate: Callable[..., AsyncIterator[Document]] = iter_task,
+    ) -> AsyncIterator[Tuple[int, Document]]:
+        """
+        Scrape the tasks and yield each document as soon as it is done, with the position of its task in `tasks`.
+
+        Args:
+            tasks (list): The tasks to scrape.
+            previous (Dict[str, Dict]): Maps document sources to the metadata recorded by an earlier run.
+            iterate (Callable): Yields the documents of one task, given the task and `previous`.
+        """
+        previous = previous or {}
+        global_slots = asyncio.Semaphore(self.max_concurrency)
+        source_slots = {source: asyncio.Semaphore(limit) for source, limit in self.source_limits.items()}
+        # Bounded so that streaming tasks pause while the consumer is busy
+        results: asyncio.Queue = asyncio.Queue(max(len(tasks), 1))
+
+        async def run_task(position, task):
+            try:
+                task_type = get_task_type(task)
+            except ValueError as e:
+                await results.put((position, failed_document(task, "unsupported", str(e))))
+                return
+            source_slot = source_slots.get(TASK_SOURCES.get(task_type)) or contextlib.nullcontext()
+            timeout = self.timeouts.get(task_type, DEFAULT_TASK_TIMEOUT)
+            scraped: Set[str] = set()
+            async with source_slot, global_slots:
+                try:
+                    async for document in with_timeout(iterate(task, previous), timeout):
+                        scraped.add(document.source)
+                        await results.put((position, document))
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    logging.warning(f"Failed to scrape {task}: {error}")
+                    metrics.count("scrape_failures")
+                    for document in failed_documents(task, task_type, error, previous, scraped):
+                        await results.put((position, document))
+
+        async def run_all(pending):
+            try:
+                await asyncio.gather(*pending)
+            finally:
+                # When cancelled the consumer has stopped, so nothing would make room for the end marker
+                if not asyncio.current_task().cancelling():
+                    await results.put(None)
+
+        async with http_client():
+            # Semaphores wake waiters in order, so tasks created first start first
+            order = sorted(range(len(tasks)), key=lambda position: self.priority(tasks[position]))
+            pending = [asyncio.ensure_future(run_task(position, tasks[position])) for position in order]
+            runner = asyncio.ensure_future(run_all(pending))
+            try:
+                while (result := await results.get()) is not None:
+                    yield result
+                await runner
+            finally:
+                for future in pending + [runner]:
+                    future.cancel()
+
+async def scrape_iter(tasks, previous: Optional[Dict[str, Dict]] = None, scheduler: Optional[ScrapeScheduler] = None) -> AsyncIterator[Document]:
+    """
+    Scrape the tasks concurrently and yield each document as soon as it is done.
+    Documents come out in completion order, not task order.
+    `previous` maps a document source to the metadata recorded for it by an earlier run.
+    Failed tasks yield an empty document with an "error" in its metadata.
+    """
+    async with contextlib.aclosing((scheduler or ScrapeScheduler()).run(tasks, previous)) as results:
+        async for _, document in results:
+            yield document
+
+async def scrape_async(tasks, scheduler: Optional[ScrapeScheduler] = None) -> List[Document]:
+    """
+    Scrape the tasks into one document each, in task order.
+    Failed tasks give an empty document with an "error" in its metadata.
+    """
+    async def scrape_one(task, previous):
+        yield await process_task(task)
+
+    results = [result async for result in (scheduler or ScrapeScheduler()).run(tasks, iterate=scrape_one)]
+    processed_data_list = [document for _, document in sorted(results, key=lambda result: result[0])]
+    if TOKEN_COUNT_MODE == "exact":
+        await count_tokens(processed_data_list)
     return processed_data_list
 
 async def scrape(tasks = TEST_TASKS) -> List[Document]:
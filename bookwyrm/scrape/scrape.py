@@ -1,8 +1,11 @@
 import time
 import asyncio
 import logging
-from urllib.parse import urlparse
+from urllib.parse import urldefrag, urljoin, urlparse, urlunparse
+from io import BytesIO
+from bs4 import BeautifulSoup
 from nbconvert import PythonExporter
+from PyPDF2 import PdfReader, PdfWriter
 import nbformat
 
 
@@ -10,13 +13,60 @@ def is_allowed_filetype(filename):
     allowed_extensions = ['.py', '.txt', '.js', '.tsx', '.ts', '.md', '.cjs', '.html', '.json', '.ipynb', '.h', '.localhost', '.sh', '.yaml', '.example']
     return any(filename.endswith(ext) for ext in allowed_extensions)
 
+def convert_ipynb(notebook_content):
+    exporter = PythonExporter()
+    python_code, _ = exporter.from_notebook_node(nbformat.reads(notebook_content, as_version=4))
+    return python_code
+
+def count_pdf_pages(content):
+    return len(PdfReader(BytesIO(content)).pages)
+
+def extract_pdf_pages(content, start=0, stop=None):
+    with BytesIO(content) as pdf_file:
+        pdf_reader = PdfReader(pdf_file)
+        stop = len(pdf_reader.pages) if stop is None else stop
+        return [pdf_reader.pages[i].extract_text() for i in range(start, stop)]
+
+def split_pdf(content, pages_per_part):
+    """
+    Split a PDF into smaller PDFs of at most `pages_per_part` pages each.
+    A part holds only its own pages and the resources they use.
+    """
+    pages = PdfReader(BytesIO(content)).pages
+    parts = []
+    for start in range(0, len(pages), pages_per_part):
+        writer = PdfWriter()
+        for i in range(start, min(start + pages_per_part, len(pages))):
+            writer.add_page(pages[i])
+        with BytesIO() as part:
+            writer.write(part)
+            parts.append(part.getvalue())
+    return parts
+
+def parse_html(html):
+    """
+    Parse a page once and return its text and the href of every link.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    return soup.get_text(), [a["href"] for a in soup.find_all("a", href=True)]
+
 def process_ipynb_file(temp_file):
     with open(temp_file, "r", encoding='utf-8', errors='ignore') as f:
         notebook_content = f.read()
 
-    exporter = PythonExporter()
-    python_code, _ = exporter.from_notebook_node(nbformat.reads(notebook_content, as_version=4))
-    return python_code
+    return convert_ipynb(notebook_content)
+
+def normalize_url(url, base=None):
+    """
+    Resolve `url` against `base` and canonicalize it for de-duplication:
+    drop the fragment, lowercase scheme and host, and strip trailing slashes.
+    """
+    if base:
+        url = urljoin(base, url)
+    url, _ = urldefrag(url)
+    parsed = urlparse(url)
+    path = parsed.path.rstrip('/') or '/'
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), path, parsed.params, parsed.query, ''))
 
 def is_same_domain(base_url, new_url):
     return urlparse(base_url).netloc == urlparse(new_url).netloc
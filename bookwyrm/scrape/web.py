@@ -1,55 +1,185 @@
+import asyncio
+import hashlib
 import logging
-import aiohttp
-from bs4 import BeautifulSoup
-from io import BytesIO
-from PyPDF2 import PdfReader
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
+from bookwyrm import metrics
 from bookwyrm.models import Document
+from .client import http_client
 from .document import create_document
-from .scrape import is_same_domain, is_within_depth
-
-
-async def crawl_and_extract_text(base_url, max_depth=2, include_pdfs=True, ignore_epubs=True) -> Document:
-    async with aiohttp.ClientSession() as session:
-        processed_urls = set()
-        all_text = ""
-
-        async def crawl(url, depth=0):
-            nonlocal all_text
-            if depth > max_depth or url in processed_urls:
-                return
-
-            processed_urls.add(url)
-
-            async with session.get(url) as response:
-                content_type = response.headers.get("Content-Type", "")
-                if "text/html" in content_type:
-                    try:
-                        soup = BeautifulSoup(await response.text(), "html.parser")
-                        text = soup.get_text()
-                        all_text += f"\n\n# URL: {url}\n{text}"
-                          
-                        for link in soup.find_all("a"):
-                            href = link.get("href")
-                            if href and href.startswith("http") and is_same_domain(base_url, href) and is_within_depth(base_url, href, max_depth):
-                                await crawl(href, depth + 1)
-                    except UnicodeDecodeError:
-                        logging.info(f"Skipping URL {url} due to encoding issues.")
-                        all_text += f"\n\n# URL: {url}\nSkipped due to encoding issues."
-                      
-                elif include_pdfs and "application/pdf" in content_type:
-                    content = await response.read()
-                    with BytesIO(content) as file:
-                        reader = PdfReader(file)
-                        text = ""
-                        for page in reader.pages:
-                            text += page.extract_text()
-                    all_text += f"\n\n# PDF URL: {url}\n{text}"
-                elif ignore_epubs and "application/epub" in content_type:
-                    pass
-                else:
-                    all_text += f"\n\n# URL: {url}\nUnsupported content type: {content_type}"
-
-        await crawl(base_url)
-
-        return create_document(all_text, base_url)
+from .executor import extract_pdf_text, run_cpu
+from .scrape import is_same_domain, is_within_depth, normalize_url, parse_html
+
+
+class HostPoliteness:
+    """
+    Limits concurrent requests per host and spaces their start times by `delay` seconds.
+    """
+    def __init__(self, concurrency: int = 2, delay: float = 0.0):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.next_start: Dict[str, float] = {}
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlparse(url).netloc
+        semaphore = self.semaphores.setdefault(host, asyncio.Semaphore(self.concurrency))
+        async with semaphore:
+            now = asyncio.get_running_loop().time()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.delay
+            if start > now:
+                metrics.count("politeness_wait_seconds", start - now)
+                await asyncio.sleep(start - now)
+            yield
+
+
+def section(header, url, text):
+    return f"# {'-' * 3}\n# {header}: {url}\n# {'-' * 3}\n\n{text}\n\n"
+
+
+def conditional_headers(validators: Dict) -> Dict[str, str]:
+    """
+    Request headers that let a server answer 304 if a page hasn't changed since `validators` were recorded.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def text_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def crawl_and_extract_text(
+    base_url,
+    max_depth=2,
+    include_pdfs=True,
+    ignore_epubs=True,
+    previous_metadata: Optional[Dict] = None,
+    workers: int = 8,
+    per_host_concurrency: int = 2,
+    per_host_delay: float = 0.0,
+) -> Document:
+    """
+    Crawl a site breadth-first from `base_url` and extract the text of every page into one document.
+
+    A pool of `workers` pulls URLs from a shared frontier queue. Requests to each
+    host are limited to `per_host_concurrency` at a time, started at least
+    `per_host_delay` seconds apart. URLs are normalized (fragment and trailing
+    slash removed) before de-duplication. Each page becomes its own section of
+    the document, in discovery order, and the page URLs are listed in
+    `metadata["pages"]`.
+
+    Every page's ETag, Last-Modified and text digest are stored in
+    `metadata["page_validators"]`, and the crawlable links found on it in
+    `metadata["page_links"]`. If `previous_metadata` carries them, each page is
+    fetched conditionally. A page answered with 304, or whose text is unchanged,
+    is left out of the text and listed in `metadata["unchanged_files"]` so its
+    chunks can be carried over; the crawl continues through its recorded links.
+    """
+    previous_validators: Dict[str, Dict] = (previous_metadata or {}).get("page_validators", {})
+    previous_links: Dict[str, List[str]] = (previous_metadata or {}).get("page_links", {})
+
+    start_url = normalize_url(base_url)
+    seen: Dict[str, int] = {start_url: 0}
+    # (discovery order, url, section text or None if unchanged)
+    pages: List[Tuple[int, str, Optional[str]]] = []
+    validators: Dict[str, Dict] = {}
+    page_links: Dict[str, List[str]] = {}
+    frontier: asyncio.Queue = asyncio.Queue()
+    politeness = HostPoliteness(per_host_concurrency, per_host_delay)
+
+    def crawlable(link):
+        return link.startswith("http") and is_same_domain(base_url, link) and is_within_depth(base_url, link, max_depth)
+
+    async with http_client() as client:
+        session = client.session
+
+        async def visit(url, order, depth):
+            links: List[str] = []
+            text = None
+            previous = previous_validators.get(url, {})
+            async with politeness.slot(url):
+                async with session.get(url, headers=conditional_headers(previous)) as response:
+                    not_modified = response.status == 304
+                    if not_modified:
+                        links = previous_links.get(url, [])
+                    else:
+                        response.raise_for_status()
+                        content_type = response.headers.get("Content-Type", "")
+                        if "text/html" in content_type:
+                            try:
+                                page_text, hrefs = await run_cpu(parse_html, await response.text())
+                                text = section("URL", url, page_text)
+                                for href in hrefs:
+                                    try:
+                                        link = normalize_url(href, str(response.url))
+                                    except ValueError:
+                                        logging.info(f"Skipping malformed link {href!r} on {url}")
+                                        continue
+                                    if crawlable(link):
+                                        links.append(link)
+                            except UnicodeDecodeError:
+                                logging.info(f"Skipping URL {url} due to encoding issues.")
+                                text = section("URL", url, "Skipped due to encoding issues.")
+                        elif include_pdfs and "application/pdf" in content_type:
+                            text = section("PDF URL", url, await extract_pdf_text(await response.read()))
+                        elif ignore_epubs and "application/epub" in content_type:
+                            pass
+                        else:
+                            text = section("URL", url, f"Unsupported content type: {content_type}")
+                        validators[url] = {
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "digest": None if text is None else text_digest(text),
+                        }
+
+            if not_modified:
+                validators[url] = previous
+            if not_modified or (text is not None and validators[url]["digest"] == previous.get("digest")):
+                metrics.count("web_pages_unchanged")
+                pages.append((order, url, None))
+            elif text is not None:
+                pages.append((order, url, text))
+            if links:
+                page_links[url] = links
+            if depth < max_depth:
+                for link in links:
+                    if link not in seen:
+                        seen[link] = len(seen)
+                        frontier.put_nowait((link, seen[link], depth + 1))
+
+        async def worker():
+            while True:
+                url, order, depth = await frontier.get()
+                try:
+                    await visit(url, order, depth)
+                except Exception as e:
+                    # A worker that dies would leave frontier.join() waiting forever
+                    logging.info(f"Skipping URL {url}: {e!r}")
+                finally:
+                    frontier.task_done()
+
+        await visit(start_url, 0, 0)
+        pool = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            await frontier.join()
+        finally:
+            for task in pool:
+                task.cancel()
+
+    pages.sort()
+    metadata: Dict = {
+        "pages": [url for _, url, _ in pages],
+        "page_validators": {url: validators[url] for _, url, _ in pages},
+        "page_links": page_links,
+        "unchanged_files": [url for _, url, text in pages if text is None],
+    }
+    return create_document("".join(text for _, _, text in pages if text is not None), base_url, metadata)
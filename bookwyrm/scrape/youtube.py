@@ -1,3 +1,4 @@
+import asyncio
 import re
 from youtube_transcript_api import YouTubeTranscriptApi # type: ignore
 from youtube_transcript_api.formatters import TextFormatter # type: ignore
@@ -5,6 +6,10 @@ from youtube_transcript_api.formatters import TextFormatter # type: ignore
 from bookwyrm.models import Document
 from .document import create_document
 
+def get_transcript_text(video_id) -> str:
+    transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
+    return TextFormatter().format_transcript(transcript_list)
+
 async def fetch_youtube_transcript(video_url) -> Document:
 
     def extract_video_id(video_url):
@@ -19,9 +24,8 @@ async def fetch_youtube_transcript(video_url) -> Document:
         raise ValueError("Invalid YouTube video URL")
 
     try:
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-        formatter = TextFormatter()
-        transcript = formatter.format_transcript(transcript_list)
+        # The transcript API is synchronous, so keep its network I/O off the event loop
+        transcript = await asyncio.to_thread(get_transcript_text, video_id)
         return create_document(transcript, video_url)
     except Exception as e:
         raise ValueError(f"Failed to retrieve YouTube transcript: {str(e)}")
@@ -0,0 +1,102 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+# Embedding rows scored per matrix product
+DEFAULT_BLOCK_SIZE = 16384
+# Queries scored together against each block
+QUERY_BLOCK_SIZE = 256
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale vectors to unit L2 norm along the last axis, leaving zero vectors as they are.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def top_k(
+    wyrm,
+    queries: np.ndarray,
+    k: int,
+    rows: Optional[np.ndarray] = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact cosine top-k over a Bookwyrm's embeddings.
+
+    Embeddings are read, dequantized and normalized one block of rows at a time,
+    and queries are scored in blocks too, so memory use is bounded by the block
+    sizes rather than by the corpus or query count. The running best k per query
+    are kept with `np.argpartition`.
+
+    Args:
+        wyrm (Bookwyrm): The Bookwyrm to search.
+        queries (np.ndarray): Query vectors of shape (num_queries, dim).
+        k (int): Number of results per query.
+        rows (np.ndarray): Optional embedding rows to search. Defaults to all rows.
+        block_size (int): Embedding rows scored per matrix product.
+
+    Returns:
+        tuple: (row indices, cosine scores), both of shape (num_queries, k') with
+            k' = min(k, number of rows), best first.
+    """
+    queries = normalize(np.atleast_2d(queries))
+    num_rows = len(wyrm.chunks) if rows is None else len(rows)
+    k = min(k, num_rows)
+    indices = np.zeros((len(queries), k), dtype=np.int64)
+    scores = np.zeros((len(queries), k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+
+    for q in range(0, len(queries), QUERY_BLOCK_SIZE):
+        query_block = queries[q:q + QUERY_BLOCK_SIZE]
+        best_scores = np.empty((len(query_block), 0), dtype=np.float32)
+        best_indices = np.empty((len(query_block), 0), dtype=np.int64)
+        for start in range(0, num_rows, block_size):
+            if rows is None:
+                block_rows = np.arange(start, min(start + block_size, num_rows))
+                block = wyrm.float_embeddings(slice(start, start + block_size))
+            else:
+                block_rows = rows[start:start + block_size]
+                block = wyrm.float_embeddings(block_rows)
+            candidate_scores = np.hstack([best_scores, query_block @ normalize(block).T])
+            candidate_indices = np.hstack([best_indices, np.broadcast_to(block_rows, (len(query_block), len(block_rows)))])
+            if candidate_scores.shape[1] > k:
+                keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+                candidate_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+                candidate_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+            best_scores, best_indices = candidate_scores, candidate_indices
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        scores[q:q + len(query_block)] = np.take_along_axis(best_scores, order, axis=1)
+        indices[q:q + len(query_block)] = np.take_along_axis(best_indices, order, axis=1)
+    return indices, scores
+
+
+async def embed_queries(query: Union[str, List[str]], embedding_model: Optional[str], embedder=None) -> np.ndarray:
+    """
+    Embed query text with the model a corpus was embedded with.
+
+    Args:
+        query (str | List[str]): One query or a list of queries.
+        embedding_model (str): Model id recorded on the corpus, if known.
+        embedder (Embedder | str): Embedder to use. Defaults to one for `embedding_model`.
+
+    Returns:
+        np.ndarray: One vector of shape (dim,) for a single query, or (num_queries, dim).
+    """
+    from .embed import get_embedder, embedder_for_model
+    from .utils import embedding_api
+
+    if embedder is None:
+        if embedding_model is None:
+            raise ValueError("The embedding model of this corpus is unknown; pass an embedder")
+        embedder = embedder_for_model(embedding_model)
+    embedder = get_embedder(embedder)
+    if embedding_model is not None and embedder.model_id != embedding_model:
+        raise ValueError(f"Embedder {embedder.model_id} does not match the corpus model {embedding_model}")
+    queries = [query] if isinstance(query, str) else list(query)
+    vectors = await embedding_api(queries, embedder=embedder)
+    return vectors[0] if isinstance(query, str) else vectors
@@ -0,0 +1,329 @@
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .bookwyrm import WyrmBuilder
+from .models import Bookwyrm, ChunkTable, DocumentRecord, SearchResult, TextChunk
+from .search import embed_queries
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = "bookwyrm-shards"
+MANIFEST_VERSION = 1
+DEFAULT_SHARD_SIZE = 100_000
+
+PathLike = Union[str, os.PathLike]
+
+
+def shard_name(i: int) -> str:
+    return f"shard-{i:05d}.npz"
+
+
+def write_manifest(directory: PathLike, manifest: dict) -> None:
+    # Write to a temporary file first so readers never see a partial manifest
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+class ShardWriter:
+    """
+    Writes a sharded wyrm as chunk batches arrive, keeping at most a few shards in memory.
+
+    Has the same interface as WyrmBuilder, so it can be passed to
+    `process_documents(builder=...)`. Shard i holds the chunks with global index
+    in [i * shard_size, (i + 1) * shard_size). A shard is written as a binary wyrm
+    file as soon as all of its chunks have been embedded, and the manifest listing
+    documents and shards is written by `build`.
+
+    Attributes:
+        directory (str): Directory the manifest and shards are written to.
+        shard_size (int): Chunks per shard.
+        embedding_dtype (str): Storage dtype of the shards' embeddings.
+        build_index (bool): Build and save an IVF index for each shard.
+    """
+    def __init__(
+        self,
+        directory: PathLike,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        embedding_dtype: str = "float32",
+        build_index: bool = False,
+    ):
+        self.directory = os.fspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.shard_size = shard_size
+        self.embedding_dtype = embedding_dtype
+        self.build_index = build_index
+        self.documents: List[DocumentRecord] = []
+        self.pending: Dict[int, WyrmBuilder] = {}
+        self.counts: Dict[int, int] = {}
+        self.shards: List[dict] = []
+
+    def add_document(self, record: DocumentRecord) -> None:
+        self.documents.append(record)
+
+    def add_batch(self, chunks: Union[ChunkTable, List[TextChunk]], embeddings: np.ndarray) -> None:
+        chunks = ChunkTable.coerce(chunks)
+        shard_ids = chunks.columns["global_index"] // self.shard_size
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            shard_id = int(shard_id)
+            builder = self.pending.setdefault(shard_id, WyrmBuilder())
+            builder.add_batch(chunks.take(rows), embeddings[rows])
+            self.counts[shard_id] = self.counts.get(shard_id, 0) + len(rows)
+            if self.counts[shard_id] == self.shard_size:
+                self.flush(shard_id)
+
+    def add_duplicates(self, chunks: Union[ChunkTable, List[TextChunk]], canonical: np.ndarray) -> None:
+        """
+        Add duplicate chunks, whose canonical chunks must be in the same shard (see `Deduplicator.scope`).
+        """
+        chunks = ChunkTable.coerce(chunks)
+        shard_ids = chunks.columns["global_index"] // self.shard_size
+        if np.any(shard_ids != np.asarray(canonical) // self.shard_size):
+            raise ValueError("Duplicate chunks must share embeddings within their shard")
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            shard_id = int(shard_id)
+            self.pending.setdefault(shard_id, WyrmBuilder()).add_duplicates(chunks.take(rows), np.asarray(canonical)[rows])
+            self.counts[shard_id] = self.counts.get(shard_id, 0) + len(rows)
+            if self.counts[shard_id] == self.shard_size:
+                self.flush(shard_id)
+
+    def flush(self, shard_id: int) -> None:
+        """
+        Write one shard to disk and release its memory.
+        """
+        wyrm = self.pending.pop(shard_id).build()
+        if wyrm.embedding_dtype != self.embedding_dtype:
+            wyrm = wyrm.astype(self.embedding_dtype)
+        if self.build_index:
+            wyrm.build_index()
+        wyrm.save(os.path.join(self.directory, shard_name(shard_id)))
+        self.shards.append({
+            "path": shard_name(shard_id),
+            "start": shard_id * self.shard_size,
+            "num_chunks": len(wyrm.chunks),
+            "chunk_offset": 0,
+            "document_offset": 0,
+        })
+        logging.info(f"Wrote shard {shard_id} with {len(wyrm.chunks)} chunks")
+
+    def build(self, embedding_model: Optional[str] = None) -> 'ShardedWyrm':
+        """
+        Write the remaining partial shards and the manifest.
+
+        Returns:
+            ShardedWyrm: A reader for the written corpus.
+        """
+        for shard_id in sorted(self.pending):
+            self.flush(shard_id)
+        self.shards.sort(key=lambda shard: shard["start"])
+        write_manifest(self.directory, {
+            "format": MANIFEST_FORMAT,
+            "version": MANIFEST_VERSION,
+            "embedding_model": embedding_model,
+            "num_chunks": sum(shard["num_chunks"] for shard in self.shards),
+            "documents": [record.dict() for record in sorted(self.documents, key=lambda r: r.index)],
+            "shards": self.shards,
+        })
+        return ShardedWyrm(self.directory)
+
+
+class ShardedWyrm:
+    """
+    Read-only view of a sharded wyrm directory.
+
+    Shards are memory-mapped on first use. Each shard entry in the manifest may
+    carry a chunk and document offset that is added to the indexes stored in the
+    shard, which lets a merged corpus reuse the shard files of its inputs.
+
+    Attributes:
+        directory (str): Directory holding the manifest.
+        documents (List[DocumentRecord]): Records of every document in the corpus.
+        embedding_model (str): Id of the model that produced the embeddings, if known.
+        shards (List[dict]): Manifest entries of the shards, in global index order.
+    """
+    def __init__(self, directory: PathLike):
+        self.directory = os.fspath(directory)
+        with open(os.path.join(self.directory, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != MANIFEST_FORMAT:
+            raise ValueError("Not a sharded bookwyrm directory")
+        if manifest.get("version", 0) > MANIFEST_VERSION:
+            raise ValueError(f"Unsupported shard manifest version: {manifest['version']}")
+        self.embedding_model: Optional[str] = manifest.get("embedding_model")
+        self.documents = [DocumentRecord(**doc) for doc in manifest["documents"]]
+        self.shards: List[dict] = manifest["shards"]
+        self._open: Dict[int, Bookwyrm] = {}
+
+    def __len__(self) -> int:
+        return sum(shard["num_chunks"] for shard in self.shards)
+
+    def shard(self, i: int) -> Bookwyrm:
+        """
+        Open shard i, memory-mapped. Its chunks keep the indexes stored in the shard file.
+        """
+        if i not in self._open:
+            wyrm = Bookwyrm.load(os.path.join(self.directory, self.shards[i]["path"]), mmap=True)
+            wyrm.embedding_model = wyrm.embedding_model or self.embedding_model
+            self._open[i] = wyrm
+        return self._open[i]
+
+    def shift(self, chunk: TextChunk, i: int) -> TextChunk:
+        """
+        Translate a chunk read from shard i to corpus-wide indexes.
+        """
+        entry = self.shards[i]
+        if not entry["chunk_offset"] and not entry["document_offset"]:
+            return chunk
+        return chunk.copy(update={
+            "global_index": chunk.global_index + entry["chunk_offset"],
+            "document_index": chunk.document_index + entry["document_offset"],
+        })
+
+    def iter_shards(self) -> Iterator[Tuple[dict, Bookwyrm]]:
+        """
+        Yield (manifest entry, shard) pairs in global index order.
+        """
+        for i, entry in enumerate(self.shards):
+            yield entry, self.shard(i)
+
+    def iter_chunks(self) -> Iterator[Tuple[TextChunk, np.ndarray]]:
+        """
+        Yield every chunk with its float32 embedding, in global index order.
+        """
+        for i, (_, wyrm) in enumerate(self.iter_shards()):
+            for start in range(0, len(wyrm.chunks), 4096):
+                embeddings = wyrm.float_embeddings(slice(start, start + 4096))
+                for chunk, embedding in zip(wyrm.chunks[start:start + 4096], embeddings):
+                    yield self.shift(chunk, i), embedding
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        k: int = 10,
+        document_index: Union[int, List[int], None] = None,
+        **kwargs,
+    ) -> Union[List[SearchResult], List[List[SearchResult]]]:
+        """
+        Search every shard and merge the results by score.
+
+        Args:
+            query_vectors (np.ndarray): One query vector of shape (dim,) or a batch of shape (num_queries, dim).
+            k (int): Number of results per query. Default is 10.
+            document_index (int | List[int]): Only search chunks of these documents.
+            **kwargs: Passed to `Bookwyrm.search` for each shard.
+
+        Returns:
+            List[SearchResult]: Results for a single query, best first, or one such list per query for a batch.
+        """
+        query_vectors = np.asarray(query_vectors)
+        queries = np.atleast_2d(query_vectors)
+        wanted = None if document_index is None else np.atleast_1d(document_index)
+        records = {record.index: record for record in self.documents}
+        merged: List[List[SearchResult]] = [[] for _ in queries]
+        for i, (entry, wyrm) in enumerate(self.iter_shards()):
+            shard_filter = None if wanted is None else (wanted - entry["document_offset"]).tolist()
+            for hits, results in zip(merged, wyrm.search(queries, k, document_index=shard_filter, **kwargs)):
+                for result in results:
+                    chunk = self.shift(result.chunk, i)
+                    hits.append(SearchResult(chunk=chunk, document=records.get(chunk.document_index), score=result.score))
+        merged = [sorted(hits, key=lambda r: r.score, reverse=True)[:k] for hits in merged]
+        return merged[0] if query_vectors.ndim == 1 else merged
+
+    async def search_text(self, query: Union[str, List[str]], k: int = 10, embedder=None, **kwargs):
+        """
+        Embed query text with the corpus' embedding model and search for it.
+        """
+        vectors = await embed_queries(query, self.embedding_model, embedder)
+        return self.search(vectors, k, **kwargs)
+
+    def to_bookwyrm(self) -> Bookwyrm:
+        """
+        Load the whole corpus into one in-memory Bookwyrm.
+        """
+        tables, embeddings = [], []
+        for entry, wyrm in self.iter_shards():
+            tables.append(wyrm.chunks.replace(
+                global_index=wyrm.chunks.columns["global_index"] + entry["chunk_offset"],
+                document_index=wyrm.chunks.columns["document_index"] + entry["document_offset"],
+            ))
+            embeddings.append(wyrm.float_embeddings())
+        return Bookwyrm(
+            documents=self.documents,
+            chunks=ChunkTable.concat(tables),
+            embeddings=np.concatenate(embeddings) if embeddings else np.array([]),
+            embedding_model=self.embedding_model,
+        )
+
+
+def merge_corpora(sources: List[Union[PathLike, Bookwyrm, ShardedWyrm]], directory: PathLike) -> ShardedWyrm:
+    """
+    Merge several corpora into one sharded wyrm without re-embedding.
+
+    The new manifest references the existing shard and wyrm files with chunk and
+    document offsets, so no embeddings are copied. In-memory Bookwyrms are saved
+    into the new directory as shards first.
+
+    Args:
+        sources (list): Sharded wyrm directories, binary wyrm files, ShardedWyrms or Bookwyrms.
+        directory (str | os.PathLike): Directory for the merged manifest.
+
+    Returns:
+        ShardedWyrm: A reader for the merged corpus.
+    """
+    directory = os.fspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    documents: List[dict] = []
+    shards: List[dict] = []
+    models = set()
+    num_chunks = 0
+    for n, source in enumerate(sources):
+        if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+            source = ShardedWyrm(source)
+        if isinstance(source, ShardedWyrm):
+            entries = [dict(entry, path=os.path.join(source.directory, entry["path"])) for entry in source.shards]
+            records, model = source.documents, source.embedding_model
+        else:
+            if isinstance(source, Bookwyrm):
+                path = os.path.join(directory, f"merged-{n:05d}.npz")
+                source.save(path)
+                wyrm = source
+            else:
+                path = os.fspath(source)
+                wyrm = Bookwyrm.load(path, mmap=True)
+            entries = [{"path": path, "start": 0, "num_chunks": len(wyrm.chunks), "chunk_offset": 0, "document_offset": 0}]
+            records, model = wyrm.documents, wyrm.embedding_model
+        models.add(model)
+
+        document_offset = len(documents)
+        # Offsets only work if records are numbered by position
+        if any(record.index != i for i, record in enumerate(records)):
+            raise ValueError("Document indexes of a merged corpus must be contiguous from 0")
+        documents.extend(record.copy(update={"index": record.index + document_offset}).dict() for record in records)
+        for entry in entries:
+            shards.append({
+                "path": os.path.relpath(entry["path"], directory),
+                "start": num_chunks + entry["start"],
+                "num_chunks": entry["num_chunks"],
+                "chunk_offset": entry["chunk_offset"] + num_chunks,
+                "document_offset": entry["document_offset"] + document_offset,
+            })
+        num_chunks += sum(entry["num_chunks"] for entry in entries)
+
+    models.discard(None)
+    if len(models) > 1:
+        raise ValueError(f"Cannot merge corpora embedded with different models: {sorted(models)}")
+    write_manifest(directory, {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "embedding_model": models.pop() if models else None,
+        "num_chunks": num_chunks,
+        "documents": documents,
+        "shards": shards,
+    })
+    return ShardedWyrm(directory)
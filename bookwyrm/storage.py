@@ -0,0 +1,299 @@
+import base64
+import json
+from contextlib import contextmanager
+from typing import IO, Union
+import os
+import struct
+import zipfile
+import numpy as np
+
+from . import metrics
+from .models import CHUNK_COLUMNS, Bookwyrm, ChunkTable, DocumentRecord
+
+FORMAT_NAME = "bookwyrm"
+FORMAT_VERSION = 3
+
+NDJSON_FORMAT_NAME = "bookwyrm-ndjson"
+NDJSON_FORMAT_VERSION = 1
+# Chunks and embedding rows serialized at a time by `write_ndjson`
+NDJSON_BLOCK = 4096
+
+PathLike = Union[str, os.PathLike]
+
+
+@metrics.timed("serialize.binary")
+def save_wyrm(bookwyrm: Bookwyrm, path: PathLike) -> None:
+    """
+    Write a Bookwyrm to a binary wyrm file.
+
+    The file is an uncompressed npz archive with a JSON header (documents and
+    format info), the embeddings matrix in the Bookwyrm's embedding dtype (plus
+    per-dimension scales for int8, and the embedding row of every chunk if
+    duplicate chunks share rows), chunk text as a UTF-8 byte column plus
+    offsets, and one int64 column per integer chunk field.
+
+    Args:
+        bookwyrm (Bookwyrm): The Bookwyrm to write.
+        path (str | os.PathLike): Destination file path.
+    """
+    chunks = ChunkTable.coerce(bookwyrm.chunks).compact()
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "num_chunks": len(chunks),
+        "embedding_dtype": bookwyrm.embedding_dtype,
+        "embedding_model": bookwyrm.embedding_model,
+        "documents": [doc.dict() for doc in bookwyrm.documents],
+    }
+    header_bytes = np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8)
+    extra = {}
+    if bookwyrm.embedding_scales is not None:
+        extra["embedding_scales"] = np.asarray(bookwyrm.embedding_scales, dtype=np.float32)
+    if bookwyrm.embedding_rows is not None:
+        extra["embedding_rows"] = np.asarray(bookwyrm.embedding_rows, dtype=np.int64)
+
+    # Pass an open file so numpy does not append ".npz" to the path
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            header=header_bytes,
+            embeddings=np.asarray(bookwyrm.embeddings, dtype=bookwyrm.embedding_dtype),
+            chunk_text=chunks.text,
+            chunk_offsets=chunks.offsets,
+            **{name: np.asarray(chunks.columns[name], dtype=np.int64) for name in CHUNK_COLUMNS},
+            **extra,
+        )
+
+
+def read_header(archive) -> dict:
+    """
+    Parse and validate the JSON header of an open wyrm archive.
+    """
+    header = json.loads(bytes(archive["header"]).decode("utf-8"))
+    if header.get("format") != FORMAT_NAME:
+        raise ValueError("Not a bookwyrm file")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"Unsupported bookwyrm format version: {header['version']}")
+    return header
+
+
+def memmap_member(path: PathLike, info: zipfile.ZipInfo) -> np.ndarray:
+    """
+    Memory-map one .npy member of an uncompressed npz archive in place.
+
+    Args:
+        path (str | os.PathLike): Path to the npz archive.
+        info (zipfile.ZipInfo): Entry of the member to map.
+
+    Returns:
+        np.ndarray: Read-only memory-mapped array.
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"Cannot memory-map compressed member {info.filename}")
+    with open(path, "rb") as f:
+        # The local file header is 30 bytes followed by the name and extra field
+        f.seek(info.header_offset)
+        name_len, extra_len = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    order = "F" if fortran_order else "C"
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order=order)
+
+
+def open_wyrm(path: PathLike) -> Bookwyrm:
+    """
+    Open a binary wyrm file read-only without loading it into memory.
+
+    The embeddings matrix and chunk columns are memory-mapped, so startup time
+    is independent of corpus size and processes opening the same file share
+    its pages. Chunks are a ChunkTable over the mapped columns.
+
+    Args:
+        path (str | os.PathLike): Path to the wyrm file.
+
+    Returns:
+        Bookwyrm: A read-only Bookwyrm backed by the file.
+    """
+    with np.load(path) as archive:
+        header = read_header(archive)
+    with zipfile.ZipFile(path) as zf:
+        infos = {info.filename[:-len(".npy")]: info for info in zf.infolist()}
+    columns = {name: memmap_member(path, info) for name, info in infos.items() if name != "header"}
+
+    chunks = ChunkTable(
+        columns["chunk_text"],
+        columns["chunk_offsets"],
+        {name: columns[name] for name in CHUNK_COLUMNS if name in columns},
+    )
+    documents = [DocumentRecord(**doc) for doc in header["documents"]]
+    # Skip validation, which would copy the mapped embeddings
+    return Bookwyrm.construct(
+        documents=documents,
+        chunks=chunks,
+        embeddings=columns["embeddings"],
+        embedding_dtype=header.get("embedding_dtype", "float32"),
+        embedding_scales=columns.get("embedding_scales"),
+        embedding_model=header.get("embedding_model"),
+        embedding_rows=columns.get("embedding_rows"),
+    )
+
+
+def load_wyrm(path: PathLike) -> Bookwyrm:
+    """
+    Read a Bookwyrm from a binary wyrm file written by `save_wyrm`.
+
+    Args:
+        path (str | os.PathLike): Path to the wyrm file.
+
+    Returns:
+        Bookwyrm: The loaded Bookwyrm.
+    """
+    with np.load(path) as archive:
+        header = read_header(archive)
+        embeddings = archive["embeddings"]
+        chunk_text = archive["chunk_text"]
+        chunk_offsets = archive["chunk_offsets"]
+        columns = {name: archive[name] for name in CHUNK_COLUMNS if name in archive}
+        scales = archive["embedding_scales"] if "embedding_scales" in archive else None
+        rows = archive["embedding_rows"] if "embedding_rows" in archive else None
+
+    documents = [DocumentRecord(**doc) for doc in header["documents"]]
+    chunks = ChunkTable(chunk_text, chunk_offsets, columns)
+    return Bookwyrm(
+        documents=documents,
+        chunks=chunks,
+        embeddings=embeddings,
+        embedding_dtype=header.get("embedding_dtype", "float32"),
+        embedding_scales=scales,
+        embedding_model=header.get("embedding_model"),
+        embedding_rows=rows,
+    )
+
+
+@contextmanager
+def text_file(file: Union[PathLike, IO[str]], mode: str):
+    """
+    Open a path as a UTF-8 text file, or use an already open file handle as is.
+    """
+    if hasattr(file, "read") or hasattr(file, "write"):
+        yield file
+    else:
+        with open(file, mode, encoding="utf-8") as f:
+            yield f
+
+
+@metrics.timed("serialize.ndjson")
+def write_ndjson(bookwyrm: Bookwyrm, file: Union[PathLike, IO[str]]) -> None:
+    """
+    Stream a Bookwyrm to newline-delimited JSON, one record per line.
+
+    A header line is followed by one line per document, then one per chunk,
+    then one per embedding row, written a block at a time so the serialized
+    form is never held in memory. Embedding rows are base64-encoded
+    little-endian float32, one per chunk in chunk order, whatever the
+    Bookwyrm's storage dtype or shared duplicate rows.
+
+    Args:
+        bookwyrm (Bookwyrm): The Bookwyrm to write.
+        file (str | os.PathLike | IO[str]): Destination path or text file handle.
+    """
+    chunks = ChunkTable.coerce(bookwyrm.chunks)
+    num_chunks = len(chunks)
+    dimensions = bookwyrm.embeddings.shape[1] if bookwyrm.embeddings.ndim == 2 else 0
+    header = {
+        "type": "header",
+        "format": NDJSON_FORMAT_NAME,
+        "version": NDJSON_FORMAT_VERSION,
+        "num_documents": len(bookwyrm.documents),
+        "num_chunks": num_chunks,
+        "dimensions": dimensions,
+        "embedding_model": bookwyrm.embedding_model,
+    }
+    with text_file(file, "w") as f:
+        f.write(json.dumps(header) + "\n")
+        for doc in bookwyrm.documents:
+            f.write(json.dumps({"type": "document", **doc.dict()}) + "\n")
+        for start in range(0, num_chunks, NDJSON_BLOCK):
+            f.writelines(json.dumps({"type": "chunk", **chunk}) + "\n" for chunk in chunks[start:start + NDJSON_BLOCK].to_dicts())
+        for start in range(0, num_chunks, NDJSON_BLOCK):
+            block = bookwyrm.float_embeddings(slice(start, start + NDJSON_BLOCK)).astype("<f4", copy=False)
+            f.writelines(
+                json.dumps({"type": "embedding", "index": start + i, "embedding": base64.b64encode(row.tobytes()).decode("ascii")}) + "\n"
+                for i, row in enumerate(block)
+            )
+
+
+@metrics.timed("deserialize.ndjson")
+def read_ndjson(file: Union[PathLike, IO[str]]) -> Bookwyrm:
+    """
+    Read a Bookwyrm from newline-delimited JSON written by `write_ndjson`.
+
+    Lines are parsed one at a time into packed chunk columns and a preallocated
+    float32 embeddings matrix. A stream that doesn't hold exactly the documents,
+    chunks and embedding rows its header announces, for example one cut short
+    by a killed writer, is rejected.
+
+    Args:
+        file (str | os.PathLike | IO[str]): Source path or text file handle.
+
+    Returns:
+        Bookwyrm: The loaded Bookwyrm, with float32 embeddings.
+
+    Raises:
+        ValueError: If the file is not bookwyrm NDJSON or is truncated or inconsistent.
+    """
+    with text_file(file, "r") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != NDJSON_FORMAT_NAME:
+            raise ValueError("Not a bookwyrm NDJSON file")
+        if header.get("version", 0) > NDJSON_FORMAT_VERSION:
+            raise ValueError(f"Unsupported bookwyrm NDJSON version: {header['version']}")
+        num_chunks = header["num_chunks"]
+        documents = []
+        text = bytearray()
+        offsets = [0]
+        columns = {name: [] for name in CHUNK_COLUMNS}
+        embeddings = np.zeros((num_chunks, header["dimensions"]), dtype=np.float32)
+        received = np.zeros(num_chunks, dtype=bool)
+        for line in f:
+            record = json.loads(line)
+            kind = record.pop("type")
+            if kind == "document":
+                documents.append(DocumentRecord(**record))
+            elif kind == "chunk":
+                text += record.pop("text").encode("utf-8")
+                offsets.append(len(text))
+                for name, values in columns.items():
+                    values.append(record[name])
+            elif kind == "embedding":
+                index = record["index"]
+                if not 0 <= index < num_chunks or received[index]:
+                    raise ValueError(f"Unexpected or repeated embedding row {index}")
+                embeddings[index] = np.frombuffer(base64.b64decode(record["embedding"]), dtype="<f4")
+                received[index] = True
+
+    if len(documents) != header.get("num_documents", len(documents)):
+        raise ValueError(f"Expected {header['num_documents']} documents, found {len(documents)}")
+    if len(offsets) - 1 != num_chunks:
+        raise ValueError(f"Expected {num_chunks} chunks, found {len(offsets) - 1}")
+    # Missing rows would otherwise load as zero vectors
+    if not received.all():
+        raise ValueError(f"Expected {num_chunks} embedding rows, found {int(received.sum())}")
+    chunks = ChunkTable(
+        np.frombuffer(bytes(text), dtype=np.uint8),
+        np.array(offsets, dtype=np.int64),
+        {name: np.array(values, dtype=np.int64) for name, values in columns.items()},
+    )
+    return Bookwyrm(
+        documents=documents,
+        chunks=chunks,
+        embeddings=embeddings if num_chunks else np.array([]),
+        embedding_model=header.get("embedding_model"),
+    )
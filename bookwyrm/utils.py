@@ -1,36 +1,60 @@
 import numpy as np
-import replicate # type: ignore
-import json 
 import tiktoken
-import asyncio
-from tqdm import tqdm
+from functools import lru_cache
+from . import metrics
+
+ENCODING_NAME = "cl100k_base"
+# Rough average for English text and code, used when exact counts aren't needed
+CHARS_PER_TOKEN = 4
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.get_encoding(ENCODING_NAME)
 
 def get_token_count(text):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(text))
-    return num_tokens
+    return len(get_encoding().encode_ordinary(text))
+
+def estimate_token_count(text):
+    return len(text) // CHARS_PER_TOKEN
+
+def encode_batch(texts, num_threads=8):
+    """
+    Tokenize several texts at once with tiktoken's threaded batch encoder.
 
-async def embedding_api(texts, batch_size=200):
-    all_embeddings = []
+    Returns:
+        list: One int64 array of token ids per text.
+    """
+    batches = get_encoding().encode_ordinary_batch(texts, num_threads=num_threads)
+    return [np.array(tokens, dtype=np.int64) for tokens in batches]
 
-    async def fetch_embeddings(batch_texts):
-        resp = await replicate.async_run(
-            "replicate/all-mpnet-base-v2:b6b7585c9640cd7a9572c6e129c9549d79c9c31f0d3fdce7baac7c67ca38f305",
-            input={"text_batch": json.dumps(batch_texts)},
-        )
-        return [o['embedding'] for o in resp]
+async def embedding_api(texts, batch_size=200, cache=None, embedder=None, dispatcher=None):
+    """
+    Embed texts with an Embedder (Replicate by default), batching the requests.
 
-    tasks = []
-    for i in tqdm(range(0, len(texts), batch_size), desc="Embedding batches"):
-        batch_texts = texts[i:i + batch_size]
-        tasks.append(fetch_embeddings(batch_texts))
+    Batches are sent through an EmbeddingDispatcher, which bounds concurrency
+    and retries failures. Pass one to share its limits and checkpoints across calls.
 
-    results = await asyncio.gather(*tasks)
+    If an EmbeddingCache is given, only the texts missing from it are sent to
+    the model; the results are stored in the cache and merged back in order.
+    """
+    from .dispatch import EmbeddingDispatcher
 
-    for result in results:
-        all_embeddings.extend(result)
+    if dispatcher is None:
+        dispatcher = EmbeddingDispatcher(embedder, batch_size=batch_size)
+    model_id = dispatcher.embedder.model_id
+    if cache is not None:
+        cached = cache.get_many(model_id, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+        num_misses = sum(vector is None for vector in cached)
+        metrics.count("cache_hits", len(texts) - num_misses)
+        metrics.count("cache_misses", num_misses)
+        if missing:
+            fetched = dict(zip(missing, await dispatcher.run(missing)))
+            cache.put_many(model_id, missing, list(fetched.values()))
+            cached = [fetched[text] if vector is None else vector for text, vector in zip(texts, cached)]
+        return np.array(cached)
 
-    return np.array(all_embeddings)
+    return await dispatcher.run(texts)
 
 TEST_TASKS = [
         # "./data/",
@@ -3,17 +3,38 @@
 
 from typing import List
 import asyncio
-from cog import BasePredictor, Input # type: ignore
+from cog import BasePredictor, Input, Path # type: ignore
 
 
 from bookwyrm import process_documents
+from bookwyrm.metrics import Metrics, collecting
 from bookwyrm.utils import TEST_TASKS
 
 class Predictor(BasePredictor):
     def predict( # type: ignore
         self,
-        urls: List[str] = Input(description="List of URLs to process.", default=TEST_TASKS)
+        urls: List[str] = Input(description="List of URLs to process.", default=TEST_TASKS),
+        output_format: str = Input(description="Output format: JSON string, streamed NDJSON file, or compact binary wyrm file.", choices=["json", "ndjson", "binary"], default="json"),
+        embedder: str = Input(description="Embedding backend: hosted Replicate model, local CPU model, or deterministic hash fake.", choices=["replicate", "local", "hash"], default="replicate"),
+        embedding_dtype: str = Input(description="Storage dtype of the embeddings: float32, half-size float16, or quarter-size int8 with per-dimension scales.", choices=["float32", "float16", "int8"], default="float32"),
+        dedup: bool = Input(description="Don't embed exact or near-duplicate chunks; they share the embedding of the first copy.", default=False),
+        metrics_format: str = Input(description="Also return per-stage timings and counters (requests, bytes, chunks, tokens, embedding batches, cache hits) as JSON or Prometheus text.", choices=["none", "json", "prometheus"], default="none"),
     ) -> dict:
+        metrics = Metrics() if metrics_format != "none" else None
         loop = asyncio.get_event_loop()
-        output = loop.run_until_complete(process_documents(urls))
-        return {"output": output.to_json()}
+        output = loop.run_until_complete(process_documents(urls, embedder=embedder, embedding_dtype=embedding_dtype, metrics=metrics, dedup=dedup))
+        with collecting(metrics):
+            if output_format == "binary":
+                path = Path("/tmp/wyrm.npz")
+                output.save(path)
+                result = {"output": path}
+            elif output_format == "ndjson":
+                path = Path("/tmp/wyrm.ndjson")
+                output.to_ndjson(path)
+                result = {"output": path}
+            else:
+                result = {"output": output.to_json()}
+        if metrics is not None:
+            report = metrics.report()
+            result["metrics"] = report.to_json() if metrics_format == "json" else report.to_prometheus()
+        return result
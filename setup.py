@@ -7,7 +7,7 @@ with open('requirements.txt', encoding='utf-8') as f:
 setup(
     name="bookwyrm",
     version="0.2.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=requirements,
     include_package_data=True,
 )
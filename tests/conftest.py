@@ -0,0 +1,12 @@
+import pytest
+
+from bookwyrm.scrape import executor
+
+
+@pytest.fixture(autouse=True)
+def inline_executor():
+    # Parse on the event loop, so tests don't start worker processes
+    kind, workers = executor.EXECUTOR_KIND, executor.MAX_WORKERS
+    executor.configure_executor("inline")
+    yield
+    executor.configure_executor(kind, workers)
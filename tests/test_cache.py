@@ -0,0 +1,49 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from bookwyrm.cache import EmbeddingCache
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.models import Bookwyrm, ChunkTable
+
+LICENSE = "Licensed under the MIT license."
+
+
+def stored_bytes(cache: EmbeddingCache) -> int:
+    return cache.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+
+def make_wyrm(texts, model="hash-8") -> Bookwyrm:
+    embeddings = asyncio.run(HashEmbedder(dim=8).embed(texts))
+    return Bookwyrm(documents=[], chunks=ChunkTable.from_texts(texts), embeddings=embeddings, embedding_model=model)
+
+
+def test_repeated_texts_are_counted_once(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    vectors = np.ones((3, 8), dtype=np.float32)
+    cache.put_many("hash-8", [LICENSE, "main()", LICENSE], vectors)
+    cache.put_many("hash-8", [LICENSE], vectors[:1])
+
+    assert cache.total_bytes == stored_bytes(cache) == 2 * vectors[0].nbytes
+
+
+def test_warm_with_boilerplate_keeps_live_entries(tmp_path):
+    texts = [LICENSE, "def hoard(): pass", LICENSE, "class Wyrm: pass", LICENSE]
+    wyrm = make_wyrm(texts)
+    # Exactly room for the three distinct texts
+    cache = EmbeddingCache(str(tmp_path), max_bytes=3 * 8 * 4)
+    cache.warm(wyrm)
+
+    found = cache.get_many("hash-8", texts)
+    assert all(vector is not None for vector in found)
+    np.testing.assert_array_equal(np.stack(found), wyrm.float_embeddings())
+    assert cache.total_bytes == stored_bytes(cache)
+
+
+def test_warm_needs_a_model(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    with pytest.raises(ValueError):
+        cache.warm(make_wyrm(["text"], model=None))
+    cache.warm(make_wyrm(["text"], model=None), model="hash-8")
+    assert cache.get_many("hash-8", ["text"])[0] is not None
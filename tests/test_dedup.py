@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+
+import numpy as np
+import pytest
+
+from bookwyrm.bookwyrm import process_documents
+from bookwyrm.dedup import Deduplicator, deduplicate, minhash_signatures
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.models import ChunkTable
+
+LONG = "The wyrm counts its hoard every night, coin by coin, and never loses track of a single one. " * 3
+
+
+def table(texts, first_global=0) -> ChunkTable:
+    return ChunkTable.from_texts(texts, global_index=first_global + np.arange(len(texts)))
+
+
+class RecordingEmbedder(HashEmbedder):
+    def __init__(self):
+        super().__init__(dim=16)
+        self.texts = []
+
+    async def embed(self, texts):
+        self.texts.extend(texts)
+        return await super().embed(texts)
+
+
+def test_exact_duplicates_share_the_first_row():
+    unique_rows, embedding_rows = deduplicate(table(["a", "b", "a", "c", "b", "a"]))
+    np.testing.assert_array_equal(unique_rows, [0, 1, 3])
+    np.testing.assert_array_equal(embedding_rows, [0, 1, 0, 2, 1, 0])
+
+
+def test_near_duplicates_need_long_similar_text():
+    edited = LONG.replace("single", "sangle", 1)
+    short = "coin by coin"
+    deduplicator = Deduplicator()
+    canonical = deduplicator.find(table([LONG, edited, "A different text entirely. " * 8, short, short + "!"]))
+
+    np.testing.assert_array_equal(canonical, [0, 0, 2, 3, 4])
+    stats = deduplicator.stats()
+    assert stats["near_duplicates"] == 1 and stats["exact_duplicates"] == 0
+    assert stats["bytes_skipped"] == len(edited.encode("utf-8"))
+
+
+def test_identical_texts_get_identical_signatures():
+    signatures = minhash_signatures(table([LONG, LONG, "short"]))
+    np.testing.assert_array_equal(signatures[0], signatures[1])
+    assert np.all(signatures[2] == np.iinfo(np.uint32).max)
+
+
+def test_deduplicator_remembers_earlier_calls_within_scope():
+    deduplicator = Deduplicator(scope=4)
+    deduplicator.find(table(["x", "y"]))
+    np.testing.assert_array_equal(deduplicator.find(table(["y", "x"], first_global=2)), [1, 0])
+    # Global indexes 4 and up are another shard, so they don't match the first one
+    np.testing.assert_array_equal(deduplicator.find(table(["x", "x"], first_global=4)), [4, 4])
+
+
+def test_deduplicate_needs_a_fresh_deduplicator():
+    deduplicator = Deduplicator()
+    deduplicator.find(table(["x"]))
+    with pytest.raises(ValueError):
+        deduplicate(table(["x"], first_global=1), deduplicator)
+
+
+def test_process_documents_shares_embedding_rows(tmp_path):
+    # Lines unlike each other, so only the copied file is a duplicate. Same-length
+    # names make both copies chunk at the same offsets after their headers.
+    body = "\n".join(f"Line {i}: " + hashlib.sha256(str(i).encode()).hexdigest() * 2 for i in range(100))
+    for name in ("a.txt", "b.txt"):
+        (tmp_path / name).write_text(body)
+    (tmp_path / "c.txt").write_text("Something else.\n")
+
+    embedder = RecordingEmbedder()
+    wyrm = asyncio.run(process_documents([str(tmp_path)], embedder=embedder, dedup=True))
+    plain = asyncio.run(process_documents([str(tmp_path)], embedder=HashEmbedder(dim=16)))
+
+    texts = wyrm.chunks.texts()
+    assert sorted(texts) == sorted(plain.chunks.texts())
+    assert len(embedder.texts) == len(set(embedder.texts)) == len(wyrm.embeddings)
+    assert wyrm.embedding_rows is not None and len(wyrm.embeddings) == len(set(texts)) - 1
+    # The copy's first chunk only differs by the file name in its header, so it is a near-duplicate
+    near = [i for i, text in enumerate(texts) if text not in set(embedder.texts)]
+    assert len(near) == 1 and "Filename" in texts[near[0]]
+    embeddings = wyrm.float_embeddings()
+    for i, text in enumerate(texts):
+        if i not in near:
+            np.testing.assert_allclose(embeddings[i], HashEmbedder(dim=16).vector(text), rtol=1e-6)
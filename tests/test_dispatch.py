@@ -0,0 +1,67 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from bookwyrm.dispatch import EmbeddingDispatcher, EmbeddingError
+from bookwyrm.embed import HashEmbedder
+
+TEXTS = [f"text number {i}" for i in range(20)]
+
+
+class FlakyEmbedder(HashEmbedder):
+    """
+    Hash embedder that records every batch and fails any batch containing a text in `failing`.
+    """
+    def __init__(self, failing=()):
+        super().__init__(dim=8)
+        self.failing = set(failing)
+        self.batches = []
+
+    async def embed(self, texts):
+        self.batches.append(list(texts))
+        if self.failing.intersection(texts):
+            raise RuntimeError("backend unavailable")
+        return await super().embed(texts)
+
+
+def test_batches_are_bounded_and_in_order():
+    dispatcher = EmbeddingDispatcher(HashEmbedder(dim=8), batch_size=3)
+    batches = dispatcher.batches(TEXTS)
+    assert all(b.stop - b.start <= 3 for b in batches)
+    assert [i for b in batches for i in range(b.start, b.stop)] == list(range(len(TEXTS)))
+
+    embeddings = asyncio.run(dispatcher.run(TEXTS))
+    np.testing.assert_array_equal(embeddings, asyncio.run(HashEmbedder(dim=8).embed(TEXTS)))
+
+
+def test_failed_batch_raises_after_retries():
+    embedder = FlakyEmbedder(failing={TEXTS[4]})
+    dispatcher = EmbeddingDispatcher(embedder, batch_size=5, retries=2, backoff=0.0)
+    with pytest.raises(EmbeddingError, match="1 of 4 embedding batches failed"):
+        asyncio.run(dispatcher.run(TEXTS))
+    assert sum(TEXTS[4] in batch for batch in embedder.batches) == 3
+
+
+def test_rerun_only_embeds_what_the_checkpoint_is_missing(tmp_path):
+    failing = FlakyEmbedder(failing={TEXTS[7]})
+    dispatcher = EmbeddingDispatcher(failing, batch_size=5, retries=0, checkpoint_dir=str(tmp_path))
+    with pytest.raises(EmbeddingError, match=str(tmp_path)):
+        asyncio.run(dispatcher.run(TEXTS))
+
+    # Batched differently on the rerun, so the checkpoint is looked up by text
+    embedder = FlakyEmbedder()
+    dispatcher = EmbeddingDispatcher(embedder, batch_size=2, checkpoint_dir=str(tmp_path))
+    embeddings = asyncio.run(dispatcher.run(TEXTS))
+
+    assert sorted(text for batch in embedder.batches for text in batch) == TEXTS[5:10]
+    np.testing.assert_array_equal(embeddings, asyncio.run(HashEmbedder(dim=8).embed(TEXTS)))
+
+
+def test_checkpoint_is_keyed_by_model(tmp_path):
+    asyncio.run(EmbeddingDispatcher(HashEmbedder(dim=8), checkpoint_dir=str(tmp_path)).run(TEXTS))
+
+    embedder = FlakyEmbedder()
+    embedder.model_id = "another-model"
+    asyncio.run(EmbeddingDispatcher(embedder, checkpoint_dir=str(tmp_path)).run(TEXTS))
+    assert sum(len(batch) for batch in embedder.batches) == len(TEXTS)
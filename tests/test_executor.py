@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from benchmarks.loop_stall import make_pdf
+from bookwyrm.scrape import executor
+from bookwyrm.scrape.scrape import count_pdf_pages, extract_pdf_pages, split_pdf
+
+PDF = make_pdf(40, lines_per_page=5)
+
+
+def test_split_pdf_keeps_every_page_once():
+    parts = split_pdf(PDF, 16)
+    assert [count_pdf_pages(part) for part in parts] == [16, 16, 8]
+    assert all(len(part) < len(PDF) for part in parts)
+    assert [text for part in parts for text in extract_pdf_pages(part)] == extract_pdf_pages(PDF)
+
+
+@pytest.mark.parametrize("kind", ["inline", "thread", "process"])
+def test_pdf_text_is_the_same_with_every_executor(kind):
+    executor.configure_executor(kind, max_workers=2)
+    text = asyncio.run(executor.extract_pdf_text(PDF, pages_per_task=7))
+    assert text == " ".join(extract_pdf_pages(PDF))
+
+
+def test_process_tasks_are_sent_their_own_pages(monkeypatch):
+    calls = []
+
+    async def run_cpu(func, *args):
+        calls.append((func, args))
+        return func(*args)
+
+    monkeypatch.setattr(executor, "EXECUTOR_KIND", "process")
+    monkeypatch.setattr(executor, "run_cpu", run_cpu)
+    asyncio.run(executor.extract_pdf_text(PDF, pages_per_task=10))
+
+    # The whole file is pickled once, to be split
+    assert [func for func, args in calls if PDF in args] == [split_pdf]
+    pages = [args[0] for func, args in calls if func is extract_pdf_pages]
+    assert [count_pdf_pages(pdf) for pdf in pages] == [10, 10, 10, 10]
@@ -0,0 +1,165 @@
+import asyncio
+import gzip
+import io
+import json
+import tarfile
+
+from benchmarks.offline import StandInServer
+from bookwyrm.process import split_sections
+from bookwyrm.scrape import github
+from bookwyrm.scrape.client import http_client
+from bookwyrm.scrape.github import git_blob_sha, process_github_repo
+
+REPO = "octo/wyrm"
+FILES = {
+    "README.md": "# Wyrm\n\nA small repo.\n",
+    "pkg/core.py": "def hoard():\n    return 'gold'\n",
+    "docs/guide.md": "# Guide\n\nFeed the wyrm.\n",
+    "assets/logo.png": "not really a png",
+    "LICENSE": "MIT",
+}
+
+
+def make_tarball(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path, text in files.items():
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(f"octo-wyrm-abc1234/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue())
+
+
+def contents_routes(base_url, files, directory=""):
+    """
+    Contents API listings and raw downloads for `files` under `directory`.
+    """
+    routes = {}
+    listing = []
+    prefix = f"{directory}/" if directory else ""
+    for path, text in files.items():
+        if not path.startswith(prefix):
+            continue
+        data = text.encode("utf-8")
+        routes[f"/raw/{REPO}/{path}"] = (200, {"Content-Type": "text/plain"}, data)
+        listing.append({
+            "type": "file", "name": path.rsplit("/", 1)[-1], "path": path,
+            "sha": git_blob_sha(data), "download_url": f"{base_url}/raw/{REPO}/{path}",
+        })
+    return routes, listing
+
+
+def run_with_server(routes_for, coroutine_for):
+    async def run():
+        server = StandInServer()
+        await server.start()
+        base_url = github.API_BASE_URL
+        github.API_BASE_URL = server.base_url
+        try:
+            server.routes = routes_for(server.base_url)
+            return await coroutine_for(), server.requests
+        finally:
+            github.API_BASE_URL = base_url
+            await server.stop()
+    return asyncio.run(run())
+
+
+def test_repo_is_fetched_as_one_tarball():
+    def routes(base_url):
+        return {f"/repos/{REPO}/tarball": (200, {"Content-Type": "application/x-gzip"}, make_tarball(FILES))}
+
+    document, requests = run_with_server(routes, lambda: process_github_repo(f"https://github.com/{REPO}"))
+
+    assert requests["github"] == 1
+    allowed = {"README.md", "pkg/core.py", "docs/guide.md"}
+    assert set(document.metadata["files"]) == allowed
+    for path in allowed:
+        assert f"# Filename: {path}\n" in document.text
+        assert FILES[path] in document.text
+    assert "logo.png" not in document.text and "LICENSE" not in document.text
+
+
+def test_tarball_fingerprints_are_blob_shas_and_skip_unchanged_files():
+    def routes(base_url):
+        return {f"/repos/{REPO}/tarball": (200, {"Content-Type": "application/x-gzip"}, make_tarball(FILES))}
+
+    previous = {"README.md": git_blob_sha(FILES["README.md"].encode("utf-8")), "pkg/core.py": "0" * 40}
+    document, _ = run_with_server(routes, lambda: process_github_repo(f"https://github.com/{REPO}", previous))
+
+    assert document.metadata["files"]["pkg/core.py"] == git_blob_sha(FILES["pkg/core.py"].encode("utf-8"))
+    assert document.metadata["unchanged_files"] == ["README.md"]
+    assert "# Filename: README.md" not in document.text
+    assert "# Filename: pkg/core.py" in document.text
+
+
+def test_one_crawl_is_shared_by_requests_with_and_without_previous_files():
+    def routes(base_url):
+        return {f"/repos/{REPO}/tarball": (200, {"Content-Type": "application/x-gzip"}, make_tarball(FILES))}
+
+    previous = {"README.md": git_blob_sha(FILES["README.md"].encode("utf-8"))}
+
+    async def both():
+        # A PR or issue task passes no previous files; the repo task passes the last run's
+        async with http_client():
+            return await asyncio.gather(
+                process_github_repo(f"https://github.com/{REPO}"),
+                process_github_repo(f"https://github.com/{REPO}", previous),
+            )
+
+    (full, incremental), requests = run_with_server(routes, both)
+
+    assert requests["github"] == 1
+    assert full.metadata["unchanged_files"] == [] and "# Filename: README.md" in full.text
+    assert incremental.metadata["unchanged_files"] == ["README.md"]
+    assert "# Filename: README.md" not in incremental.text and "# Filename: pkg/core.py" in incremental.text
+
+
+def test_subdirectory_uses_contents_api():
+    def routes(base_url):
+        routes, listing = contents_routes(base_url, FILES, "docs")
+        routes[f"/repos/{REPO}/contents/docs?ref=main"] = (200, {"Content-Type": "application/json"}, json.dumps(listing).encode("utf-8"))
+        return routes
+
+    document, requests = run_with_server(routes, lambda: process_github_repo(f"https://github.com/{REPO}/tree/main/docs"))
+
+    assert set(document.metadata["files"]) == {"docs/guide.md"}
+    assert FILES["docs/guide.md"] in document.text
+    # One listing plus one download, and no tarball
+    assert requests["github"] == 2
+
+
+def test_contents_api_keeps_same_named_files_apart():
+    files = {"README.md": "# Top\n", "docs/README.md": "# Docs\n", "pkg/README.md": "# Package\n"}
+
+    def routes(base_url):
+        routes = {}
+        for directory in ("", "docs", "pkg"):
+            in_directory = {path: text for path, text in files.items() if path.rpartition("/")[0] == directory}
+            directory_routes, listing = contents_routes(base_url, in_directory, directory)
+            if not directory:
+                listing += [{"type": "dir", "name": d, "path": d, "url": f"{base_url}/repos/{REPO}/contents/{d}"} for d in ("docs", "pkg")]
+            routes.update(directory_routes)
+            routes[f"/repos/{REPO}/contents" + (f"/{directory}" if directory else "")] = (200, {"Content-Type": "application/json"}, json.dumps(listing).encode("utf-8"))
+        # No tarball route, so the files are downloaded concurrently from the contents API
+        return routes
+
+    document, _ = run_with_server(routes, lambda: process_github_repo(f"https://github.com/{REPO}"))
+
+    assert set(document.metadata["files"]) == set(files)
+    sections = {path: document.text[start:end] for path, start, end in split_sections(document.text)}
+    for path, text in files.items():
+        assert text in sections[path]
+
+
+def test_failed_tarball_falls_back_to_contents_api():
+    def routes(base_url):
+        routes, listing = contents_routes(base_url, FILES)
+        routes[f"/repos/{REPO}/contents"] = (200, {"Content-Type": "application/json"}, json.dumps(listing).encode("utf-8"))
+        # No tarball route, so the archive download gets a 404
+        return routes
+
+    document, _ = run_with_server(routes, lambda: process_github_repo(f"https://github.com/{REPO}"))
+
+    assert set(document.metadata["files"]) == {"README.md", "pkg/core.py", "docs/guide.md"}
+    assert FILES["pkg/core.py"] in document.text
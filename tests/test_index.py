@@ -0,0 +1,99 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.index import IVFIndex, index_path, wyrm_fingerprint
+from bookwyrm.models import Bookwyrm, ChunkTable, DocumentRecord
+from bookwyrm.storage import save_wyrm
+
+TEXTS = [f"chunk {i:03d} of the hoard" for i in range(200)]
+
+
+def make_wyrm(texts=TEXTS) -> Bookwyrm:
+    embeddings = asyncio.run(HashEmbedder(dim=32).embed(texts))
+    chunks = ChunkTable.from_texts(texts, document_index=np.arange(len(texts)) // 50, global_index=np.arange(len(texts)))
+    documents = [DocumentRecord(index=i, uri=f"doc-{i}", metadata={}) for i in range(len(texts) // 50)]
+    return Bookwyrm(documents=documents, chunks=chunks, embeddings=embeddings, embedding_model="hash-32")
+
+
+def test_saved_index_is_loaded_for_the_same_rows(tmp_path):
+    path = tmp_path / "wyrm.npz"
+    wyrm = make_wyrm()
+    wyrm.build_index(num_lists=8)
+    wyrm.save(path)
+
+    loaded = Bookwyrm.load(path)
+    assert loaded.index is not None
+    np.testing.assert_array_equal(loaded.index.assignments, wyrm.index.assignments)
+
+
+def test_index_is_rejected_after_a_same_length_edit(tmp_path):
+    path = tmp_path / "wyrm.npz"
+    wyrm = make_wyrm()
+    wyrm.build_index(num_lists=8)
+    wyrm.save(path)
+
+    # A refresh that changes one character keeps every chunk length
+    edited = list(TEXTS)
+    edited[7] = edited[7].replace("hoard", "horde")
+    assert len(edited[7]) == len(TEXTS[7])
+    save_wyrm(make_wyrm(edited), path)
+
+    assert (tmp_path / "wyrm.ivf.npz").exists()
+    assert Bookwyrm.load(path).index is None
+
+
+def test_save_without_index_removes_a_stale_one(tmp_path):
+    path = tmp_path / "wyrm.npz"
+    wyrm = make_wyrm()
+    wyrm.build_index(num_lists=8)
+    wyrm.save(path)
+    make_wyrm().save(path)
+
+    assert not (tmp_path / "wyrm.ivf.npz").exists()
+    assert index_path(path) == str(tmp_path / "wyrm.ivf.npz")
+
+
+def test_extend_files_new_rows_under_the_existing_centroids(tmp_path):
+    path = tmp_path / "wyrm.npz"
+    full = make_wyrm()
+    wyrm = make_wyrm(TEXTS[:150])
+    index = wyrm.build_index(num_lists=8)
+    centroids = index.centroids.copy()
+
+    wyrm.extend(full.documents[3:], full.chunks[150:], full.float_embeddings(slice(150, None)))
+
+    assert wyrm.index is index and index.num_rows == 200
+    assert index.fingerprint == wyrm_fingerprint(wyrm)
+    np.testing.assert_array_equal(index.centroids, centroids)
+    assert wyrm.chunks.texts() == TEXTS
+    hits = wyrm.search(full.float_embeddings(180), k=1, nprobe=8)
+    assert hits[0].chunk.text == TEXTS[180] and hits[0].document.uri == "doc-3"
+
+    wyrm.save(path)
+    loaded = Bookwyrm.load(path)
+    assert loaded.index is not None
+    np.testing.assert_array_equal(loaded.index.assignments, index.assignments)
+
+
+def test_extend_loads_a_saved_index_before_appending(tmp_path):
+    path = tmp_path / "wyrm.npz"
+    full = make_wyrm()
+    wyrm = make_wyrm(TEXTS[:150]).astype("int8")
+    wyrm.build_index(num_lists=8)
+    wyrm.save(path)
+
+    loaded = Bookwyrm.load(path, mmap=True)
+    loaded.extend([], full.chunks[150:], full.float_embeddings(slice(150, None)))
+
+    assert loaded.index is not None and loaded.index.num_rows == 200
+    assert loaded.embeddings.dtype == np.int8
+    np.testing.assert_array_equal(loaded.embedding_scales, wyrm.embedding_scales)
+
+
+def test_index_add_only_appends():
+    index = IVFIndex.build(make_wyrm().float_embeddings(), num_lists=8)
+    with pytest.raises(ValueError):
+        index.add(np.ones((1, 32), dtype=np.float32), start_row=10)
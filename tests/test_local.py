@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from bookwyrm.scrape.local import scan_local_folder
+
+
+def notebook(source):
+    return json.dumps({
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": source}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 5,
+    })
+
+
+def scan(folder, **kwargs):
+    async def collect():
+        return {document.source: document async for document in scan_local_folder(str(folder), **kwargs)}
+    return asyncio.run(collect())
+
+
+def test_notebooks_are_converted_to_code(tmp_path):
+    (tmp_path / "hoard.ipynb").write_text(notebook("gold = count_hoard()"))
+    (tmp_path / "notes.md").write_text("# Notes\n")
+
+    documents = scan(tmp_path)
+
+    text = documents[str(tmp_path / "hoard.ipynb")].text
+    assert "gold = count_hoard()" in text and '"cells"' not in text
+    assert documents[str(tmp_path / "notes.md")].text.endswith("# Notes\n")
+
+
+def test_large_files_are_skipped_before_they_are_parsed(tmp_path):
+    (tmp_path / "huge.ipynb").write_text(notebook("x = 1\n" * 1000))
+    (tmp_path / "huge.md").write_text("x" * 2000)
+    (tmp_path / "small.ipynb").write_text(notebook("y = 2"))
+    (tmp_path / "binary.txt").write_bytes(b"\0\1\2")
+
+    documents = scan(tmp_path, max_file_bytes=1000)
+
+    assert sorted(documents) == [str(tmp_path / "small.ipynb")]
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from bookwyrm.models import CHUNK_COLUMNS, Bookwyrm, ChunkTable, DocumentRecord, TextChunk
+
+TEXTS = ["first", "", "naïve café", "wyrm 🐉", "last one"]
+
+
+def make_table(texts=TEXTS) -> ChunkTable:
+    n = len(texts)
+    return ChunkTable.from_texts(texts, document_index=np.arange(n) // 2, local_index=np.arange(n), global_index=np.arange(n) + 10)
+
+
+def test_from_texts_round_trips_multibyte_text():
+    table = make_table()
+    assert len(table) == len(TEXTS)
+    assert table.texts() == TEXTS
+    assert [chunk.text for chunk in table] == TEXTS
+    assert set(table.columns) == set(CHUNK_COLUMNS)
+    assert table[3] == TextChunk(text="wyrm 🐉", document_index=1, local_index=3, global_index=13)
+    assert table[-1].text == "last one"
+    with pytest.raises(IndexError):
+        table[len(TEXTS)]
+
+
+def test_slice_is_a_view_and_step_slice_a_copy():
+    table = make_table()
+    view = table[1:4]
+    assert view.text is table.text
+    assert view.texts() == TEXTS[1:4]
+    np.testing.assert_array_equal(view.columns["global_index"], [11, 12, 13])
+    assert len(table[4:2]) == 0 and table[4:2].texts() == []
+
+    stepped = table[::2]
+    assert stepped.texts() == TEXTS[::2]
+    assert len(stepped.text) == sum(len(t.encode("utf-8")) for t in TEXTS[::2])
+
+
+def test_take_copies_rows_in_any_order():
+    table = make_table()
+    taken = table.take([4, 0, 2, 2])
+    assert taken.texts() == [TEXTS[4], TEXTS[0], TEXTS[2], TEXTS[2]]
+    np.testing.assert_array_equal(taken.columns["local_index"], [4, 0, 2, 2])
+    assert taken.offsets[0] == 0 and taken.offsets[-1] == len(taken.text)
+    assert table[[1, 3]].texts() == [TEXTS[1], TEXTS[3]]
+    assert table.take([]).texts() == []
+
+
+def test_concat_compacts_views():
+    table = make_table()
+    joined = ChunkTable.concat([table[3:], table[:2], ChunkTable.from_texts([])])
+    assert joined.texts() == TEXTS[3:] + TEXTS[:2]
+    np.testing.assert_array_equal(joined.columns["global_index"], [13, 14, 10, 11])
+    assert joined.offsets[-1] == len(joined.text)
+    assert len(ChunkTable.concat([])) == 0
+
+
+def test_replace_shares_text_and_broadcasts_scalars():
+    table = make_table()
+    replaced = table.replace(document_index=7, global_index=np.arange(5) * 2)
+    assert replaced.text is table.text
+    assert replaced.texts() == TEXTS
+    np.testing.assert_array_equal(replaced.columns["document_index"], [7] * 5)
+    np.testing.assert_array_equal(replaced.columns["global_index"], [0, 2, 4, 6, 8])
+    # The original columns are untouched
+    np.testing.assert_array_equal(table.columns["global_index"], np.arange(5) + 10)
+    np.testing.assert_array_equal(replaced.columns["local_index"], table.columns["local_index"])
+
+
+def test_from_chunks_matches_to_dicts():
+    table = make_table()
+    rebuilt = ChunkTable.from_chunks(table.to_dicts())
+    assert rebuilt.to_dicts() == table.to_dicts()
+    assert ChunkTable.coerce(table) is table
+    assert ChunkTable.coerce(list(table)).texts() == TEXTS
+
+
+def make_wyrm(embeddings, **kwargs) -> Bookwyrm:
+    documents = [DocumentRecord(index=0, uri="doc-0", metadata={})]
+    return Bookwyrm(documents=documents, chunks=make_table(TEXTS[:len(embeddings)]), embeddings=embeddings, **kwargs)
+
+
+def test_float_embeddings_are_quantized_for_int8():
+    vectors = np.random.default_rng(0).standard_normal((4, 8))
+    wyrm = make_wyrm(vectors, embedding_dtype="int8")
+
+    assert wyrm.embeddings.dtype == np.int8 and np.abs(wyrm.embeddings).max() == 127
+    np.testing.assert_allclose(wyrm.float_embeddings(), vectors, atol=wyrm.embedding_scales.max())
+
+    scales = np.full(8, 0.05, dtype=np.float32)
+    rescaled = make_wyrm(vectors, embedding_dtype="int8", embedding_scales=scales)
+    np.testing.assert_array_equal(rescaled.embedding_scales, scales)
+    np.testing.assert_array_equal(rescaled.embeddings, np.clip(np.rint(vectors / 0.05), -127, 127))
+
+
+def test_int8_embeddings_keep_their_scales():
+    wyrm = make_wyrm(np.random.default_rng(1).standard_normal((4, 8)), embedding_dtype="int8")
+    loaded = Bookwyrm.from_json(wyrm.to_json())
+    np.testing.assert_array_equal(loaded.embeddings, wyrm.embeddings)
+    np.testing.assert_array_equal(loaded.embedding_scales, wyrm.embedding_scales)
+
+    with pytest.raises(ValueError):
+        make_wyrm(wyrm.embeddings, embedding_dtype="int8")
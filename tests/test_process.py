@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from bookwyrm.models import Document
+from bookwyrm.process import chunk, chunk_document, chunk_sections, split_sections
+from bookwyrm.utils import get_encoding
+
+
+def file_section(path, lines):
+    return f"# ---\n# Filename: {path}\n# ---\n\n" + "\n".join(lines) + "\n\n"
+
+
+def make_document(num_files=3, num_lines=40):
+    text = "A short description before the first file.\n\n"
+    for f in range(num_files):
+        lines = [f"Line {i} of file {f} says café and naïve things." + ("\n" if i % 7 == 6 else "") for i in range(num_lines)]
+        text += file_section(f"src/file_{f}.py", lines)
+    return Document(text=text, source="test", metadata={})
+
+
+def assert_spans_match_text(document, chunks):
+    for c in chunks:
+        assert c.text == document.text[c.char_start:c.char_end]
+
+
+@pytest.mark.parametrize("max_tokens,overlap", [(16, 0), (32, 4), (64, 16), (10_000, 0)])
+def test_chunks_stay_within_max_tokens_and_sections(max_tokens, overlap):
+    document = make_document()
+    sections = chunk_sections(document, document_index=0, max_tokens=max_tokens, overlap=overlap)
+
+    assert [path for path, _ in sections] == [path for path, _, _ in split_sections(document.text)]
+    spans = {path: (start, end) for path, start, end in split_sections(document.text)}
+    for path, chunks in sections:
+        token_start, token_end = chunks.columns["token_start"], chunks.columns["token_end"]
+        assert np.all(token_end - token_start <= max_tokens)
+        assert np.all(token_end > token_start)
+        # Consecutive windows share exactly `overlap` tokens and never leave the section
+        np.testing.assert_array_equal(token_start[1:], token_end[:-1] - overlap)
+        start, end = spans[path]
+        assert chunks.columns["char_start"][0] == start and chunks.columns["char_end"][-1] == end
+        assert_spans_match_text(document, chunks)
+
+
+def test_windows_end_at_line_breaks_where_possible():
+    # Every line is far shorter than the last quarter of a window
+    text = file_section("notes.txt", [f"Note {i}." for i in range(200)])
+    document = Document(text=text, source="test", metadata={})
+    chunks = chunk_document(document, 0, max_tokens=64)
+    ends = [document.text[:c.char_end] for c in chunks][:-1]
+    assert len(ends) > 2
+    assert all(end.endswith("\n") for end in ends)
+
+
+def test_chunk_numbers_chunks_across_documents():
+    documents = [make_document(num_files=2), make_document(num_files=1)]
+    chunks = chunk(documents, max_tokens=32)
+
+    np.testing.assert_array_equal(chunks.columns["global_index"], np.arange(len(chunks)))
+    for i, document in enumerate(documents):
+        mine = chunks.columns["document_index"] == i
+        np.testing.assert_array_equal(chunks.columns["local_index"][mine], np.arange(mine.sum()))
+        assert_spans_match_text(document, chunks[np.flatnonzero(mine)])
+
+
+def test_passed_tokens_give_the_same_chunks():
+    document = make_document()
+    tokens = np.array(get_encoding().encode_ordinary(document.text))
+    a = chunk_document(document, 0, max_tokens=24, overlap=4)
+    b = chunk_document(document, 0, max_tokens=24, overlap=4, tokens=tokens)
+    assert a.texts() == b.texts()
+    np.testing.assert_array_equal(a.columns["token_end"], b.columns["token_end"])
+
+
+def test_empty_document_has_no_chunks():
+    assert chunk_sections(Document(text="", source="empty", metadata={}), 0) == []
+
+
+def test_overlap_is_bounded_by_half_the_window():
+    with pytest.raises(ValueError):
+        chunk_sections(make_document(), 0, max_tokens=16, overlap=9)
@@ -0,0 +1,95 @@
+import asyncio
+from collections import Counter
+
+from bookwyrm.scrape.document import create_document
+from bookwyrm.scrape.main import TASK_SOURCES, ScrapeScheduler, get_task_type, scrape_iter
+
+REPOS = [f"https://github.com/octo/repo-{i}" for i in range(6)]
+SITES = [f"https://example.com/site-{i}" for i in range(3)]
+
+
+class FakeScraper:
+    """
+    Stands in for `iter_task`, recording how many tasks of each source run at once.
+    """
+    def __init__(self, delays=None, errors=None):
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.active = Counter()
+        self.peak = Counter()
+        self.started = []
+
+    async def __call__(self, task, previous):
+        source = TASK_SOURCES[get_task_type(task)]
+        self.started.append(task)
+        self.active[source] += 1
+        self.active["all"] += 1
+        self.peak[source] = max(self.peak[source], self.active[source])
+        self.peak["all"] = max(self.peak["all"], self.active["all"])
+        try:
+            await asyncio.sleep(self.delays.get(task, 0.01))
+            if task in self.errors:
+                raise self.errors[task]
+        finally:
+            self.active[source] -= 1
+            self.active["all"] -= 1
+        yield create_document(f"text of {task}", task, {"scraped": True})
+
+
+def run(scheduler, tasks, scraper, previous=None):
+    async def collect():
+        return [result async for result in scheduler.run(tasks, previous, iterate=scraper)]
+    return asyncio.run(collect())
+
+
+def test_per_source_and_global_caps():
+    scraper = FakeScraper()
+    results = run(ScrapeScheduler(max_concurrency=8, source_limits={"github": 2, "web": 1}), REPOS + SITES, scraper)
+    assert sorted(position for position, _ in results) == list(range(len(REPOS + SITES)))
+    assert scraper.peak["github"] == 2 and scraper.peak["web"] == 1
+
+    scraper = FakeScraper()
+    run(ScrapeScheduler(max_concurrency=3), REPOS + SITES, scraper)
+    assert scraper.peak["all"] == 3
+
+
+def test_tasks_start_in_priority_order():
+    scraper = FakeScraper()
+    tasks = ["10.1000/xyz123", SITES[0], REPOS[0]]
+    run(ScrapeScheduler(max_concurrency=1), tasks, scraper)
+    assert scraper.started == [REPOS[0], SITES[0], "10.1000/xyz123"]
+
+
+def test_failed_and_timed_out_tasks_yield_error_documents():
+    scraper = FakeScraper(delays={SITES[0]: 10}, errors={REPOS[1]: RuntimeError("rate limited")})
+    previous = {REPOS[1]: {"files": {"README.md": "abc"}}}
+    results = dict(run(ScrapeScheduler(timeouts={"web_content": 0.05}), REPOS[:3] + SITES[:1] + ["not a task"], scraper, previous))
+
+    assert results[0].metadata == {"scraped": True} and results[2].metadata == {"scraped": True}
+    failed = results[1].metadata
+    # The earlier run's content is kept by marking the source not modified
+    assert failed["error"] == "RuntimeError: rate limited" and failed["not_modified"] and failed["files"] == {"README.md": "abc"}
+    assert results[3].metadata["error"] == "TimeoutError: Timed out after 0.05s"
+    assert results[3].metadata["task_type"] == "web_content"
+    assert results[4].metadata["task_type"] == "unsupported"
+
+
+def test_timed_out_folder_keeps_files_it_did_not_reach(tmp_path):
+    for i in range(5):
+        (tmp_path / f"file_{i}.txt").write_text(f"File number {i}.\n")
+    folder = str(tmp_path)
+
+    async def scrape(previous=None, scheduler=None):
+        return [document async for document in scrape_iter([folder], previous, scheduler)]
+
+    first = asyncio.run(scrape())
+    assert len(first) == 5 and not any("error" in document.metadata for document in first)
+    previous = {document.source: document.metadata for document in first}
+
+    documents = asyncio.run(scrape(previous, ScrapeScheduler(timeouts={"local_folder": 0.0})))
+
+    errors = [document for document in documents if "error" in document.metadata]
+    assert [document.source for document in errors] == [folder]
+    files = [document for document in documents if document.source != folder]
+    assert sorted(document.source for document in files) == sorted(previous)
+    assert all(document.metadata["not_modified"] for document in files)
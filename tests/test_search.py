@@ -0,0 +1,93 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from bookwyrm import search
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.models import Bookwyrm, ChunkTable, DocumentRecord
+from bookwyrm.search import top_k
+
+
+def make_wyrm(num_rows=100, dim=16, num_documents=4) -> Bookwyrm:
+    rng = np.random.default_rng(0)
+    # Rows of different lengths, so scores must be cosine and not dot products
+    embeddings = (rng.standard_normal((num_rows, dim)) * rng.uniform(0.1, 10, (num_rows, 1))).astype(np.float32)
+    texts = [f"chunk {i}" for i in range(num_rows)]
+    chunks = ChunkTable.from_texts(texts, document_index=np.arange(num_rows) % num_documents, global_index=np.arange(num_rows))
+    documents = [DocumentRecord(index=i, uri=f"doc-{i}", metadata={}) for i in range(num_documents)]
+    return Bookwyrm(documents=documents, chunks=chunks, embeddings=embeddings)
+
+
+def brute_force(embeddings, queries, k, rows=None):
+    rows = np.arange(len(embeddings)) if rows is None else rows
+    vectors = embeddings[rows] / np.linalg.norm(embeddings[rows], axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ vectors.T
+    order = np.argsort(-scores, axis=1)[:, :k]
+    return rows[order], np.take_along_axis(scores, order, axis=1)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 32, 1000])
+def test_blocked_top_k_matches_brute_force(monkeypatch, block_size):
+    # Several query blocks as well as several row blocks
+    monkeypatch.setattr(search, "QUERY_BLOCK_SIZE", 3)
+    wyrm = make_wyrm()
+    queries = np.random.default_rng(1).standard_normal((10, 16)).astype(np.float32)
+
+    indices, scores = top_k(wyrm, queries, k=5, block_size=block_size)
+    expected_indices, expected_scores = brute_force(wyrm.embeddings, queries, 5)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+
+def test_top_k_over_selected_rows():
+    wyrm = make_wyrm()
+    queries = np.random.default_rng(2).standard_normal((4, 16)).astype(np.float32)
+    rows = np.flatnonzero(wyrm.document_indices() == 1)
+
+    indices, _ = top_k(wyrm, queries, k=6, rows=rows, block_size=4)
+
+    np.testing.assert_array_equal(indices, brute_force(wyrm.embeddings, queries, 6, rows)[0])
+
+
+def test_k_is_capped_by_the_number_of_rows():
+    wyrm = make_wyrm(num_rows=3)
+    indices, scores = top_k(wyrm, np.ones(16, dtype=np.float32), k=10, block_size=2)
+    assert indices.shape == scores.shape == (1, 3)
+    assert sorted(indices[0]) == [0, 1, 2]
+    assert np.all(np.diff(scores[0]) <= 0)
+
+
+def test_int8_search_finds_the_same_neighbours():
+    wyrm = make_wyrm()
+    queries = wyrm.embeddings[[3, 50, 97]]
+
+    hits = wyrm.astype("int8").search(queries, k=1, block_size=8)
+
+    assert [h[0].chunk.global_index for h in hits] == [3, 50, 97]
+
+
+def test_search_filters_by_document():
+    wyrm = make_wyrm()
+    hits = wyrm.search(wyrm.embeddings[5], k=5, document_index=[2, 3], block_size=16)
+    assert len(hits) == 5
+    assert {hit.document.uri for hit in hits} <= {"doc-2", "doc-3"}
+    assert hits[0].score >= hits[-1].score
+
+
+def test_search_text_embeds_with_the_corpus_model():
+    texts = ["the wyrm sleeps", "on a hoard of gold", "in the mountain"]
+    embedder = HashEmbedder(dim=16)
+    wyrm = Bookwyrm(
+        documents=[DocumentRecord(index=0, uri="doc-0", metadata={})],
+        chunks=ChunkTable.from_texts(texts, document_index=np.zeros(3, dtype=np.int64)),
+        embeddings=asyncio.run(embedder.embed(texts)),
+        embedding_model=embedder.model_id,
+    )
+
+    hits = asyncio.run(wyrm.search_text("on a hoard of gold", k=1, embedder=embedder))
+    assert hits[0].chunk.text == "on a hoard of gold"
+    with pytest.raises(ValueError):
+        asyncio.run(wyrm.search_text("gold", embedder=HashEmbedder(dim=8)))
@@ -0,0 +1,141 @@
+import asyncio
+import io
+
+import numpy as np
+import pytest
+
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.models import Bookwyrm, ChunkTable, DocumentRecord
+
+TEXTS = ["A wyrm hoards books.", "Ünïcode survives the trip.", "", "The last chunk."]
+
+
+def make_wyrm() -> Bookwyrm:
+    embeddings = asyncio.run(HashEmbedder(dim=8).embed(TEXTS))
+    chunks = ChunkTable.from_texts(TEXTS, document_index=[0, 0, 1, 1], local_index=[0, 1, 0, 1], global_index=np.arange(4))
+    documents = [DocumentRecord(index=i, uri=f"doc-{i}", metadata={"n": i}) for i in range(2)]
+    return Bookwyrm(documents=documents, chunks=chunks, embeddings=embeddings, embedding_model="hash-8")
+
+
+def ndjson_lines(wyrm: Bookwyrm):
+    buffer = io.StringIO()
+    wyrm.to_ndjson(buffer)
+    return buffer.getvalue().splitlines(keepends=True)
+
+
+def assert_same(loaded: Bookwyrm, wyrm: Bookwyrm):
+    assert loaded.documents == wyrm.documents
+    assert loaded.chunks.to_dicts() == wyrm.chunks.to_dicts()
+    np.testing.assert_array_equal(loaded.float_embeddings(), wyrm.float_embeddings())
+    assert loaded.embedding_model == wyrm.embedding_model
+
+
+def test_ndjson_round_trip():
+    wyrm = make_wyrm()
+    assert_same(Bookwyrm.from_ndjson(io.StringIO("".join(ndjson_lines(wyrm)))), wyrm)
+
+
+def test_truncated_ndjson_is_rejected():
+    lines = ndjson_lines(make_wyrm())
+    # A writer killed after the chunks, mid-way through the embeddings
+    with pytest.raises(ValueError, match="embedding rows"):
+        Bookwyrm.from_ndjson(io.StringIO("".join(lines[:-2])))
+    # Or part-way through a line
+    with pytest.raises(ValueError):
+        Bookwyrm.from_ndjson(io.StringIO("".join(lines)[:-10]))
+
+
+def test_repeated_embedding_row_is_rejected():
+    lines = ndjson_lines(make_wyrm())
+    with pytest.raises(ValueError, match="repeated"):
+        Bookwyrm.from_ndjson(io.StringIO("".join(lines[:-1] + [lines[-2]])))
+
+
+def test_binary_round_trip(tmp_path):
+    wyrm = make_wyrm()
+    wyrm.save(tmp_path / "wyrm.npz")
+    assert_same(Bookwyrm.load(tmp_path / "wyrm.npz"), wyrm)
+
+
+def test_binary_round_trip_keeps_shared_embedding_rows(tmp_path):
+    wyrm = make_wyrm()
+    shared = Bookwyrm(
+        documents=wyrm.documents,
+        chunks=wyrm.chunks,
+        embeddings=wyrm.embeddings[:3],
+        embedding_rows=np.array([0, 1, 2, 0]),
+        embedding_model=wyrm.embedding_model,
+    )
+    shared.save(tmp_path / "wyrm.npz")
+
+    loaded = Bookwyrm.load(tmp_path / "wyrm.npz")
+    np.testing.assert_array_equal(loaded.embedding_rows, [0, 1, 2, 0])
+    assert_same(loaded, shared)
+
+
+def test_empty_wyrm_round_trip(tmp_path):
+    empty = Bookwyrm(documents=[], chunks=[], embeddings=np.array([]))
+    empty.save(tmp_path / "wyrm.npz")
+    loaded = Bookwyrm.load(tmp_path / "wyrm.npz")
+    assert len(loaded.chunks) == 0 and loaded.documents == []
+
+
+@pytest.mark.parametrize("output_format", ["json", "ndjson", "binary"])
+def test_write_output_formats_read_back(tmp_path, output_format):
+    from bookwyrm.bookwyrm import write_output
+
+    wyrm = make_wyrm()
+    path = tmp_path / f"wyrm.{output_format}"
+    write_output(wyrm, str(path), output_format)
+    if output_format == "json":
+        loaded = Bookwyrm.from_json(path.read_text())
+    elif output_format == "ndjson":
+        loaded = Bookwyrm.from_ndjson(path)
+    else:
+        loaded = Bookwyrm.load(path)
+    assert_same(loaded, wyrm)
+
+
+def test_other_npz_files_are_rejected(tmp_path):
+    np.savez(tmp_path / "other.npz", header=np.frombuffer(b'{"format": "other"}', dtype=np.uint8))
+    with pytest.raises(ValueError, match="Not a bookwyrm file"):
+        Bookwyrm.load(tmp_path / "other.npz")
+
+
+def test_mmap_load_maps_arrays_read_only(tmp_path):
+    wyrm = make_wyrm()
+    wyrm.save(tmp_path / "wyrm.npz")
+
+    mapped = Bookwyrm.load(tmp_path / "wyrm.npz", mmap=True)
+    assert isinstance(mapped.embeddings, np.memmap)
+    assert isinstance(mapped.chunks.text, np.memmap)
+    with pytest.raises(ValueError):
+        mapped.embeddings[0, 0] = 1
+    assert_same(mapped, wyrm)
+
+
+def test_mmap_chunks_are_built_on_access(tmp_path):
+    wyrm = make_wyrm()
+    wyrm.save(tmp_path / "wyrm.npz")
+
+    chunks = Bookwyrm.load(tmp_path / "wyrm.npz", mmap=True).chunks
+    assert chunks[1].text == TEXTS[1] and chunks[-1].document_index == 1
+    # A slice is a view on the mapped columns
+    assert chunks[1:3].texts() == TEXTS[1:3]
+    assert chunks[1:3].text is chunks.text
+
+
+def test_mmap_keeps_int8_embeddings_and_shared_rows(tmp_path):
+    wyrm = make_wyrm()
+    shared = Bookwyrm(
+        documents=wyrm.documents,
+        chunks=wyrm.chunks,
+        embeddings=wyrm.embeddings[:3],
+        embedding_rows=np.array([0, 1, 2, 0]),
+    ).astype("int8")
+    shared.save(tmp_path / "wyrm.npz")
+
+    mapped = Bookwyrm.load(tmp_path / "wyrm.npz", mmap=True)
+    assert mapped.embeddings.dtype == np.int8
+    np.testing.assert_array_equal(mapped.float_embeddings(), shared.float_embeddings())
+    np.testing.assert_array_equal(mapped.float_embeddings(3), mapped.float_embeddings(0))
@@ -0,0 +1,90 @@
+import asyncio
+
+from benchmarks.offline import StandInServer
+from bookwyrm.bookwyrm import process_documents
+from bookwyrm.embed import HashEmbedder
+from bookwyrm.scrape.web import crawl_and_extract_text
+
+HTML = {"Content-Type": "text/html; charset=utf-8"}
+
+
+def page(title, body=""):
+    return f"<html><body><h1>{title}</h1><p>{body}</p></body></html>".encode("utf-8")
+
+
+def site_routes(version=1):
+    links = "".join(f'<a href="/site/page/{i}">Page {i}</a>' for i in range(3))
+    return {
+        "/site": (200, {**HTML, "ETag": '"start"'}, page("Site", links)),
+        "/site/page/0": (200, {**HTML, "ETag": '"zero"'}, page("Page 0", "Page zero never changes.")),
+        "/site/page/1": (200, {**HTML, "ETag": f'"v{version}"'}, page("Page 1", f"Version {version} of page one.")),
+        # No validators, so only the digest of its text shows it is unchanged
+        "/site/page/2": (200, HTML, page("Page 2", "Page two has no ETag.")),
+    }
+
+
+class RecordingEmbedder(HashEmbedder):
+    def __init__(self):
+        super().__init__(dim=16)
+        self.texts = []
+
+    async def embed(self, texts):
+        self.texts.extend(texts)
+        return await super().embed(texts)
+
+
+def run_with_site(steps):
+    """
+    Serve the site and await each `step(base_url, server, results)` in turn, returning their results.
+    """
+    async def run():
+        server = StandInServer()
+        await server.start()
+        results = []
+        try:
+            for step in steps:
+                results.append(await step(server.base_url, server, results))
+            return results
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+
+def test_unchanged_pages_are_not_returned_again():
+    async def first(base_url, server, results):
+        server.routes = site_routes()
+        return await crawl_and_extract_text(f"{base_url}/site")
+
+    async def second(base_url, server, results):
+        server.routes = site_routes(version=2)
+        return await crawl_and_extract_text(f"{base_url}/site", previous_metadata=results[0].metadata)
+
+    document = run_with_site([first, second])[1]
+    base_url = document.source.rsplit("/site", 1)[0]
+
+    # The start page answered 304, but the crawl still reached the changed page
+    assert document.metadata["pages"] == [f"{base_url}/site"] + [f"{base_url}/site/page/{i}" for i in range(3)]
+    assert document.metadata["unchanged_files"] == [f"{base_url}/site", f"{base_url}/site/page/0", f"{base_url}/site/page/2"]
+    assert "Version 2 of page one." in document.text
+    assert "Page zero" not in document.text and "Page two" not in document.text
+    assert document.metadata["page_validators"][f"{base_url}/site/page/1"]["etag"] == '"v2"'
+
+
+def test_refresh_only_embeds_changed_pages():
+    embedder = RecordingEmbedder()
+
+    async def first(base_url, server, results):
+        server.routes = site_routes()
+        return await process_documents([f"{base_url}/site"], embedder=embedder)
+
+    async def second(base_url, server, results):
+        server.routes = site_routes(version=2)
+        embedder.texts.clear()
+        return await process_documents([f"{base_url}/site"], embedder=embedder, previous=results[0])
+
+    refreshed = run_with_site([first, second])[1]
+
+    assert embedder.texts and all("Page 1" in text for text in embedder.texts)
+    texts = "".join(refreshed.chunks.texts())
+    assert "Version 2 of page one." in texts and "Version 1" not in texts
+    assert "Page zero never changes." in texts and "Page two has no ETag." in texts